@@ -1,27 +1,69 @@
+import argparse
+import asyncio
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import html
+import io
+import itertools
+import json
 import logging
 import os
+import queue
+import random
+import re
+import shutil
 import sqlite3
+import sys
+import tempfile
+import time
 import traceback
-from datetime import datetime
-from contextlib import asynccontextmanager
+import tracemalloc
+import urllib.parse
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramServerError
+from aiogram.methods import EditMessageText, GetChatMember, GetMe, SendDocument, SendMessage
 from aiogram.types import (
-    Message, CallbackQuery, ChatJoinRequest,
+    Message, CallbackQuery, ChatJoinRequest, ChatMemberUpdated,
     InlineKeyboardButton, InlineKeyboardMarkup,
-    ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+    ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton,
+    Update, User, Chat, ChatMemberMember, ChatMemberLeft, FSInputFile
 )
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
 
 # === 🔧 SOZLAMALAR ===
 load_dotenv(".env")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = 8380378054  # ADMIN ID ni o'zingiznikiga almashtiring
-
-if not BOT_TOKEN:
+# Bir jarayonda bir nechta bot: [{"token": ..., "admin_id": ..., "db_path": ...}, ...] ko'rinishidagi JSON fayl
+BOTS_CONFIG = os.getenv("BOTS_CONFIG")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))  # bo'sh ulanish hovuzda necha soniya saqlanadi
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archives")
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+# users / points_given / referrals_awarded jadvallarini user_id bo'yicha K ta faylga bo'lish (0 = o'chiq)
+DB_SHARDS = int(os.getenv("DB_SHARDS", "0"))
+# Statistika kun/soat chegaralari uchun UTC ga nisbatan siljish (Toshkent = +5)
+STATS_UTC_OFFSET = int(os.getenv("STATS_UTC_OFFSET", "5"))
+
+if not BOT_TOKEN and not BOTS_CONFIG:
     raise SystemExit("❌ Iltimos, .env faylda BOT_TOKEN qiymatini kiriting!")
 
 # === LOGGING ===
@@ -33,14 +75,51 @@ logger = logging.getLogger(__name__)
 
 
 # === DATABASE ===
+# Shard rejimida user_id bo'yicha bo'linadigan jadvallar (referrals_awarded — referrer_id bo'yicha)
+SHARDED_TABLES = ("users", "points_given", "referrals_awarded", "points_ledger")
+# Soatlik / kunlik / umumiy hisoblagichlar — yozuv bilan bir tranzaksiyada, foydalanuvchi shardida yangilanadi
+STATS_TABLES = ("stats_hourly", "stats_daily", "stats_total")
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "8"))  # o'qish oqimlari va har bir fayl uchun ochiq ro ulanishlar
+# run_read ichida True: get_connection() hovuzdan mode=ro ulanish beradi
+db_read_only = ContextVar("db_read_only", default=False)
+
+
+class ReadOnlyConnection(sqlite3.Connection):
+    """mode=ro ulanish; close() uni yopmasdan hovuzga qaytaradi"""
+
+    def close(self):
+        try:
+            if self.in_transaction:
+                self.rollback()
+            for _, name, _ in self.execute("PRAGMA database_list").fetchall():
+                if name not in ("main", "temp"):
+                    self.execute(f"DETACH DATABASE {name}")
+        except sqlite3.Error:
+            super().close()
+            return
+        if self.pool.qsize() < READ_POOL_SIZE:
+            self.pool.put(self)
+        else:
+            super().close()
+
+
 class Database:
-    def __init__(self, path: str = "bot_full.db"):
+    def __init__(self, path: str = "bot_full.db", shards: int = 0):
         self.path = path
+        self._read_pool = queue.SimpleQueue()
         self._init_db()
+        # Har bir shard — alohida SQLite fayl, o'z WAL i va o'z yozish qulfi bilan
+        self.shards = []
+        if shards > 1:
+            root, ext = os.path.splitext(path)
+            self.shards = [Database(f"{root}.shard{k}{ext or '.db'}") for k in range(shards)]
+            self._migrate_to_shards()
 
     def _init_db(self):
         conn = sqlite3.connect(self.path, check_same_thread=False)
         cur = conn.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'points_ledger'")
+        ledger_existed = cur.fetchone() is not None
         cur.executescript("""
                           CREATE TABLE IF NOT EXISTS users
                           (
@@ -153,15 +232,288 @@ class Database:
                               points_required
                               INTEGER
                           );
+                          CREATE INDEX IF NOT EXISTS idx_users_points_id ON users (points, user_id);
+                          CREATE INDEX IF NOT EXISTS idx_gifts_points_id ON gifts (points_required, id);
+                          CREATE TABLE IF NOT EXISTS gift_orders
+                          (
+                              id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                              user_id    INTEGER,
+                              gift_id    INTEGER,
+                              gift_name  TEXT,
+                              points     INTEGER,
+                              status     TEXT      DEFAULT 'pending',
+                              created_ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                              done_ts    TIMESTAMP
+                          );
+                          CREATE INDEX IF NOT EXISTS idx_gift_orders_status ON gift_orders (status, id);
+                          CREATE TABLE IF NOT EXISTS subscriptions
+                          (
+                              user_id    INTEGER,
+                              chat_id    TEXT,
+                              status     TEXT,
+                              updated_at INTEGER,
+                              PRIMARY KEY (user_id, chat_id)
+                          );
+                          CREATE TABLE IF NOT EXISTS job_state
+                          (
+                              name       TEXT PRIMARY KEY,
+                              value      TEXT,
+                              updated_ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                          );
+                          CREATE TABLE IF NOT EXISTS stats_hourly
+                          (
+                              bucket     TEXT,
+                              metric     TEXT,
+                              channel_id TEXT    DEFAULT '',
+                              count      INTEGER DEFAULT 0,
+                              points     INTEGER DEFAULT 0,
+                              PRIMARY KEY (bucket, metric, channel_id)
+                          ) WITHOUT ROWID;
+                          CREATE TABLE IF NOT EXISTS stats_daily
+                          (
+                              bucket     TEXT,
+                              metric     TEXT,
+                              channel_id TEXT    DEFAULT '',
+                              count      INTEGER DEFAULT 0,
+                              points     INTEGER DEFAULT 0,
+                              PRIMARY KEY (bucket, metric, channel_id)
+                          ) WITHOUT ROWID;
+                          CREATE TABLE IF NOT EXISTS points_ledger
+                          (
+                              id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                              user_id    INTEGER,
+                              delta      INTEGER,
+                              ref_delta  INTEGER   DEFAULT 0,
+                              reason     TEXT,
+                              contest_id INTEGER,
+                              ref        TEXT,
+                              ts         TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                          );
+                          CREATE INDEX IF NOT EXISTS idx_points_ledger_user ON points_ledger (user_id, id);
+                          CREATE TABLE IF NOT EXISTS scheduled_jobs
+                          (
+                              id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                              kind       TEXT,
+                              payload    TEXT,
+                              run_at     INTEGER,
+                              status     TEXT      DEFAULT 'pending',
+                              job_key    TEXT,
+                              attempts   INTEGER   DEFAULT 0,
+                              last_error TEXT,
+                              created_ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                          );
+                          CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (run_at) WHERE status = 'pending';
+                          CREATE UNIQUE INDEX IF NOT EXISTS idx_scheduled_jobs_key
+                              ON scheduled_jobs (job_key) WHERE status = 'pending';
+                          CREATE TABLE IF NOT EXISTS leaderboard_snapshots
+                          (
+                              snapshot_ts INTEGER,
+                              contest_id  INTEGER,
+                              rank        INTEGER,
+                              user_id     INTEGER,
+                              full_name   TEXT,
+                              points      INTEGER,
+                              PRIMARY KEY (snapshot_ts, rank)
+                          );
+                          CREATE TABLE IF NOT EXISTS stats_total
+                          (
+                              metric     TEXT,
+                              channel_id TEXT    DEFAULT '',
+                              count      INTEGER DEFAULT 0,
+                              points     INTEGER DEFAULT 0,
+                              PRIMARY KEY (metric, channel_id)
+                          ) WITHOUT ROWID;
+                          CREATE TABLE IF NOT EXISTS fsm_states
+                          (
+                              key        TEXT PRIMARY KEY,
+                              state      TEXT,
+                              data       TEXT,
+                              updated_ts INTEGER
+                          ) WITHOUT ROWID;
+                          CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_ts);
+                          """)
+        # Eski bazalar uchun yangi ustunlar
+        self._ensure_column(cur, "gifts", "stock", "INTEGER")  # NULL = cheklanmagan
+        self._ensure_column(cur, "points_given", "left_ts", "TIMESTAMP")  # obunadan chiqqan (flag rejimi)
+        # check — a'zolik tekshirilib berilgan, request — qo'shilish so'rovi uchun (hali tasdiqlanmagan bo'lishi mumkin)
+        self._ensure_column(cur, "points_given", "source", "TEXT DEFAULT 'check'")
+        self._ensure_column(cur, "gift_orders", "nonce", "TEXT")  # tasdiqlash xabari — takroriy bosishga qarshi
+        if self._ensure_column(cur, "users", "last_active", "TIMESTAMP"):
+            cur.execute("UPDATE users SET last_active = joined_ts")
+        # Segmentli xabar yuborish filtrlari uchun indekslar
+        cur.executescript("""
+                          CREATE INDEX IF NOT EXISTS idx_users_joined_ts ON users (joined_ts);
+                          CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active);
+                          CREATE INDEX IF NOT EXISTS idx_users_referrals ON users (referrals);
+                          CREATE INDEX IF NOT EXISTS idx_points_given_channel ON points_given (channel_id, user_id);
+                          CREATE UNIQUE INDEX IF NOT EXISTS idx_gift_orders_nonce
+                              ON gift_orders (user_id, nonce) WHERE nonce IS NOT NULL;
+                          """)
+        # /find uchun to'liq matnli indeks — users jadvalining o'zidan o'qiydi, triggerlar bilan sinxron
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'")
+        fts_existed = cur.fetchone() is not None
+        cur.executescript("""
+                          CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5
+                          (
+                              username,
+                              full_name,
+                              content = 'users',
+                              content_rowid = 'user_id',
+                              prefix = '2 3',
+                              tokenize = 'unicode61 remove_diacritics 2'
+                          );
+                          CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users
+                          BEGIN
+                              INSERT INTO users_fts (rowid, username, full_name)
+                              VALUES (new.user_id, new.username, new.full_name);
+                          END;
+                          CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users
+                          BEGIN
+                              INSERT INTO users_fts (users_fts, rowid, username, full_name)
+                              VALUES ('delete', old.user_id, old.username, old.full_name);
+                          END;
+                          -- Ball o'zgarishlari indeksga tegmaydi — faqat ism/username o'zgarganda
+                          CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, full_name ON users
+                              WHEN old.username IS NOT new.username OR old.full_name IS NOT new.full_name
+                          BEGIN
+                              INSERT INTO users_fts (users_fts, rowid, username, full_name)
+                              VALUES ('delete', old.user_id, old.username, old.full_name);
+                              INSERT INTO users_fts (rowid, username, full_name)
+                              VALUES (new.user_id, new.username, new.full_name);
+                          END;
                           """)
+        if not fts_existed:
+            cur.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+        conn.commit()
+        self._backfill_stats(cur)
+        if not ledger_existed:
+            self._open_ledger(cur)
         conn.commit()
+        # WAL rejimi: o'quvchilar yozuvchini kutmaydi (bulk import paytida ham)
+        cur.execute("PRAGMA journal_mode=WAL")
         conn.close()
 
+    @staticmethod
+    def _open_ledger(cur):
+        """Daftar paydo bo'lishidan oldingi balanslar 'opening' yozuvlari sifatida (allaqachon qo'llanilgan) kiritiladi"""
+        cur.execute(
+            "INSERT INTO points_ledger (user_id, delta, ref_delta, reason, contest_id) "
+            "SELECT user_id, points, referrals, 'opening', "
+            "(SELECT id FROM contests WHERE is_active = 1 ORDER BY id DESC LIMIT 1) "
+            "FROM users WHERE points != 0 OR referrals != 0"
+        )
+        cur.execute(
+            "INSERT OR REPLACE INTO job_state (name, value) "
+            "SELECT 'ledger_applied_id', COALESCE(MAX(id), 0) FROM points_ledger"
+        )
+
+    @staticmethod
+    def _backfill_stats(cur):
+        """Rollup jadvallari paydo bo'lishidan oldingi ma'lumotlarni bir marta hisoblab chiqadi"""
+        cur.execute("SELECT 1 FROM job_state WHERE name = 'stats_backfilled'")
+        if cur.fetchone():
+            return
+        shift = f"{STATS_UTC_OFFSET:+d} hours"
+        for table, fmt in (("stats_hourly", "%Y-%m-%d %H"), ("stats_daily", "%Y-%m-%d")):
+            cur.execute(
+                f"INSERT INTO {table} (bucket, metric, channel_id, count, points) "
+                f"SELECT strftime(?, joined_ts, ?), 'join', '', COUNT(*), 0 FROM users "
+                f"WHERE joined_ts IS NOT NULL GROUP BY 1",
+                (fmt, shift),
+            )
+            cur.execute(
+                f"INSERT INTO {table} (bucket, metric, channel_id, count, points) "
+                f"SELECT strftime(?, given_ts, ?), 'award', channel_id, COUNT(*), SUM(points) FROM points_given "
+                f"WHERE given_ts IS NOT NULL GROUP BY 1, 3",
+                (fmt, shift),
+            )
+        cur.execute("INSERT INTO stats_total (metric, channel_id, count, points) "
+                    "SELECT 'join', '', COUNT(*), 0 FROM users")
+        cur.execute("INSERT INTO stats_total (metric, channel_id, count, points) "
+                    "SELECT 'award', channel_id, COUNT(*), SUM(points) FROM points_given GROUP BY channel_id")
+        cur.execute("INSERT INTO stats_total (metric, channel_id, count, points) "
+                    "SELECT 'referral', '', COUNT(*), COALESCE(SUM(points), 0) FROM referrals_awarded")
+        cur.execute("INSERT INTO job_state (name, value) VALUES ('stats_backfilled', '1')")
+
+    @staticmethod
+    def _ensure_column(cur, table: str, column: str, decl: str) -> bool:
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in [r[1] for r in cur.fetchall()]:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            return True
+        return False
+
     def get_connection(self):
-        return sqlite3.connect(self.path, check_same_thread=False)
+        if db_read_only.get():
+            return self.get_read_connection()
+        return sqlite3.connect(self.path, check_same_thread=False, uri=True)
+
+    def get_read_connection(self):
+        """WAL rejimida yozuvchini kutmaydigan faqat-o'qish ulanishi (hovuzdan)"""
+        try:
+            return self._read_pool.get_nowait()
+        except queue.Empty:
+            pass
+        conn = sqlite3.connect(
+            f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro",
+            check_same_thread=False, uri=True, factory=ReadOnlyConnection,
+        )
+        conn.pool = self._read_pool
+        return conn
+
+    def for_user(self, user_id: int) -> "Database":
+        """Foydalanuvchi ma'lumotlari joylashgan baza (shard bo'lmasa — o'zi)"""
+        if not self.shards:
+            return self
+        return self.shards[user_id % len(self.shards)]
+
+    def user_shards(self) -> list:
+        """users / points_given / referrals_awarded saqlanadigan barcha bazalar"""
+        return self.shards or [self]
+
+    def _migrate_to_shards(self):
+        """Shard rejimi birinchi marta yoqilganda asosiy bazadagi ma'lumotlarni shardlarga ko'chiradi"""
+        conn = self.get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM users) OR EXISTS (SELECT 1 FROM points_given)")
+        if not cur.fetchone()[0]:
+            conn.close()
+            return
+        conn.close()
 
+        k = len(self.shards)
+        for index, shard in enumerate(self.shards):
+            shard_conn = shard.get_connection()
+            shard_conn.execute("ATTACH DATABASE ? AS src", (self.path,))
+            with shard_conn:
+                shard_conn.execute("INSERT OR IGNORE INTO users SELECT * FROM src.users WHERE user_id % ? = ?", (k, index))
+                shard_conn.execute(
+                    "INSERT OR IGNORE INTO points_given SELECT * FROM src.points_given WHERE user_id % ? = ?", (k, index))
+                shard_conn.execute(
+                    "INSERT OR IGNORE INTO referrals_awarded SELECT * FROM src.referrals_awarded "
+                    "WHERE referrer_id % ? = ?", (k, index))
+                # Daftar id lari saqlanadi, shuning uchun qo'llanilgan chegara ham o'zgarmaydi
+                shard_conn.execute(
+                    "INSERT OR IGNORE INTO points_ledger SELECT * FROM src.points_ledger WHERE user_id % ? = ?", (k, index))
+                shard_conn.execute(
+                    "INSERT OR REPLACE INTO job_state (name, value) "
+                    "SELECT name, value FROM src.job_state WHERE name IN ('ledger_applied_id', 'ledger_reset_id')")
+                if index == 0:
+                    # Rollup lar shardlar bo'yicha yig'iladi — eski hisoblarni bitta shardga qo'yish yetarli
+                    for table in STATS_TABLES:
+                        shard_conn.execute(
+                            f"INSERT INTO {table} SELECT * FROM src.{table} WHERE true "
+                            f"ON CONFLICT DO UPDATE SET count = count + excluded.count, points = points + excluded.points")
+            shard_conn.execute("DETACH DATABASE src")
+            shard_conn.close()
+
+        conn = self.get_connection()
+        with conn:
+            for table in SHARDED_TABLES + STATS_TABLES:
+                conn.execute(f"DELETE FROM {table}")
+        conn.close()
+        logger.info(f"🔀 {self.path}: foydalanuvchi ma'lumotlari {k} ta shardga ko'chirildi")
 
-db = Database()
 
 # === KONSTANTALAR ===
 JOIN_REQUEST_POINTS = 10
@@ -169,15 +521,297 @@ REFERRAL_POINTS = 10
 POINTS_PER_JOIN = 10
 
 
+# === YORDAMCHI VOSITALAR ===
+class RateLimiter:
+    """Token bucket: soniyasiga `rate` ta so'rov, `burst` tagacha jamlanadi"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# === TELEGRAM API KLIENTI ===
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+# Metod bo'yicha timeout (s); JSON bilan almashtirish mumkin: {"getChatMember": 3}
+HTTP_METHOD_TIMEOUTS = {
+    "getChatMember": 5,
+    "answerCallbackQuery": 5,
+    "sendMessage": 10,
+    "editMessageText": 10,
+    "sendDocument": 60,
+    "getFile": 30,
+    **json.loads(os.getenv("HTTP_METHOD_TIMEOUTS", "{}")),
+}
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_RETRY_BASE = float(os.getenv("HTTP_RETRY_BASE", "0.5"))  # birinchi qayta urinish oldidan kutish (s)
+HTTP_RETRY_MAX = float(os.getenv("HTTP_RETRY_MAX", "8"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "10"))  # ketma-ket xatolar soni
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))  # ochiq holatda turish vaqti (s)
+# Timeoutdan keyin qayta yuborilsa foydalanuvchi xabarni ikki marta olishi mumkin
+NON_IDEMPOTENT_PREFIXES = ("send", "forward", "copy")
+
+
+class CircuitBreaker:
+    """Telegram API ketma-ket ishlamasa so'rovlarni darhol rad etadi, BREAKER_RESET dan keyin bitta sinov so'rovi"""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("🟢 Telegram API tiklandi — circuit breaker yopildi")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"🔴 Telegram API {self.failures} marta ketma-ket xato berdi — circuit breaker ochildi")
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Sinov so'rovi natijasiz tugadi (masalan, bekor qilindi) — keyingi so'rov sinab ko'radi"""
+        self._probe_in_flight = False
+
+
+class ResilientSession(AiohttpSession):
+    """Hovuz/keep-alive sozlangan, metod bo'yicha timeout, jitter bilan qayta urinish va circuit breaker"""
+
+    def __init__(self, limit: int = HTTP_POOL_SIZE, keepalive: float = HTTP_KEEPALIVE, **kwargs):
+        super().__init__(limit=limit, timeout=HTTP_TIMEOUT, **kwargs)
+        self._connector_init["keepalive_timeout"] = keepalive
+        self.breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "rejected": 0}
+
+    @staticmethod
+    def _retryable(method_name: str, error: Exception) -> bool:
+        if isinstance(error, TelegramServerError):
+            return True
+        # Javob kelmay qolgan yuboruvchi so'rovlar qayta yuborilmaydi (dublikat bo'lmasligi uchun)
+        if "timeout" in str(error).lower() and method_name.startswith(NON_IDEMPOTENT_PREFIXES):
+            return False
+        return True
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        method_name = method.__api_method__
+        if timeout is None:
+            timeout = HTTP_METHOD_TIMEOUTS.get(method_name, self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.stats["rejected"] += 1
+                raise TelegramNetworkError(method=method, message="Circuit breaker open: Telegram API ishlamayapti")
+            self.stats["requests"] += 1
+            try:
+                result = await super().make_request(bot, method, timeout)
+            except (TelegramServerError, TelegramNetworkError) as e:
+                self.breaker.record_failure()
+                self.stats["failures"] += 1
+                attempt += 1
+                if attempt > HTTP_RETRIES or not self._retryable(method_name, e):
+                    raise
+                self.stats["retries"] += 1
+                # Full jitter: bir vaqtda xato olgan so'rovlar bir vaqtda qaytib kelmasligi uchun
+                await asyncio.sleep(random.uniform(0, min(HTTP_RETRY_MAX, HTTP_RETRY_BASE * 2 ** (attempt - 1))))
+                continue
+            except TelegramAPIError:
+                # 4xx javob — API ishlayapti, xato so'rovning o'zida
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+
+
+# === ISH VAQTI PROFILI (uvloop / orjson) ===
+# performance — uvloop va orjson (o'rnatilgan bo'lsa); default — standart asyncio va json
+RUNTIME_PROFILE = os.getenv("RUNTIME_PROFILE", "default").lower()
+
+
+def load_runtime_profile() -> dict:
+    """Profilni qo'llaydi (asyncio.run dan oldin chaqiriladi); yo'q paketlar uchun standartiga qaytadi"""
+    profile = {"name": RUNTIME_PROFILE, "loop": "asyncio", "json": "json", "session_kwargs": {}}
+    if RUNTIME_PROFILE != "performance":
+        return profile
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        profile["loop"] = f"uvloop {uvloop.__version__}"
+    except ImportError:
+        profile["loop"] = "asyncio (uvloop o'rnatilmagan)"
+    try:
+        import orjson
+
+        def orjson_dumps(obj) -> str:
+            return orjson.dumps(obj).decode()
+
+        profile["session_kwargs"] = {"json_loads": orjson.loads, "json_dumps": orjson_dumps}
+        profile["json"] = f"orjson {orjson.__version__}"
+    except ImportError:
+        profile["json"] = "json (orjson o'rnatilmagan)"
+    return profile
+
+
+runtime_profile = {"name": "default", "loop": "asyncio", "json": "json", "session_kwargs": {}}
+
+
+# === TENANTLAR (BIR JARAYONDA BIR NECHTA BOT) ===
+class Tenant:
+    """Bitta bot nusxasi: token, admin, o'z bazasi va arxiv papkasi"""
+
+    def __init__(self, token: str, admin_id: int, db_path: str = "bot_full.db", name: str = None,
+                 archive_dir: str = None, sweep_rate: float = None, shards: int = None, backup_dir: str = None):
+        self.token = token
+        self.admin_id = int(admin_id)
+        self.name = name or os.path.splitext(os.path.basename(db_path))[0]
+        self.db = Database(db_path, DB_SHARDS if shards is None else shards)
+        self.archive_dir = archive_dir or os.path.join(ARCHIVE_DIR, self.name)
+        self.backup_dir = backup_dir or os.path.join(BACKUP_DIR, self.name)
+        self.sweep_rate = sweep_rate  # None = umumiy SWEEP_RATE
+        self.scheduler_wakeup = asyncio.Event()  # yangi vazifa qo'shilganda rejalashtiruvchini uyg'otadi
+
+
+# BOTS_CONFIG rejimida standart tenant yo'q: kontekstsiz kod jimgina bot_full.db ga yozmasligi,
+# balki LookupError bilan to'xtashi kerak
+if BOTS_CONFIG:
+    default_tenant = None
+    current_tenant = ContextVar("current_tenant")
+else:
+    default_tenant = Tenant(BOT_TOKEN, ADMIN_ID, archive_dir=ARCHIVE_DIR, backup_dir=BACKUP_DIR)
+    current_tenant = ContextVar("current_tenant", default=default_tenant)
+tenants_by_bot_id = {}
+
+
+class TenantDatabase:
+    """Joriy tenant bazasiga yo'naltiruvchi proksi — handlerlar `db` dan odatdagidek foydalanadi"""
+
+    def __getattr__(self, name):
+        return getattr(current_tenant.get().db, name)
+
+
+db = TenantDatabase()
+
+
+def get_admin_id() -> int:
+    return current_tenant.get().admin_id
+
+
+def tenant_for_bot(bot_id: int) -> Tenant:
+    """Bot ID si bo'yicha tenant; noma'lum bot (va standart tenant yo'q bo'lsa) — xato"""
+    tenant = tenants_by_bot_id.get(bot_id, default_tenant)
+    if tenant is None:
+        raise LookupError(f"Bot {bot_id} uchun tenant topilmadi (BOTS_CONFIG)")
+    return tenant
+
+
+def load_tenants() -> list:
+    """BOTS_CONFIG bo'lsa undan, aks holda .env dagi bitta botdan tenantlar ro'yxatini tuzadi"""
+    if not BOTS_CONFIG:
+        return [default_tenant]
+    with open(BOTS_CONFIG, encoding="utf-8") as f:
+        entries = json.load(f)
+    specs = []
+    for e in entries:
+        # db_path berilmasa — nomidan yoki bot ID sidan; botlar bitta bazani bo'lishib qolmasligi kerak
+        db_path = e.get("db_path") or f"{e.get('name') or 'bot_' + e['token'].split(':')[0]}.db"
+        name = e.get("name") or os.path.splitext(os.path.basename(db_path))[0]
+        specs.append({
+            "db_path": db_path, "name": name,
+            "archive_dir": e.get("archive_dir") or os.path.join(ARCHIVE_DIR, name),
+            "backup_dir": e.get("backup_dir") or os.path.join(BACKUP_DIR, name),
+        })
+    # Bazalar ochilishidan oldin tekshiriladi — takroriy yo'l bilan hech narsa yaratilmaydi
+    for field in ("db_path", "archive_dir", "backup_dir"):
+        seen = {}
+        for spec in specs:
+            path = os.path.abspath(spec[field])
+            if path in seen:
+                raise ValueError(f"BOTS_CONFIG: {seen[path]} va {spec['name']} bir xil {field} ishlatmoqda: {path}")
+            seen[path] = spec["name"]
+    return [
+        Tenant(e["token"], e["admin_id"], spec["db_path"], spec["name"], spec["archive_dir"],
+               e.get("sweep_rate"), e.get("shards"), spec["backup_dir"])
+        for e, spec in zip(entries, specs)
+    ]
+
+
+def create_tenant_task(tenant: Tenant, coro) -> asyncio.Task:
+    """Fon vazifasini berilgan tenant konteksti bilan ishga tushiradi"""
+    token = current_tenant.set(tenant)
+    try:
+        return asyncio.create_task(coro)
+    finally:
+        current_tenant.reset(token)
+
+
+class TenantMiddleware(BaseMiddleware):
+    """Har bir update uchun joriy tenantni bot ID si bo'yicha o'rnatadi"""
+
+    async def __call__(self, handler, event, data):
+        token = current_tenant.set(tenant_for_bot(data["bot"].id))
+        try:
+            return await handler(event, data)
+        finally:
+            current_tenant.reset(token)
+
+
 # === STATES ===
 # === STATES NI YANGILAYMIZ ===
 class AdminStates(StatesGroup):
+    broadcast_filter = State()
     broadcast = State()
     confirm_reset = State()
     add_channel = State()
     delete_channel = State()
     add_gift = State()
     delete_gift = State()
+    bulk_import = State()
 
 
 # === KEYBOARDS ===
@@ -198,9 +832,10 @@ def admin_menu():
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="📢 Kanallar"), KeyboardButton(text="🎁 Sovg'alar")],
-            [KeyboardButton(text="📩 Xabar yuborish")],
+            [KeyboardButton(text="📩 Xabar yuborish"), KeyboardButton(text="🧾 Buyurtmalar")],
             [KeyboardButton(text="🏁 Konkursni yakunlash"), KeyboardButton(text="🔁 Yangi konkurs")],
-            [KeyboardButton(text="📊 Top 10"), KeyboardButton(text="🧹 Tozalash")],
+            [KeyboardButton(text="📊 Top 10"), KeyboardButton(text="📈 Statistika")],
+            [KeyboardButton(text="🧹 Tozalash")],
         ],
         resize_keyboard=True,
     )
@@ -227,7 +862,44 @@ def build_channels_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+# O'qishlar parallel oqimlarda, og'ir yozishlar bitta ketma-ket yozuvchi oqimida
+read_executor = ThreadPoolExecutor(READ_POOL_SIZE, thread_name_prefix="db-read")
+write_executor = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+
+
+async def run_read(fn, *args, **kwargs):
+    """fn ni o'qish oqimida faqat-o'qish ulanishlari bilan bajaradi (tenant konteksti saqlanadi)"""
+    ctx = copy_context()
+    ctx.run(db_read_only.set, True)
+    return await asyncio.get_running_loop().run_in_executor(read_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+async def run_write(fn, *args, **kwargs):
+    """fn ni yagona yozuvchi oqimida bajaradi — og'ir yozishlar event loop ni va bir-birini to'smaydi"""
+    ctx = copy_context()
+    return await asyncio.get_running_loop().run_in_executor(write_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+def query_main(sql: str, params: tuple = ()) -> list:
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
 # === DATABASE FUNCTIONS ===
+def find_active_contest_id():
+    """Faol konkurs id si yoki None (yangisini ochmaydi)"""
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM contests WHERE is_active = 1 ORDER BY id DESC LIMIT 1")
+    r = cur.fetchone()
+    conn.close()
+    return r[0] if r else None
+
+
 def get_active_contest_id() -> int:
     conn = db.get_connection()
     cur = conn.cursor()
@@ -245,7 +917,7 @@ def get_active_contest_id() -> int:
 
 def add_or_update_user(user_id: int, username: str, full_name: str, referrer_id: int = None):
     try:
-        conn = db.get_connection()
+        conn = db.for_user(user_id).get_connection()
         cur = conn.cursor()
         cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
         existed = cur.fetchone()
@@ -261,6 +933,7 @@ def add_or_update_user(user_id: int, username: str, full_name: str, referrer_id:
             "INSERT INTO users (user_id, username, full_name, referrer_id) VALUES (?, ?, ?, ?)",
             (user_id, username, full_name, referrer_id),
         )
+        record_stats(cur, "join")
         conn.commit()
         conn.close()
         if referrer_id:
@@ -269,40 +942,88 @@ def add_or_update_user(user_id: int, username: str, full_name: str, referrer_id:
         logger.error(traceback.format_exc())
 
 
-def give_points_once_for_channel(user_id: int, channel_id: str, points: int) -> bool:
-    try:
-        conn = db.get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM points_given WHERE user_id = ? AND channel_id = ?", (user_id, channel_id))
-        if cur.fetchone():
-            conn.close()
-            return False
+def award_channels(user_id: int, channel_ids: list, points: int, source: str = "check") -> list:
+    """Foydalanuvchi hali ball olmagan kanallar uchun bitta tranzaksiyada ball beradi.
 
+    Kanallar soniga bog'liq bo'lmagan sondagi so'rovlar: mavjudlik tekshiruvi va yozuv bitta
+    INSERT ... RETURNING da, balans esa bitta daftar yozuvi. Faol konkurs ham shu tranzaksiyada
+    aniqlanadi (yo'q bo'lsa ochiladi). Yagona istisno — shard rejimi: contests asosiy bazada,
+    ball esa foydalanuvchi shardida; asosiy bazaning yozish qulfini har bir ball uchun olmaslik
+    uchun konkurs tranzaksiyadan oldin aniqlanadi va tranzaksiya faqat shardga yozadi.
+    Qaytaradi: yangi ball berilgan kanallar.
+    """
+    if not channel_ids:
+        return []
+    if db.shards:
         contest_id = get_active_contest_id()
-        cur.execute(
-            "INSERT INTO points_given (user_id, channel_id, contest_id, points) VALUES (?, ?, ?, ?)",
-            (user_id, channel_id, contest_id, points),
-        )
-        cur.execute("UPDATE users SET points = points + ? WHERE user_id = ?", (points, user_id))
-        conn.commit()
+        contest_sql = ":contest_id"
+        conn = db.for_user(user_id).get_connection()
+    else:
+        contest_id = None
+        contest_sql = "(SELECT id FROM contests WHERE is_active = 1 ORDER BY id DESC LIMIT 1)"
+        conn = db.get_connection()
+    try:
+        with conn:
+            if not db.shards:
+                conn.execute(
+                    "INSERT INTO contests (is_active) SELECT 1 "
+                    "WHERE NOT EXISTS (SELECT 1 FROM contests WHERE is_active = 1)"
+                )
+            rows = conn.execute(
+                f"""
+                INSERT INTO points_given (user_id, channel_id, contest_id, points, source)
+                SELECT :user_id, c.value, {contest_sql}, :points, :source
+                FROM json_each(:channels) c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM points_given p WHERE p.user_id = :user_id AND p.channel_id = c.value
+                )
+                ON CONFLICT DO NOTHING
+                RETURNING channel_id, contest_id
+                """,
+                {"user_id": user_id, "contest_id": contest_id, "points": points, "source": source,
+                 "channels": json.dumps([str(c) for c in channel_ids])},
+            ).fetchall()
+            if rows:
+                awarded = [channel_id for channel_id, _ in rows]
+                append_ledger(conn, user_id, points * len(rows), "channel", rows[0][1], ",".join(awarded))
+                record_award_stats(conn, awarded, points)
+    finally:
         conn.close()
+    for channel_id, _ in rows:
         logger.info(f"✅ {user_id} foydalanuvchiga {channel_id} kanali uchun {points} ball berildi")
-        return True
+    return [channel_id for channel_id, _ in rows]
+
+
+def give_points_once_for_channel(user_id: int, channel_id: str, points: int) -> bool:
+    try:
+        return bool(award_channels(user_id, [channel_id], points))
     except Exception as e:
         logger.error(f"Ball berishda xatolik: {e}")
         return False
 
 
-def give_referral_points_if_needed(referred_id: int):
+def give_referral_points_if_needed(referred_id: int) -> bool:
+    """Taklif qilgan foydalanuvchiga bir marta ball beradi. Ball berilgan bo'lsa True"""
     try:
-        conn = db.get_connection()
+        conn = db.for_user(referred_id).get_connection()
         cur = conn.cursor()
         cur.execute("SELECT referrer_id FROM users WHERE user_id = ?", (referred_id,))
         r = cur.fetchone()
+        conn.close()
         if not r or not r[0]:
-            conn.close()
-            return
+            return False
         referrer_id = r[0]
+        contest_id = get_active_contest_id()
+
+        # referrals_awarded referrer bilan bir shardda — yozuv va ball bitta tranzaksiyada
+        conn = db.for_user(referrer_id).get_connection()
+        cur = conn.cursor()
+
+        # Mavjud bo'lmagan foydalanuvchi uchun daftar yozuvi ham, statistika ham yozilmaydi
+        cur.execute("SELECT 1 FROM users WHERE user_id = ?", (referrer_id,))
+        if not cur.fetchone():
+            conn.close()
+            return False
 
         cur.execute(
             "SELECT 1 FROM referrals_awarded WHERE referrer_id = ? AND referred_id = ?",
@@ -310,188 +1031,1883 @@ def give_referral_points_if_needed(referred_id: int):
         )
         if cur.fetchone():
             conn.close()
-            return
+            return False
 
         cur.execute(
             "INSERT INTO referrals_awarded (referrer_id, referred_id, points) VALUES (?, ?, ?)",
             (referrer_id, referred_id, REFERRAL_POINTS),
         )
-        cur.execute(
-            "UPDATE users SET points = points + ?, referrals = referrals + 1 WHERE user_id = ?",
-            (REFERRAL_POINTS, referrer_id),
-        )
+        append_ledger(cur, referrer_id, REFERRAL_POINTS, "referral", contest_id, str(referred_id), ref_delta=1)
+        record_stats(cur, "referral", points=REFERRAL_POINTS)
         conn.commit()
         conn.close()
         logger.info(f"🎁 Referral ball berildi: {referrer_id} -> {referred_id}")
+        return True
     except Exception:
         logger.error(traceback.format_exc())
+        return False
 
 
-# === MAJBURIY OBUNA TEKSHIRISH ===
-async def check_subscription(user_id: int, bot: Bot) -> bool:
-    """Foydalanuvchi barcha kanallarga obuna bo'lganini tekshiradi"""
-    conn = db.get_connection()
+def count_users(where: str = "", params: tuple = ()) -> int:
+    """users jadvali bo'yicha COUNT(*) — barcha shardlar yig'indisi"""
+    total = 0
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM users {where}", params)
+        total += cur.fetchone()[0]
+        conn.close()
+    return total
+
+
+def top_users(limit: int, with_ids: bool = False) -> list:
+    """Eng ko'p ball to'plaganlar (full_name, points[, user_id]) — shardlar natijasi birlashtiriladi"""
+    results = []
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT full_name, points, user_id FROM users ORDER BY points DESC, user_id DESC LIMIT ?", (limit,))
+        results.append(cur.fetchall())
+        conn.close()
+    merged = heapq.merge(*results, key=lambda r: (r[1], r[2]), reverse=True)
+    if with_ids:
+        return list(itertools.islice(merged, limit))
+    return [(name, points) for name, points, _ in itertools.islice(merged, limit)]
+
+
+def fetch_user_id_batch(shard: Database, where: str, params: tuple, after: int, limit: int) -> list:
+    """Sharddan after dan keyingi limit ta user_id (keyset) — so'rov qisqa, ulanish darhol yopiladi"""
+    conn = shard.get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT chat_id, invite_link FROM channels")
-    channels = cur.fetchall()
+    cur.execute(
+        f"SELECT user_id FROM users {where} {'AND' if where else 'WHERE'} user_id > ? ORDER BY user_id LIMIT ?",
+        (*params, after, limit),
+    )
+    user_ids = [r[0] for r in cur.fetchall()]
     conn.close()
+    return user_ids
 
-    if not channels:
-        return True  # kanal yo'q bo'lsa, obuna talab qilinmaydi
 
-    all_subscribed = True
-    new_points_given = 0
+def get_user_names(user_ids) -> dict:
+    """{user_id: (full_name, username)} — har bir shardga bitta so'rov"""
+    by_shard = {}
+    for uid in set(user_ids):
+        by_shard.setdefault(db.for_user(uid).path, (db.for_user(uid), []))[1].append(uid)
+    names = {}
+    for shard, uids in by_shard.values():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT user_id, full_name, username FROM users WHERE user_id IN ({', '.join('?' for _ in uids)})",
+            uids,
+        )
+        names.update({uid: (full_name, username) for uid, full_name, username in cur.fetchall()})
+        conn.close()
+    return names
 
-    for chat_id, invite_link in channels:
-        try:
-            member = await bot.get_chat_member(chat_id, user_id)
-            if member.status in ["member", "administrator", "creator"]:
-                # Obuna bo'lgan bo'lsa, ball berilganligini tekshiramiz
-                conn = db.get_connection()
-                cur = conn.cursor()
-                cur.execute("SELECT 1 FROM points_given WHERE user_id=? AND channel_id=?", (user_id, str(chat_id)))
-                if not cur.fetchone():
-                    # Agar hali ball berilmagan bo'lsa, ball beramiz
-                    if give_points_once_for_channel(user_id, str(chat_id), JOIN_REQUEST_POINTS):
-                        new_points_given += JOIN_REQUEST_POINTS
-                        logger.info(
-                            f"✅ {user_id} foydalanuvchi {chat_id} kanaliga obuna bo'ldi - {JOIN_REQUEST_POINTS} ball berildi")
-                conn.close()
-            else:
-                all_subscribed = False  # Obuna bo'lmagan
-        except Exception as e:
-            logger.error(f"Obuna tekshirishda xatolik {chat_id}: {e}")
-            # Agar tekshirish imkoni bo'lmasa, bazadagi ball berilganligiga qaraymiz
-            conn = db.get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT 1 FROM points_given WHERE user_id=? AND channel_id=?", (user_id, str(chat_id)))
-            if not cur.fetchone():
-                all_subscribed = False
-            conn.close()
 
-    # Agar yangi ball berilgan bo'lsa, foydalanuvchiga xabar beramiz
-    if new_points_given > 0:
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"🎉 Tabriklaymiz! Siz {new_points_given} ball qo'lga kiritdingiz!"
-            )
-        except Exception as e:
-            logger.error(f"Ball haqida xabar berishda xatolik: {e}")
+FIND_LIMIT = 15
 
-    return all_subscribed
 
+def fts_prefix_query(text: str) -> str:
+    """Foydalanuvchi matnini FTS5 so'roviga aylantiradi: har bir so'z prefiks sifatida, hammasi AND"""
+    return " ".join(f'"{token}"*' for token in re.findall(r"\w+", text.lower()))
 
-# === ROUTERS ===
-router = Router()
-admin_router = Router()
 
-# Apply admin filter to admin router
-admin_router.message.filter(F.from_user.id == ADMIN_ID)
-admin_router.callback_query.filter(F.from_user.id == ADMIN_ID)
+def search_users(text: str, limit: int = FIND_LIMIT) -> list:
+    """[(user_id, full_name, username, points, referrals, referrer_id)] — mosligi bo'yicha tartiblangan"""
+    match = fts_prefix_query(text)
+    exact_id = int(text) if text.strip().lstrip("-").isdigit() else None
+    found = []
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        rows = []
+        if exact_id is not None:
+            cur.execute("SELECT -1e9, user_id FROM users WHERE user_id = ?", (exact_id,))
+            rows += cur.fetchall()
+        if match:
+            # rank = bm25; LIKE dan farqli ravishda indeksdan o'qiydi (prefix='2 3' qisqa prefikslarni tezlashtiradi)
+            cur.execute("SELECT rank, rowid FROM users_fts WHERE users_fts MATCH ? ORDER BY rank LIMIT ?", (match, limit))
+            rows += cur.fetchall()
+        seen = set()
+        for rank, uid in rows:
+            if uid in seen:
+                continue
+            seen.add(uid)
+            cur.execute("SELECT full_name, username, referrer_id FROM users WHERE user_id = ?", (uid,))
+            full_name, username, referrer_id = cur.fetchone()
+            points, referrals = ledger_balance(cur, uid)
+            found.append((rank, uid, full_name, username, points, referrals, referrer_id))
+        conn.close()
+    found.sort(key=lambda r: r[0])
+    return [r[1:] for r in found[:limit]]
 
 
-# === START HANDLER ===
-@router.message(CommandStart())
-async def start_handler(message: Message, bot: Bot):
-    user = message.from_user
+def attach_user_shard(conn, user_id: int) -> str:
+    """Foydalanuvchi shardini asosiy ulanishga 'us' nomi bilan ulaydi va jadval prefiksini qaytaradi"""
+    if not db.shards:
+        return "main."
+    conn.execute("ATTACH DATABASE ? AS us", (db.for_user(user_id).path,))
+    return "us."
 
-    # Referral parametrni tekshiramiz
-    referrer_id = None
-    if message.text and len(message.text.split()) > 1:
-        try:
-            referrer_id = int(message.text.split()[1])
-        except ValueError:
-            pass
 
-    conn = db.get_connection()
-    cur = conn.cursor()
+# === BALLAR DAFTARI (LEDGER) ===
+# Ball o'zgarishlari faqat qo'shiladi; users.points / referrals — kompaktor yangilaydigan snapshot
+LEDGER_COMPACT_INTERVAL = float(os.getenv("LEDGER_COMPACT_INTERVAL", "2"))
+LEDGER_CURSOR = "COALESCE((SELECT CAST(value AS INTEGER) FROM {p}job_state WHERE name = '{name}'), 0)"
 
-    # Foydalanuvchi bazada bormi?
-    cur.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
-    existing_user = cur.fetchone()
 
-    # AGAR: Yangi foydalanuvchi VA referral mavjud VA o'zini taklif qilmagan bo'lsa
-    if not existing_user and referrer_id and referrer_id != user.id:
-        print(f"🎯 YANGI REFERAL: {user.id} -> {referrer_id}")
+def append_ledger(cur, user_id: int, delta: int, reason: str, contest_id: int = None, ref: str = None,
+                  ref_delta: int = 0, prefix: str = ""):
+    """Daftarga yozuv qo'shadi (chaqiruvchining tranzaksiyasida, foydalanuvchi shardida)"""
+    cur.execute(
+        f"INSERT INTO {prefix}points_ledger (user_id, delta, ref_delta, reason, contest_id, ref) "
+        f"VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, delta, ref_delta, reason, contest_id, ref),
+    )
 
-        # 1. Referral egasiga ball qo'shish
-        cur.execute("UPDATE users SET points = points + ?, referrals = referrals + 1 WHERE user_id = ?",
-                    (REFERRAL_POINTS, referrer_id))
 
-        # 2. Yangi foydalanuvchini qo'shish
-        cur.execute("INSERT INTO users (user_id, username, full_name, points, referrals) VALUES (?, ?, ?, ?, ?)",
-                    (user.id, user.username, user.full_name, 0, 0))
+def ledger_balance(cur, user_id: int, prefix: str = "") -> tuple:
+    """(ball, referallar) = snapshot + hali qo'llanilmagan yozuvlar"""
+    cur.execute(
+        f"SELECT u.points + COALESCE(SUM(l.delta), 0), u.referrals + COALESCE(SUM(l.ref_delta), 0) "
+        f"FROM {prefix}users u LEFT JOIN {prefix}points_ledger l "
+        f"ON l.user_id = u.user_id AND l.id > {LEDGER_CURSOR.format(p=prefix, name='ledger_applied_id')} "
+        f"WHERE u.user_id = ? GROUP BY u.user_id",
+        (user_id,),
+    )
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
 
-        conn.commit()
-        print(f"✅ Referral {referrer_id} ga {REFERRAL_POINTS} ball qo'shildi")
 
-        # Referral egasiga xabar yuborish
-        try:
-            await bot.send_message(
-                referrer_id,
-                f"🎊 Tabriklaymiz! Sizning taklif havolangiz orqali yangi foydalanuvchi qo'shildi.\n"
-                f"📊 Sizga {REFERRAL_POINTS} ball qo'shildi!"
-            )
-        except Exception as e:
-            print(f"⚠️ Referral egasiga xabar yuborishda xatolik: {e}")
+def get_user_balance(user_id: int) -> tuple:
+    conn = db.for_user(user_id).get_connection()
+    try:
+        return ledger_balance(conn.cursor(), user_id)
+    finally:
+        conn.close()
 
-    elif not existing_user:
-        # Oddiy yangi foydalanuvchi
-        cur.execute("INSERT INTO users (user_id, username, full_name, points, referrals) VALUES (?, ?, ?, ?, ?)",
-                    (user.id, user.username, user.full_name, 0, 0))
-        conn.commit()
-        print(f"✅ Yangi foydalanuvchi qo'shildi: {user.id}")
 
-    else:
-        # Mavjud foydalanuvchi - faqat ma'lumotlarni yangilash
-        cur.execute("UPDATE users SET username = ?, full_name = ? WHERE user_id = ?",
-                    (user.username, user.full_name, user.id))
-        conn.commit()
-        print(f"✅ Foydalanuvchi yangilandi: {user.id}")
+def reset_ledger_cursor(cur):
+    """Konkurs/ma'lumotlar tozalanganda: hozirgi daftar oxiri ham qo'llanilgan, ham qayta qurish boshlanishi"""
+    cur.execute(
+        "INSERT OR REPLACE INTO job_state (name, value, updated_ts) "
+        "SELECT name, COALESCE((SELECT MAX(id) FROM points_ledger), 0), CURRENT_TIMESTAMP "
+        "FROM (SELECT 'ledger_applied_id' AS name UNION ALL SELECT 'ledger_reset_id')"
+    )
 
-    conn.close()
 
-    # 🔒 Majburiy obuna tekshiruvi
-    is_subscribed = await check_subscription(user.id, bot)
-    if not is_subscribed:
-        keyboard = build_channels_keyboard()
-        await message.answer(
-            "❌ Iltimos, quyidagi kanallarga obuna bo'ling yoki qo'shilish so'rovini yuboring, so'ngra tekshirish tugmasini bosing:",
-            reply_markup=keyboard
+def compact_ledger(shard: Database) -> int:
+    """Qo'llanilmagan yozuvlarni users snapshotiga bitta tranzaksiyada qo'shadi. Qo'llangan yozuvlar sonini qaytaradi"""
+    conn = shard.get_connection()
+    conn.isolation_level = None
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(f"SELECT {LEDGER_CURSOR.format(p='', name='ledger_applied_id')}, MAX(id) FROM points_ledger")
+        applied, upto = cur.fetchone()
+        if not upto or upto <= applied:
+            cur.execute("ROLLBACK")
+            return 0
+        cur.execute(
+            "UPDATE users SET points = points + t.delta, referrals = referrals + t.ref_delta "
+            "FROM (SELECT user_id, SUM(delta) AS delta, SUM(ref_delta) AS ref_delta FROM points_ledger "
+            "      WHERE id > ? AND id <= ? GROUP BY user_id) AS t "
+            "WHERE users.user_id = t.user_id",
+            (applied, upto),
         )
-        return
-
-    # ✅ Obuna bo'lgan foydalanuvchi uchun ASOSIY XABAR
-    if user.id == ADMIN_ID:
-        await message.answer("👑 Xush kelibsiz, Admin!", reply_markup=admin_menu())
-    else:
-        conn = db.get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT points FROM users WHERE user_id = ?", (user.id,))
-        pts = cur.fetchone()
+        cur.execute(
+            "INSERT OR REPLACE INTO job_state (name, value, updated_ts) "
+            "VALUES ('ledger_applied_id', ?, CURRENT_TIMESTAMP)",
+            (upto,),
+        )
+        cur.execute("COMMIT")
+        return upto - applied
+    except Exception:
+        if conn.in_transaction:
+            cur.execute("ROLLBACK")
+        raise
+    finally:
         conn.close()
-        pts = pts[0] if pts else 0
 
-        await message.answer(
-            f"👋 Xush kelibsiz, {user.full_name}!\n\n"
-            f"📊 Sizning ballaringiz: {pts} ball\n\n"
-            f"Quyidagi menyu orqali botning barcha imkoniyatlaridan foydalaning:",
-            reply_markup=user_menu()
+
+def rebuild_balances(shard: Database) -> int:
+    """users.points / referrals ni oxirgi tozalashdan keyingi daftar yozuvlaridan qaytadan hisoblaydi"""
+    conn = shard.get_connection()
+    with conn:
+        reset_from = conn.execute(f"SELECT {LEDGER_CURSOR.format(p='', name='ledger_reset_id')}").fetchone()[0]
+        cur = conn.execute(
+            "UPDATE users SET "
+            "points = COALESCE((SELECT SUM(delta) FROM points_ledger l WHERE l.user_id = users.user_id AND l.id > ?), 0), "
+            "referrals = COALESCE((SELECT SUM(ref_delta) FROM points_ledger l "
+            "                      WHERE l.user_id = users.user_id AND l.id > ?), 0)",
+            (reset_from, reset_from),
+        )
+        updated = cur.rowcount
+        conn.execute(
+            "INSERT OR REPLACE INTO job_state (name, value, updated_ts) "
+            "SELECT 'ledger_applied_id', COALESCE(MAX(id), 0), CURRENT_TIMESTAMP FROM points_ledger"
         )
+    conn.close()
+    return updated
 
-# === BALL KO'RISH ===
-@router.message(Command("ball"))
-@router.message(F.text == "📊 Mening ballarim")
-async def my_points_cmd(message: Message, bot: Bot):
-    conn = db.get_connection()
+
+async def ledger_compactor():
+    """Har LEDGER_COMPACT_INTERVAL soniyada barcha shardlar daftarini snapshotga qo'llaydi"""
+    while True:
+        try:
+            for shard in db.user_shards():
+                await run_write(compact_ledger, shard)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(f"Daftarni kompaktlashda xatolik: {traceback.format_exc()}")
+        await asyncio.sleep(LEDGER_COMPACT_INTERVAL)
+
+
+# === STATISTIKA (ROLLUP) ===
+STATS_METRICS = {
+    "join": "👤 Yangi foydalanuvchilar",
+    "referral": "🎯 Referallar",
+    "request": "📩 Qo'shilish so'rovlari",
+    "award": "✅ Kanal uchun ball berildi",
+    "left": "🚪 Kanaldan chiqqanlar",
+}
+
+
+def stats_buckets(ts: float = None) -> tuple:
+    """(soat, kun) kalitlari — STATS_UTC_OFFSET bo'yicha mahalliy vaqtda"""
+    local = time.gmtime((time.time() if ts is None else ts) + STATS_UTC_OFFSET * 3600)
+    return time.strftime("%Y-%m-%d %H", local), time.strftime("%Y-%m-%d", local)
+
+
+def record_stats(cur, metric: str, channel_id: str = "", points: int = 0, count: int = 1):
+    """Soatlik, kunlik va umumiy hisoblagichlarni chaqiruvchining tranzaksiyasi ichida oshiradi"""
+    hour, day = stats_buckets()
+    for table, bucket in (("stats_hourly", hour), ("stats_daily", day)):
+        cur.execute(
+            f"INSERT INTO {table} (bucket, metric, channel_id, count, points) VALUES (?, ?, ?, ?, ?) "
+            f"ON CONFLICT(bucket, metric, channel_id) DO UPDATE SET "
+            f"count = count + excluded.count, points = points + excluded.points",
+            (bucket, metric, channel_id or "", count, points),
+        )
+    cur.execute(
+        "INSERT INTO stats_total (metric, channel_id, count, points) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(metric, channel_id) DO UPDATE SET count = count + excluded.count, points = points + excluded.points",
+        (metric, channel_id or "", count, points),
+    )
+
+
+def record_award_stats(cur, channel_ids: list, points: int, prefix: str = ""):
+    """Bir nechta kanal uchun 'award' hisoblagichlari — har bir jadvalga bitta so'rov"""
+    hour, day = stats_buckets()
+    channels = json.dumps(channel_ids)
+    for table, bucket in (("stats_hourly", hour), ("stats_daily", day)):
+        cur.execute(
+            f"INSERT INTO {prefix}{table} (bucket, metric, channel_id, count, points) "
+            f"SELECT ?, 'award', value, 1, ? FROM json_each(?) WHERE true "
+            f"ON CONFLICT(bucket, metric, channel_id) DO UPDATE SET "
+            f"count = count + excluded.count, points = points + excluded.points",
+            (bucket, points, channels),
+        )
+    cur.execute(
+        f"INSERT INTO {prefix}stats_total (metric, channel_id, count, points) "
+        f"SELECT 'award', value, 1, ? FROM json_each(?) WHERE true "
+        f"ON CONFLICT(metric, channel_id) DO UPDATE SET count = count + excluded.count, points = points + excluded.points",
+        (points, channels),
+    )
+
+
+def record_user_event(user_id: int, metric: str, channel_id: str = ""):
+    """Alohida yozuvsiz hodisa (masalan, qo'shilish so'rovi) uchun hisoblagich"""
+    try:
+        conn = db.for_user(user_id).get_connection()
+        with conn:
+            record_stats(conn, metric, channel_id)
+        conn.close()
+    except Exception as e:
+        logger.error(f"Statistikani yozishda xatolik: {e}")
+
+
+def read_stats(table: str, buckets: list = None) -> dict:
+    """{metric: (count, points)} — berilgan soat/kun kalitlari bo'yicha (stats_total da — hammasi), shardlar yig'indisi"""
+    where = "" if buckets is None else f"WHERE bucket IN ({', '.join('?' for _ in buckets)})"
+    totals = {}
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute(f"SELECT metric, SUM(count), SUM(points) FROM {table} {where} GROUP BY metric", buckets or ())
+        for metric, count, points in cur.fetchall():
+            c, p = totals.get(metric, (0, 0))
+            totals[metric] = (c + count, p + points)
+        conn.close()
+    return totals
+
+
+def channel_conversion_stats() -> dict:
+    """{channel_id: {metric: count}} — kanal bo'yicha umumiy so'rov / ball / chiqish sonlari"""
+    result = {}
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT channel_id, metric, count FROM stats_total WHERE channel_id != ''")
+        for channel_id, metric, count in cur.fetchall():
+            per_channel = result.setdefault(channel_id, {})
+            per_channel[metric] = per_channel.get(metric, 0) + count
+        conn.close()
+    return result
+
+
+def format_conversion(counts: dict) -> str:
+    requests = counts.get("request", 0)
+    awards = counts.get("award", 0)
+    left = counts.get("left", 0)
+    line = f"📩 {requests} so'rov → ✅ {awards} ball → 🚪 {left} chiqdi"
+    if requests:
+        line += f" ({awards * 100 // requests}% konversiya)"
+    return line
+
+
+def get_job_state(name: str, default=None):
+    conn = db.get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT points, referrals FROM users WHERE user_id = ?", (message.from_user.id,))
+    cur.execute("SELECT value FROM job_state WHERE name = ?", (name,))
     row = cur.fetchone()
     conn.close()
+    return row[0] if row else default
+
+
+def set_job_state(name: str, value):
+    conn = db.get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO job_state (name, value, updated_ts) VALUES (?, ?, CURRENT_TIMESTAMP) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_ts = excluded.updated_ts",
+            (name, str(value)),
+        )
+    conn.close()
+
+
+# === KONKURS ARXIVI ===
+def contest_archive_path(contest_id: int) -> str:
+    return os.path.join(current_tenant.get().archive_dir, f"contest_{contest_id}.db")
+
+
+def archive_contest(contest_id: int) -> str:
+    """Konkurs ballari va yakuniy reytingni alohida SQLite faylga ko'chiradi"""
+    # Reyting users snapshotidan olinadi — avval daftardagi qoldiqni qo'llaymiz
+    for shard in db.user_shards():
+        compact_ledger(shard)
+    path = contest_archive_path(contest_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = db.get_connection()
+    try:
+        conn.execute("ATTACH DATABASE ? AS arc", (path,))
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS arc.contest
+            (
+                id          INTEGER PRIMARY KEY,
+                start_ts    TIMESTAMP,
+                end_ts      TIMESTAMP,
+                archived_ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS arc.points_given
+            (
+                id         INTEGER PRIMARY KEY,
+                user_id    INTEGER,
+                channel_id TEXT,
+                points     INTEGER,
+                given_ts   TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS arc.standings
+            (
+                rank      INTEGER PRIMARY KEY,
+                user_id   INTEGER,
+                username  TEXT,
+                full_name TEXT,
+                points    INTEGER,
+                referrals INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS arc.standings_raw
+            (
+                user_id   INTEGER,
+                username  TEXT,
+                full_name TEXT,
+                points    INTEGER,
+                referrals INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS arc.idx_standings_user ON standings (user_id);
+            CREATE INDEX IF NOT EXISTS arc.idx_points_given_user ON points_given (user_id);
+        """)
+        # Qayta arxivlash xavfsiz: arxiv fayli har safar to'liq qayta yoziladi
+        with conn:
+            conn.execute("DELETE FROM arc.contest")
+            conn.execute("DELETE FROM arc.points_given")
+            conn.execute("DELETE FROM arc.standings")
+            conn.execute("DELETE FROM arc.standings_raw")
+            conn.execute(
+                "INSERT INTO arc.contest (id, start_ts, end_ts) "
+                "SELECT id, start_ts, COALESCE(end_ts, CURRENT_TIMESTAMP) FROM main.contests WHERE id = ?",
+                (contest_id,),
+            )
+        conn.execute("DETACH DATABASE arc")
+    finally:
+        conn.close()
+
+    # Ballar va reyting har bir shard (yoki asosiy baza) dan ko'chiriladi
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        try:
+            conn.execute("ATTACH DATABASE ? AS arc", (path,))
+            with conn:
+                conn.execute(
+                    "INSERT INTO arc.points_given (user_id, channel_id, points, given_ts) "
+                    "SELECT user_id, channel_id, points, given_ts FROM main.points_given WHERE contest_id = ? ORDER BY id",
+                    (contest_id,),
+                )
+                conn.execute(
+                    "INSERT INTO arc.standings_raw (user_id, username, full_name, points, referrals) "
+                    "SELECT user_id, username, full_name, points, referrals FROM main.users WHERE points > 0"
+                )
+            conn.execute("DETACH DATABASE arc")
+        finally:
+            conn.close()
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO standings (rank, user_id, username, full_name, points, referrals)
+            SELECT ROW_NUMBER() OVER (ORDER BY points DESC, user_id), user_id, username, full_name, points, referrals
+            FROM standings_raw
+            """
+        )
+        conn.execute("DELETE FROM standings_raw")
+    conn.close()
+    logger.info(f"🗄 Konkurs {contest_id} arxivlandi: {path}")
+    return path
+
+
+def finish_contest(contest_id: int) -> str:
+    """Konkursni arxivlaydi va yakunlangan deb belgilaydi"""
+    conn = db.get_connection()
+    with conn:
+        # Rejalashtirilgan end_ts hali kelmagan bo'lsa, haqiqiy yakunlanish vaqti yoziladi
+        conn.execute(
+            "UPDATE contests SET end_ts = MIN(COALESCE(end_ts, CURRENT_TIMESTAMP), CURRENT_TIMESTAMP) WHERE id = ?",
+            (contest_id,),
+        )
+    conn.close()
+    path = archive_contest(contest_id)
+    conn = db.get_connection()
+    with conn:
+        conn.execute("UPDATE contests SET is_active = 0 WHERE id = ?", (contest_id,))
+    conn.close()
+    return path
+
+
+def archive_unarchived_contests():
+    """points_given dagi hali arxivlanmagan konkurslarni arxivlaydi (tozalashdan oldin)"""
+    contest_ids = set()
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT contest_id FROM points_given WHERE contest_id IS NOT NULL")
+        contest_ids.update(r[0] for r in cur.fetchall())
+        conn.close()
+    for contest_id in sorted(contest_ids):
+        if not os.path.exists(contest_archive_path(contest_id)):
+            archive_contest(contest_id)
+
+
+@contextmanager
+def attached_archive(contest_id: int):
+    """Arxiv faylini faqat o'qish uchun 'arc' nomi bilan ulaydi"""
+    path = contest_archive_path(contest_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    conn = db.get_connection()
+    try:
+        conn.execute("ATTACH DATABASE ? AS arc", (f"file:{path}?mode=ro",))
+        yield conn
+    finally:
+        conn.close()
+
+
+def list_archived_contests() -> list:
+    archive_dir = current_tenant.get().archive_dir
+    if not os.path.isdir(archive_dir):
+        return []
+    ids = []
+    for name in os.listdir(archive_dir):
+        if name.startswith("contest_") and name.endswith(".db"):
+            try:
+                ids.append(int(name[len("contest_"):-len(".db")]))
+            except ValueError:
+                pass
+    return sorted(ids, reverse=True)
+
+
+# === ZAXIRA NUSXALAR (ONLINE BACKUP) ===
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))  # saqlanadigan oxirgi nusxalar soni
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "256"))  # bitta qadamda ko'chiriladigan sahifalar
+BACKUP_STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.005"))  # qadamlar orasidagi tanaffus (s)
+BACKUP_SEND_LIMIT = 50 * 1024 * 1024  # Bot API orqali yuboriladigan fayl chegarasi
+
+
+def backup_file(src_path: str, dst_path: str):
+    """SQLite online backup: BACKUP_PAGES sahifadan, qadamlar orasida yozuvchilar to'xtamaydi.
+
+    Manba ulanishida ochiq o'qish tranzaksiyasi ushlab turiladi: WAL rejimida bu nusxaga
+    bir lahzalik holatni beradi va boshqa ulanishlarning yozuvlari nusxani qayta boshlatmaydi.
+    """
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=BACKUP_PAGES, progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE))
+    finally:
+        dst.close()
+        src.rollback()
+        src.close()
+
+
+def list_backups() -> list:
+    """Tayyor nusxalar papkalari — eskisidan yangisiga"""
+    backup_dir = current_tenant.get().backup_dir
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if not name.endswith(".tmp") and os.path.isdir(os.path.join(backup_dir, name))
+    )
+
+
+def create_backup(reason: str = "manual") -> str:
+    """Asosiy baza va barcha shardlarning nusxasini yangi papkaga oladi, eskilarini aylantiradi"""
+    tenant = current_tenant.get()
+    target = os.path.join(tenant.backup_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{reason}")
+    tmp = f"{target}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    started = time.monotonic()
+    for database in [tenant.db, *tenant.db.shards]:
+        backup_file(database.path, os.path.join(tmp, os.path.basename(database.path)))
+    # Yarim qolgan nusxa hech qachon "oxirgi nusxa" bo'lib qolmaydi
+    os.replace(tmp, target)
+    for old in list_backups()[:-BACKUP_KEEP]:
+        shutil.rmtree(old, ignore_errors=True)
+    logger.info(f"💾 Zaxira nusxa olindi: {target} ({time.monotonic() - started:.1f} s)")
+    return target
+
+
+def backup_files(snapshot: str) -> list:
+    return [os.path.join(snapshot, name) for name in sorted(os.listdir(snapshot))]
+
+
+def restore_backup(snapshot: str):
+    """Nusxani ishlayotgan bazalarga backup API orqali qaytaradi (fayllar almashtirilmaydi)"""
+    tenant = current_tenant.get()
+    databases = [tenant.db, *tenant.db.shards]
+    sources = [os.path.join(snapshot, os.path.basename(d.path)) for d in databases]
+    missing = [path for path in sources if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(", ".join(missing))
+    for database, source in zip(databases, sources):
+        src = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(source))}?mode=ro", uri=True)
+        dst = sqlite3.connect(database.path, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    logger.warning(f"♻️ Zaxira nusxadan tiklandi: {snapshot}")
+
+
+# === SOVG'A BUYURTMALARI ===
+def redeem_gift(user_id: int, gift_id: int, nonce: str = None):
+    """Sovg'ani bitta atomar tranzaksiyada sotib oladi.
+
+    nonce — tasdiqlash xabarining id si: shu xabar bo'yicha buyurtma bor bo'lsa, qayta yaratilmaydi.
+    Qaytaradi: ("ok", buyurtma_id, nomi, narxi) yoki ("duplicate" | "not_found" | "out_of_stock" | "no_points", ...)
+    """
+    contest_id = get_active_contest_id()
+    conn = db.get_connection()
+    conn.isolation_level = None  # tranzaksiyani o'zimiz boshqaramiz
+    cur = conn.cursor()
+    try:
+        # Shard rejimida foydalanuvchi jadvali ham shu tranzaksiyaga ulanadi
+        users_table = attach_user_shard(conn, user_id) + "users"
+        # IMMEDIATE: yozish qulfi darhol olinadi, o'qish-keyin-yozish poygasi bo'lmaydi
+        cur.execute("BEGIN IMMEDIATE")
+        if nonce is not None:
+            cur.execute("SELECT id, gift_name, points FROM gift_orders WHERE user_id = ? AND nonce = ?",
+                        (user_id, nonce))
+            existing = cur.fetchone()
+            if existing:
+                cur.execute("ROLLBACK")
+                return ("duplicate", *existing)
+        cur.execute(
+            "UPDATE gifts SET stock = stock - 1 WHERE id = ? AND (stock IS NULL OR stock > 0) "
+            "RETURNING name, points_required",
+            (gift_id,),
+        )
+        gift = cur.fetchone()
+        if not gift:
+            cur.execute("SELECT 1 FROM gifts WHERE id = ?", (gift_id,))
+            reason = "out_of_stock" if cur.fetchone() else "not_found"
+            cur.execute("ROLLBACK")
+            return reason, None, None, None
+        name, price = gift
+
+        # Balans = snapshot + qo'llanilmagan daftar yozuvlari; yozish qulfi ostida o'qiladi
+        prefix = users_table[:-len("users")]
+        if ledger_balance(cur, user_id, prefix)[0] < price:
+            cur.execute("ROLLBACK")
+            return "no_points", None, name, price
+
+        cur.execute(
+            "INSERT INTO gift_orders (user_id, gift_id, gift_name, points, nonce) VALUES (?, ?, ?, ?, ?)",
+            (user_id, gift_id, name, price, nonce),
+        )
+        order_id = cur.lastrowid
+        append_ledger(cur, user_id, -price, "redeem", contest_id, f"order:{order_id}", prefix=prefix)
+        cur.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            cur.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    logger.info(f"🧾 Buyurtma #{order_id}: {user_id} -> {name} ({price} ball)")
+    return "ok", order_id, name, price
+
+
+def fulfil_order(order_id: int):
+    """Buyurtmani bajarilgan deb belgilaydi. Qaytaradi: (user_id, gift_name) yoki None"""
+    conn = db.get_connection()
+    with conn:
+        cur = conn.execute(
+            "UPDATE gift_orders SET status = 'done', done_ts = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'pending' RETURNING user_id, gift_name",
+            (order_id,),
+        )
+        row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def reject_order(order_id: int):
+    """Buyurtmani rad etadi: ballar va sovg'a soni qaytariladi. Qaytaradi: (user_id, gift_name) yoki None"""
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT user_id FROM gift_orders WHERE id = ?", (order_id,))
+    owner = cur.fetchone()
+    if not owner:
+        conn.close()
+        return None
+    users_table = attach_user_shard(conn, owner[0]) + "users"
+    contest_id = get_active_contest_id()
+    with conn:
+        cur = conn.execute(
+            "UPDATE gift_orders SET status = 'rejected', done_ts = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'pending' RETURNING user_id, gift_id, gift_name, points",
+            (order_id,),
+        )
+        row = cur.fetchone()
+        if row:
+            user_id, gift_id, _name, points = row
+            append_ledger(conn, user_id, points, "refund", contest_id, f"order:{order_id}",
+                          prefix=users_table[:-len("users")])
+            conn.execute("UPDATE gifts SET stock = stock + 1 WHERE id = ? AND stock IS NOT NULL", (gift_id,))
+    conn.close()
+    return (row[0], row[2]) if row else None
+
+
+def order_admin_keyboard(order_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Bajarildi", callback_data=f"ord:done:{order_id}"),
+        InlineKeyboardButton(text="❌ Rad etish", callback_data=f"ord:rej:{order_id}"),
+    ]])
+
+
+# === OBUNA HOLATI JADVALI ===
+SUB_STATE_TTL = int(os.getenv("SUB_STATE_TTL", "86400"))  # s, shundan eski yozuvlar API orqali yangilanadi
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+def member_has_left(member) -> bool:
+    return member.status in ("left", "kicked") or (
+        member.status == "restricted" and not getattr(member, "is_member", True)
+    )
+
+
+def member_status(member) -> str:
+    return "left" if member_has_left(member) else member.status
+
+
+def save_subscription_states(states: list):
+    """(user_id, chat_id, status) yozuvlarini subscriptions jadvaliga yozadi"""
+    now = int(time.time())
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO subscriptions (user_id, chat_id, status, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id, chat_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at",
+            [(user_id, str(chat_id), status, now) for user_id, chat_id, status in states],
+        )
+    conn.close()
+
+
+def get_fresh_subscription_states(user_id: int) -> dict:
+    """Foydalanuvchining eskirmagan obuna holatlari: {chat_id: status}"""
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT chat_id, status FROM subscriptions WHERE user_id = ? AND updated_at >= ?",
+        (user_id, int(time.time()) - SUB_STATE_TTL),
+    )
+    states = dict(cur.fetchall())
+    conn.close()
+    return states
+
+
+def resolve_registered_channel(chat) -> str:
+    """Telegram chatiga mos ro'yxatdagi kanal chat_id sini qaytaradi (yoki None)"""
+    keys = [str(chat.id)]
+    if chat.username:
+        keys.append(f"@{chat.username}")
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT chat_id FROM channels WHERE chat_id IN ({', '.join('?' for _ in keys)})",
+        keys,
+    )
+    row = cur.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def forget_channel_states(chat_id: str):
+    """Kanal bo'yicha keshlangan holatlarni o'chiradi (bot yangilanish olmay qolganda)"""
+    conn = db.get_connection()
+    with conn:
+        conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+    conn.close()
+
+
+# === XABARNOMA DIGESTLARI ===
+# Bir qabul qiluvchiga shu oraliqda kelgan referal/ball xabarlari bitta xabarga jamlanadi (0 = darhol)
+NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "30"))
+
+
+class NotificationDigest:
+    """Referal va ball xabarnomalarini qabul qiluvchi bo'yicha jamlab, kechiktirib yuboradi"""
+
+    def __init__(self, window: float = NOTIFY_DIGEST_WINDOW):
+        self.window = window
+        self.pending = {}  # (bot_id, chat_id) -> {"bot", "text", "count", "points", "referrals"}
+        self.timers = {}
+        self.sent = 0
+        self.coalesced = 0
+
+    def add(self, bot: Bot, chat_id: int, text: str, points: int = 0, referrals: int = 0):
+        """Xabarnomani navbatga qo'yadi; oyna ichida yolg'iz qolsa, text o'zgarishsiz yuboriladi"""
+        key = (bot.id, chat_id)
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = {"bot": bot, "text": text, "count": 0, "points": 0, "referrals": 0}
+            self.timers[key] = asyncio.create_task(self._flush_later(key))
+        else:
+            self.coalesced += 1
+        entry["count"] += 1
+        entry["points"] += points
+        entry["referrals"] += referrals
+
+    async def _flush_later(self, key: tuple):
+        await asyncio.sleep(self.window)
+        self.timers.pop(key, None)
+        await self._send(key)
+
+    @staticmethod
+    def digest_text(entry: dict) -> str:
+        lines = ["📬 <b>So'nggi yangiliklar</b>"]
+        if entry["referrals"]:
+            lines.append(f"👥 +{entry['referrals']} ta yangi referal")
+        if entry["points"]:
+            lines.append(f"📊 +{entry['points']} ball")
+        return "\n".join(lines)
+
+    async def _send(self, key: tuple):
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+        text = entry["text"] if entry["count"] == 1 else self.digest_text(entry)
+        try:
+            await entry["bot"].send_message(key[1], text)
+            self.sent += 1
+        except Exception as e:
+            logger.error(f"Xabarnoma yuborishda xatolik ({key[1]}): {e}")
+
+    async def flush_all(self):
+        """To'xtashdan oldin: kutayotgan barcha digestlarni darhol yuboradi"""
+        for task in self.timers.values():
+            task.cancel()
+        self.timers.clear()
+        keys = list(self.pending)
+        if keys:
+            logger.info(f"📬 To'xtashdan oldin {len(keys)} ta xabarnoma yuborilmoqda")
+        for key in keys:
+            await self._send(key)
+
+
+notification_digest = NotificationDigest()
+
+
+async def notify(bot: Bot, chat_id: int, text: str, points: int = 0, referrals: int = 0):
+    """Referal/ball xabarnomasi — NOTIFY_DIGEST_WINDOW > 0 bo'lsa jamlanadi"""
+    if notification_digest.window <= 0:
+        await bot.send_message(chat_id, text)
+    else:
+        notification_digest.add(bot, chat_id, text, points, referrals)
+
+
+# === MAJBURIY OBUNA TEKSHIRISH ===
+# Bir vaqtda ishlayotgan tekshiruvlar: (bot_id, user_id) -> asyncio.Task
+_subscription_checks = {}
+single_flight_stats = {"started": 0, "joined": 0}
+# subscriptions jadvalidagi yangi holatlar: topildi (hits) / API dan so'raldi (misses)
+subscription_cache_stats = {"hits": 0, "misses": 0}
+
+
+async def check_subscription(user_id: int, bot: Bot) -> bool:
+    """Foydalanuvchi barcha kanallarga obuna bo'lganini tekshiradi.
+
+    Bir foydalanuvchi uchun parallel chaqiruvlar bitta tekshiruvni kutadi va uning natijasini oladi.
+    """
+    key = (bot.id, user_id)
+    task = _subscription_checks.get(key)
+    if task is None:
+        single_flight_stats["started"] += 1
+        task = asyncio.ensure_future(_check_subscription(user_id, bot))
+        _subscription_checks[key] = task
+        task.add_done_callback(
+            lambda t: _subscription_checks.pop(key) if _subscription_checks.get(key) is t else None
+        )
+    else:
+        single_flight_stats["joined"] += 1
+    # shield: bitta chaqiruvchi bekor qilinsa ham umumiy tekshiruv davom etadi
+    return await asyncio.shield(task)
+
+
+async def _check_subscription(user_id: int, bot: Bot) -> bool:
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT chat_id, invite_link FROM channels")
+    channels = cur.fetchall()
+    conn.close()
+
+    if not channels:
+        return True  # kanal yo'q bo'lsa, obuna talab qilinmaydi
+
+    all_subscribed = True
+    new_points_given = 0
+    # chat_member yangilanishlaridan kelgan holatlar — API ga faqat noma'lum/eskirganlar uchun murojaat qilamiz
+    known_states = get_fresh_subscription_states(user_id)
+    looked_up = []
+    subscribed = []
+
+    for chat_id, invite_link in channels:
+        try:
+            status = known_states.get(str(chat_id))
+            subscription_cache_stats["misses" if status is None else "hits"] += 1
+            if status is None:
+                member = await bot.get_chat_member(chat_id, user_id)
+                status = member_status(member)
+                looked_up.append((user_id, chat_id, status))
+            if status in SUBSCRIBED_STATUSES:
+                # Ball keyin — barcha obuna bo'lingan kanallar uchun bitta tranzaksiyada
+                subscribed.append(str(chat_id))
+            else:
+                all_subscribed = False  # Obuna bo'lmagan
+        except Exception as e:
+            logger.error(f"Obuna tekshirishda xatolik {chat_id}: {e}")
+            # Agar tekshirish imkoni bo'lmasa, bazadagi ball berilganligiga qaraymiz
+            conn = db.for_user(user_id).get_connection()
+            cur = conn.cursor()
+            cur.execute("SELECT 1 FROM points_given WHERE user_id=? AND channel_id=?", (user_id, str(chat_id)))
+            if not cur.fetchone():
+                all_subscribed = False
+            conn.close()
+
+    if looked_up:
+        save_subscription_states(looked_up)
+
+    # Hali ball olinmagan kanallar uchun bitta INSERT ... RETURNING
+    try:
+        new_points_given = len(award_channels(user_id, subscribed, JOIN_REQUEST_POINTS)) * JOIN_REQUEST_POINTS
+    except Exception as e:
+        logger.error(f"Ball berishda xatolik: {e}")
+
+    # Agar yangi ball berilgan bo'lsa, foydalanuvchiga xabar beramiz
+    if new_points_given > 0:
+        try:
+            await notify(
+                bot, user_id, f"🎉 Tabriklaymiz! Siz {new_points_given} ball qo'lga kiritdingiz!",
+                points=new_points_given,
+            )
+        except Exception as e:
+            logger.error(f"Ball haqida xabar berishda xatolik: {e}")
+
+    return all_subscribed
+
+
+# === OBUNANI QAYTA TEKSHIRISH (FON VAZIFASI) ===
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "21600"))  # to'liq aylanishlar orasidagi pauza (s), 0 = o'chiq
+SWEEP_BATCH = int(os.getenv("SWEEP_BATCH", "500"))
+SWEEP_CONCURRENCY = int(os.getenv("SWEEP_CONCURRENCY", "5"))
+SWEEP_RATE = float(os.getenv("SWEEP_RATE", "5"))  # get_chat_member so'rovlari / soniya
+SWEEP_MODE = os.getenv("SWEEP_MODE", "revoke")  # "revoke" — ballni qaytarib olish, "flag" — faqat belgilash
+
+
+def revoke_left_awards(shard: Database, rows: list):
+    """Kanaldan chiqqanlar uchun berilgan ballarni qaytarib oladi yoki belgilaydi.
+
+    Batch tekshiruvi davomida qatorlar o'chirilgan bo'lishi mumkin (yangi konkurs, tozalash) —
+    ball va statistika faqat haqiqatan o'zgargan (RETURNING) qatorlar bo'yicha hisoblanadi.
+    """
+    contest_id = get_active_contest_id()
+    award_ids = [row[0] for row in rows]
+    placeholders = ", ".join("?" for _ in award_ids)
+    conn = shard.get_connection()
+    with conn:
+        if SWEEP_MODE == "flag":
+            changed = conn.execute(
+                f"UPDATE points_given SET left_ts = CURRENT_TIMESTAMP "
+                f"WHERE id IN ({placeholders}) AND left_ts IS NULL RETURNING user_id, channel_id, points",
+                award_ids,
+            ).fetchall()
+        else:
+            changed = conn.execute(
+                f"DELETE FROM points_given WHERE id IN ({placeholders}) RETURNING user_id, channel_id, points",
+                award_ids,
+            ).fetchall()
+            for user_id, channel_id, points in changed:
+                append_ledger(conn, user_id, -points, "left", contest_id, channel_id)
+        left_by_channel = {}
+        for _, channel_id, points in changed:
+            count, total = left_by_channel.get(channel_id, (0, 0))
+            left_by_channel[channel_id] = (count + 1, total + points)
+        for channel_id, (count, total) in left_by_channel.items():
+            record_stats(conn, "left", channel_id, points=0 if SWEEP_MODE == "flag" else total, count=count)
+    conn.close()
+
+
+def sweep_checkpoint_name(shard_index: int) -> str:
+    return "sweep_last_id" if shard_index == 0 else f"sweep_last_id:{shard_index}"
+
+
+async def sweep_subscriptions_batch(bot: Bot, limiter: RateLimiter, shard_index: int = 0) -> bool:
+    """Sharddagi navbatdagi batchni tekshiradi. Shard aylanishi tugagan bo'lsa True qaytaradi"""
+    shard = db.user_shards()[shard_index]
+    last_id = int(get_job_state(sweep_checkpoint_name(shard_index), 0))
+    conn = shard.get_connection()
+    cur = conn.cursor()
+    # flag rejimida belgilangan qatorlar ham tekshiriladi — qaytib qo'shilganlar belgisi olib tashlanadi
+    cur.execute(
+        "SELECT id, user_id, channel_id, points, source, left_ts FROM points_given "
+        "WHERE id > ? ORDER BY id LIMIT ?",
+        (last_id, SWEEP_BATCH),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    if not rows:
+        return True
+
+    # chat_member yangilanishlaridan ma'lum bo'lgan yangi holatlar uchun API chaqirilmaydi
+    user_ids = sorted({r[1] for r in rows})
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT user_id, chat_id, status FROM subscriptions "
+        f"WHERE user_id IN ({', '.join('?' for _ in user_ids)}) AND updated_at >= ?",
+        (*user_ids, int(time.time()) - SUB_STATE_TTL),
+    )
+    known_states = {(uid, chat_id): status for uid, chat_id, status in cur.fetchall()}
+    conn.close()
+
+    semaphore = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    looked_up = []
+
+    async def check(row):
+        status = known_states.get((row[1], row[2]))
+        if status is None:
+            async with semaphore:
+                await limiter.acquire()
+                try:
+                    member = await bot.get_chat_member(row[2], row[1])
+                except Exception as e:
+                    # Kanal o'chirilgan yoki bot admin emas — bunday holatda ballga tegmaymiz
+                    logger.debug(f"Qayta tekshirishda xatolik {row[2]}/{row[1]}: {e}")
+                    return None
+            status = member_status(member)
+            looked_up.append((row[1], row[2], status))
+        return row, status
+
+    left, rejoined, approved = [], [], []
+    for result in await asyncio.gather(*(check(r) for r in rows)):
+        if result is None:
+            continue
+        row, status = result
+        award_id, _, _, _, source, left_ts = row
+        if status == "left":
+            # Kutilayotgan qo'shilish so'rovi ham "left" ko'rinadi — so'rov uchun berilgan ball olinmaydi
+            if source != "request" and left_ts is None:
+                left.append(row)
+        else:
+            if left_ts is not None:
+                rejoined.append(award_id)
+            if source == "request":
+                # So'rov tasdiqlandi: endi oddiy a'zolik kabi tekshiriladi
+                approved.append(award_id)
+    if looked_up:
+        save_subscription_states(looked_up)
+    if rejoined or approved:
+        conn = shard.get_connection()
+        with conn:
+            conn.executemany("UPDATE points_given SET left_ts = NULL WHERE id = ?", [(i,) for i in rejoined])
+            conn.executemany("UPDATE points_given SET source = 'check' WHERE id = ?", [(i,) for i in approved])
+        conn.close()
+    if left:
+        revoke_left_awards(shard, left)
+        logger.info(f"🧹 Qayta tekshiruv: {len(left)} ta obunadan chiqish aniqlandi ({SWEEP_MODE})")
+    set_job_state(sweep_checkpoint_name(shard_index), rows[-1][0])
+    return False
+
+
+async def subscription_sweeper(bot: Bot):
+    """Ball berilgan (user, kanal) juftliklarini fon rejimida qayta tekshiradi"""
+    # Har bir tenant o'z rate budjetiga ega
+    limiter = RateLimiter(current_tenant.get().sweep_rate or SWEEP_RATE, burst=SWEEP_CONCURRENCY)
+    while True:
+        shard_count = len(db.user_shards())
+        try:
+            # Shardlar ketma-ket; tugagan shard checkpointi aylanish oxirigacha saqlanadi
+            for shard_index in range(shard_count):
+                while not await sweep_subscriptions_batch(bot, limiter, shard_index):
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(f"Qayta tekshiruv xatosi: {traceback.format_exc()}")
+            await asyncio.sleep(60)
+            continue
+        for shard_index in range(shard_count):
+            set_job_state(sweep_checkpoint_name(shard_index), 0)
+        logger.info("🧹 Obunalarni qayta tekshirish aylanishi tugadi")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+# === SAHIFALASH (KEYSET) ===
+PAGE_SIZE = 10
+
+# Ro'yxat turi -> jadval, ustunlar va indekslangan kalit (tartiblash) ustunlari.
+# callback_data: "pg:<tur>:<sahifa>:<n|p>:<kalit1>[:<kalit2>]" — 64 baytdan oshmaydi
+PAGED_LISTS = {
+    "r": {"table": "users", "columns": "full_name", "key": ("points", "user_id"), "desc": True},
+    "c": {"table": "channels", "columns": "name, invite_link", "key": ("rowid",), "desc": False},
+    "g": {"table": "gifts", "columns": "id, name, stock", "key": ("points_required", "id"), "desc": False},
+    "a": {"table": "gifts", "columns": "id, name, stock", "key": ("points_required", "id"), "desc": False},
+}
+
+
+def fetch_keyset_page(kind: str, cursor: tuple = None, backward: bool = False):
+    """Kursordan keyingi (yoki oldingi) sahifani indeks bo'yicha o'qiydi.
+
+    Qaytaradi: (qatorlar, yana_bor). Har bir qator oxirida kalit ustunlari turadi.
+    """
+    spec = PAGED_LISTS[kind]
+    key = ", ".join(spec["key"])
+    descending = spec["desc"] != backward
+    sql = f"SELECT {spec['columns']}, {key} FROM {spec['table']}"
+    params = []
+    if cursor is not None:
+        placeholders = ", ".join("?" for _ in spec["key"])
+        sql += f" WHERE ({key}) {'<' if descending else '>'} ({placeholders})"
+        params.extend(cursor)
+    sql += " ORDER BY " + ", ".join(f"{c} {'DESC' if descending else 'ASC'}" for c in spec["key"])
+    sql += " LIMIT ?"
+    params.append(PAGE_SIZE + 1)
+
+    # Shard rejimida har bir shard o'z sahifasini beradi, natijalar kalit bo'yicha birlashtiriladi
+    sources = db.user_shards() if spec["table"] in SHARDED_TABLES else [db]
+    key_len = len(spec["key"])
+    results = []
+    for source in sources:
+        conn = source.get_connection()
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        results.append(cur.fetchall())
+        conn.close()
+    rows = results[0] if len(results) == 1 else list(itertools.islice(
+        heapq.merge(*results, key=lambda r: r[-key_len:], reverse=descending), PAGE_SIZE + 1))
+
+    has_more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+def page_callback_data(kind: str, page: int, direction: str, key: tuple) -> str:
+    return ":".join(["pg", kind, str(page), direction] + [str(k) for k in key])
+
+
+def parse_page_callback(data: str):
+    """'pg:...' ni (tur, sahifa, orqaga, kursor) ga ajratadi"""
+    _, kind, page, direction, *key = data.split(":")
+    return kind, int(page), direction == "p", tuple(int(k) for k in key)
+
+
+def load_page(kind: str, page: int = 0, cursor: tuple = None, backward: bool = False):
+    """Sahifani o'qib, navigatsiya tugmalarini tayyorlaydi"""
+    rows, has_more = fetch_keyset_page(kind, cursor, backward)
+    if backward and not has_more:
+        page = 0  # boshiga yetib keldik
+
+    key_len = len(PAGED_LISTS[kind]["key"])
+    nav = []
+    if rows and page > 0:
+        nav.append(InlineKeyboardButton(
+            text="◀️", callback_data=page_callback_data(kind, page - 1, "p", rows[0][-key_len:])))
+    if rows and (has_more or backward):
+        nav.append(InlineKeyboardButton(
+            text="▶️", callback_data=page_callback_data(kind, page + 1, "n", rows[-1][-key_len:])))
+    return rows, page, nav
+
+
+def render_rating_page(page: int = 0, cursor: tuple = None, backward: bool = False):
+    rows, page, nav = load_page("r", page, cursor, backward)
+    msg = f"🏆 Reyting — {page + 1}-sahifa\n\n"
+    for i, (name, points, _uid) in enumerate(rows, page * PAGE_SIZE + 1):
+        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        msg += f"{medal} {name} - {points} ball\n"
+    if not rows:
+        msg += "📭 Hozircha ishtirokchilar yo'q.\n"
+    return msg, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
+
+def render_channels_page(page: int = 0, cursor: tuple = None, backward: bool = False):
+    rows, page, nav = load_page("c", page, cursor, backward)
+    if not rows and page == 0:
+        return "📺 Hozircha kanallar mavjud emas.", None
+    msg = "📺 Obuna bo'lish kerak bo'lgan kanallar:\n\n"
+    for name, link, _rowid in rows:
+        msg += f"➡️ {name}\n"
+        if link:
+            msg += f"🔗 {link}\n"
+        msg += "\n"
+    msg += "ℹ️ Kanallarga obuna bo'lib, qo'shimcha ball to'plashingiz mumkin!"
+    return msg, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
+
+def get_user_points(user_id: int) -> int:
+    return get_user_balance(user_id)[0]
+
+
+def render_gifts_page(user_id: int, page: int = 0, cursor: tuple = None, backward: bool = False):
+    rows, page, nav = load_page("g", page, cursor, backward)
+    user_points = get_user_points(user_id)
+    if not rows and page == 0:
+        return (
+            f"🎁 Hozircha sovg'alar mavjud emas.\n\n"
+            f"📊 Sizda {user_points} ball to'plagansiz."
+        ), None
+
+    msg = f"🎁 Mavjud sovg'alar:\n\n"
+    msg += f"💰 Sizning ballaringiz: {user_points}\n\n"
+    buttons = []
+    for gift_id, name, stock, points_req, _id in rows:
+        if stock is not None and stock <= 0:
+            status = "📦 Tugagan"
+        elif user_points >= points_req:
+            status = "✅ Sotib olish mumkin"
+            buttons.append([InlineKeyboardButton(text=f"🎁 {name}", callback_data=f"rd:{gift_id}")])
+        else:
+            status = f"❌ Yetarli ball yo'q"
+        msg += f"🎯 {name}\n"
+        msg += f"💰 Narxi: {points_req} ball\n"
+        if stock is not None:
+            msg += f"📦 Qoldi: {max(stock, 0)} ta\n"
+        msg += f"📊 Holat: {status}\n\n"
+    if buttons:
+        msg += "ℹ️ Sovg'a olish uchun quyidagi tugmalardan birini bosing."
+    if nav:
+        buttons.append(nav)
+    return msg, InlineKeyboardMarkup(inline_keyboard=buttons) if buttons else None
+
+
+def render_admin_gifts_page(page: int = 0, cursor: tuple = None, backward: bool = False):
+    rows, page, nav = load_page("a", page, cursor, backward)
+    if not rows and page == 0:
+        return "📭 Hozircha sovg'alar mavjud emas.", None
+    message_text = "📜 <b>Mavjud sovg'alar:</b>\n\n"
+    for id, name, stock, points, _id in rows:
+        message_text += f"<b>{id}. {name}</b>\n"
+        message_text += f"   Narxi: {points} ball\n"
+        message_text += f"   Soni: {stock if stock is not None else '♾'}\n\n"
+    return message_text, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
+
+# === THROTTLING VA YUKLAMANI KAMAYTIRISH ===
+# Handler turi -> (soniyasiga token, maksimal jamlanish)
+THROTTLE_RATES = {
+    "check": (0.2, 2),   # ✅ Tekshirish: N ta API so'rovi + yozuvlar
+    "rating": (0.5, 3),  # 🏆 Reyting
+    "lists": (0.5, 3),   # kanallar / sovg'alar ro'yxati
+    "pages": (2, 5),     # ◀️/▶️
+    "redeem": (0.5, 2),
+    "default": (2, 10),
+}
+THROTTLE_MAX_BUCKETS = 100000
+# Event loop kechikishi shundan oshsa, muhim bo'lmagan so'rovlar rad etiladi
+SHED_LAG_THRESHOLD = float(os.getenv("SHED_LAG_THRESHOLD", "0.5"))
+SHEDDABLE_KEYS = {"rating", "lists", "pages"}
+
+
+class LoopLagMonitor:
+    """Event loop kechikishini o'lchaydi va yuklama rejimini belgilaydi"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def shedding(self) -> bool:
+        return self.lag > SHED_LAG_THRESHOLD
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            was_shedding = self.shedding
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.shedding != was_shedding:
+                mode = "yoqildi" if self.shedding else "o'chirildi"
+                logger.warning(f"⚠️ Yuklama rejimi {mode} (loop kechikishi {self.lag * 1000:.0f} ms)")
+
+
+loop_monitor = LoopLagMonitor()
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Har bir foydalanuvchi va handler turi uchun token bucket"""
+
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.throttled = 0
+        self.shed = 0
+
+    def _bucket(self, user_id: tuple, key: str) -> RateLimiter:
+        bucket = self.buckets.get((user_id, key))
+        if bucket is None:
+            rate, burst = THROTTLE_RATES.get(key, THROTTLE_RATES["default"])
+            bucket = self.buckets[(user_id, key)] = RateLimiter(rate, burst)
+            if len(self.buckets) > THROTTLE_MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end((user_id, key))
+        return bucket
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id == get_admin_id():
+            return await handler(event, data)
+
+        key = get_flag(data, "throttling_key", default="default")
+        if key in SHEDDABLE_KEYS and loop_monitor.shedding:
+            self.shed += 1
+            # CallbackQuery uchun qisqa bildirishnoma, Message uchun qisqa javob
+            await event.answer("⚠️ Bot hozir band. Iltimos, birozdan so'ng qayta urinib ko'ring.")
+            return None
+
+        if not self._bucket((data["bot"].id, user.id), key).try_acquire():
+            self.throttled += 1
+            if isinstance(event, CallbackQuery):
+                # Tugma "aylanib" qolmasligi uchun javob beramiz, lekin ishni bajarmaymiz
+                await event.answer("⏳ Iltimos, biroz kuting...")
+            return None
+        return await handler(event, data)
+
+
+throttling_middleware = ThrottlingMiddleware()
+
+
+# === FAOLLIK (last_active) ===
+ACTIVITY_RESOLUTION = int(os.getenv("ACTIVITY_RESOLUTION", "3600"))  # last_active ni yangilash oralig'i (s)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """users.last_active ni yangilaydi — har bir foydalanuvchi uchun ACTIVITY_RESOLUTION da ko'pi bilan bir marta"""
+
+    def __init__(self):
+        self.last_written = OrderedDict()
+        self.skipped = 0
+        self.written = 0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            key = (data["bot"].id, user.id)
+            now = time.monotonic()
+            last = self.last_written.get(key)
+            if last is not None and now - last < ACTIVITY_RESOLUTION:
+                self.skipped += 1
+            else:
+                try:
+                    conn = db.for_user(user.id).get_connection()
+                    with conn:
+                        updated = conn.execute(
+                            "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?", (user.id,)
+                        ).rowcount
+                    conn.close()
+                    # Hali ro'yxatdan o'tmagan foydalanuvchi keyingi hodisada qayta yoziladi
+                    if updated:
+                        self.written += 1
+                        self.last_written[key] = now
+                        self.last_written.move_to_end(key)
+                        if len(self.last_written) > THROTTLE_MAX_BUCKETS:
+                            self.last_written.popitem(last=False)
+                except Exception as e:
+                    logger.error(f"last_active ni yangilashda xatolik: {e}")
+        return await handler(event, data)
+
+
+activity_middleware = ActivityMiddleware()
+
+
+# === PARALLEL ISHLOV (TARTIB SAQLANADI) ===
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))  # bir vaqtda bajariladigan update lar
+
+
+class OrderedEventIsolation(BaseEventIsolation):
+    """Turli foydalanuvchilar update lari parallel, bitta foydalanuvchiniki esa kelgan tartibida bajariladi.
+
+    aiogram FSM middleware i lock() ni holat o'qilishidan oldin oladi, shuning uchun
+    keyingi update oldingisi o'rnatgan holatni ko'radi (masalan AdminStates.broadcast).
+    asyncio.Lock navbati FIFO — kutayotganlar kelish tartibida uyg'onadi.
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.locks = {}
+        self.depth = {}  # kalit -> navbatdagi (bajarilayotgan bilan birga) update lar soni
+        self.running = 0
+        self.processed = 0
+        self.max_depth = 0
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        depth = self.depth[key] = self.depth.get(key, 0) + 1
+        self.max_depth = max(self.max_depth, depth)
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        try:
+            async with lock, self.semaphore:
+                self.running += 1
+                try:
+                    yield
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+        finally:
+            self.depth[key] -= 1
+            # Navbati bo'shagan kalitning qulfi ham o'chiriladi — lug'at o'smaydi
+            if not self.depth[key]:
+                del self.depth[key]
+                del self.locks[key]
+
+    async def close(self):
+        self.locks.clear()
+        self.depth.clear()
+
+    def queue_stats(self, top: int = 10) -> dict:
+        busiest = heapq.nlargest(top, self.depth.items(), key=lambda item: item[1])
+        return {
+            "running": self.running,
+            "waiting": sum(self.depth.values()) - self.running,
+            "keys": len(self.depth),
+            "processed": self.processed,
+            "max_depth": self.max_depth,
+            "busiest": [(key.user_id, depth) for key, depth in busiest],
+        }
+
+
+update_isolation = OrderedEventIsolation()
+admin_tasks = set()
+
+
+def _admin_task_done(task: asyncio.Task):
+    admin_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Fon vazifasi {task.get_name()} xatosi: {task.exception()!r}")
+
+
+def start_admin_task(coro, name: str) -> asyncio.Task:
+    """Uzoq admin ishini handlerdan tashqarida bajaradi — foydalanuvchi navbati (qulf) darhol bo'shaydi.
+
+    Handler qaytgach admin boshqa buyruqlarni (shu jumladan "🔙 Bekor qilish") yubora oladi.
+    """
+    task = asyncio.create_task(coro, name=name)
+    admin_tasks.add(task)
+    task.add_done_callback(_admin_task_done)
+    return task
+
+
+# === DIAGNOSTIKA ===
+DIAG_INTERVAL = int(os.getenv("DIAG_INTERVAL", "0"))  # davriy hisobot oralig'i (s), 0 = o'chiq
+DIAG_TRACEMALLOC = int(os.getenv("DIAG_TRACEMALLOC", "0"))  # >0 bo'lsa tracemalloc shuncha freym bilan yoqiladi
+DIAG_TOP = 10
+
+
+def hit_rate(hits: int, misses: int) -> str:
+    total = hits + misses
+    return f"{hits}/{total} ({hits * 100 // total}%)" if total else "0/0"
+
+
+def process_rss() -> int:
+    """Joriy RSS (bayt); /proc bo'lmasa — eng katta RSS"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def fsm_storage_size(storage) -> str:
+    """FSM yozuvlari: jami / holati yoki ma'lumoti borlari"""
+    if hasattr(storage, "size_report"):
+        return storage.size_report()
+    records = getattr(storage, "storage", None)
+    if not isinstance(records, dict):
+        return type(storage).__name__
+    active = sum(1 for r in records.values() if r.state is not None or r.data)
+    return f"{len(records)} yozuv, {active} ta faol"
+
+
+class Diagnostics:
+    """Event loop, vazifalar, keshlar va xotira holati — /diag va davriy hisobot uchun"""
+
+    def __init__(self):
+        self.task_started = weakref.WeakKeyDictionary()
+        self.installed_at = time.monotonic()
+        self.snapshot = None
+
+    def install(self, loop: asyncio.AbstractEventLoop):
+        """Vazifalar yoshini bilish uchun task factory o'rnatadi"""
+        self.installed_at = time.monotonic()
+        if DIAG_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start(DIAG_TRACEMALLOC)
+
+        def factory(loop, coro, **kwargs):
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+            self.task_started[task] = time.monotonic()
+            return task
+
+        loop.set_task_factory(factory)
+
+    def task_report(self) -> list:
+        now = time.monotonic()
+        ages = []
+        for task in asyncio.all_tasks():
+            ages.append((now - self.task_started.get(task, self.installed_at), task))
+        ages.sort(key=lambda item: item[0], reverse=True)
+        buckets = {"<1s": 0, "<1m": 0, "<1h": 0, "≥1h": 0}
+        for age, _ in ages:
+            key = "<1s" if age < 1 else "<1m" if age < 60 else "<1h" if age < 3600 else "≥1h"
+            buckets[key] += 1
+        lines = [f"Vazifalar: {len(ages)} ({', '.join(f'{k}: {v}' for k, v in buckets.items())})"]
+        # Eng eski vazifalar — fon sikllaridan tashqari uzoq yashayotganlar oqish belgisi
+        for age, task in ages[:5]:
+            coro = task.get_coro()
+            lines.append(f"  {age:8.0f}s {getattr(coro, '__qualname__', task.get_name())}")
+        return lines
+
+    def memory_report(self) -> list:
+        lines = [f"RSS: {process_rss() / 1048576:.1f} MB"]
+        if not tracemalloc.is_tracing():
+            lines.append("tracemalloc: o'chiq (DIAG_TRACEMALLOC=N)")
+            return lines
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"tracemalloc: {current / 1048576:.1f} MB (cho'qqi {peak / 1048576:.1f} MB)")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        if self.snapshot is None:
+            lines.append("Eng ko'p ajratuvchilar:")
+            stats = [(s.size, s.count, s.traceback) for s in snapshot.statistics("lineno")[:DIAG_TOP]]
+        else:
+            # Oldingi hisobotdan beri o'sganlar — oqish shu yerda ko'rinadi
+            lines.append("Oldingi hisobotdan beri o'sish:")
+            stats = [(s.size_diff, s.count_diff, s.traceback)
+                     for s in snapshot.compare_to(self.snapshot, "lineno")[:DIAG_TOP]]
+        self.snapshot = snapshot
+        for size, count, tb in stats:
+            frame = tb[0]
+            lines.append(f"  {size / 1024:+9.1f} KB {count:+7d} {os.path.basename(frame.filename)}:{frame.lineno}")
+        return lines
+
+    def report(self, storage=None) -> str:
+        queue_stats = update_isolation.queue_stats(0)
+        lines = [
+            f"Loop kechikishi: {loop_monitor.lag * 1000:.0f} ms (maks. {loop_monitor.max_lag * 1000:.0f} ms)"
+            + (" — yuklama rejimi" if loop_monitor.shedding else ""),
+            *self.task_report(),
+            f"Update lar: {queue_stats['running']} bajarilmoqda, {queue_stats['waiting']} kutmoqda, "
+            f"{queue_stats['keys']} qulf",
+        ]
+        if storage is not None:
+            lines.append(f"FSM: {fsm_storage_size(storage)}")
+        lines += [
+            "Keshlar:",
+            f"  throttling: {len(throttling_middleware.buckets)} bucket "
+            f"(rad: {throttling_middleware.throttled}, yuklama: {throttling_middleware.shed})",
+            f"  last_active: {len(activity_middleware.last_written)} kalit, "
+            f"o'tkazildi {hit_rate(activity_middleware.skipped, activity_middleware.written)}",
+            f"  obuna holatlari: {hit_rate(subscription_cache_stats['hits'], subscription_cache_stats['misses'])}",
+            f"  obuna tekshiruvlari: {len(_subscription_checks)} faol, "
+            f"birlashtirildi {hit_rate(single_flight_stats['joined'], single_flight_stats['started'])}",
+            f"  o'qish ulanishlari (hovuzda): {sum(d._read_pool.qsize() for d in [db, *db.shards])}",
+            f"  xabarnomalar: {len(notification_digest.pending)} kutmoqda, {notification_digest.sent} yuborildi, "
+            f"{notification_digest.coalesced} jamlandi",
+        ]
+        lines += self.memory_report()
+        return "\n".join(lines)
+
+    async def run(self, storage=None):
+        """DIAG_INTERVAL soniyada bir marta hisobotni logga yozadi"""
+        while True:
+            await asyncio.sleep(DIAG_INTERVAL)
+            try:
+                logger.info("🩺 Diagnostika:\n" + self.report(storage))
+            except Exception:
+                logger.error(f"Diagnostikada xatolik: {traceback.format_exc()}")
+
+
+diagnostics = Diagnostics()
+
+# === FSM SAQLASH (SQLITE) ===
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # sqlite | memory
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))  # yozuvlarni bazaga saqlash oralig'i (s)
+FSM_CACHE_TTL = int(os.getenv("FSM_CACHE_TTL", "900"))  # ishlatilmagan yozuv keshdan chiqariladi (s)
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))  # tashlab ketilgan holat o'chiriladi (s)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM holatlari tenant bazasidagi fsm_states jadvalida.
+
+    O'qish keshdan (yo'q bo'lsa o'qish hovuzi orqali bazadan), yozish avval keshga tushadi va
+    FSM_FLUSH_INTERVAL da yozuvchi oqimida bir tranzaksiyada saqlanadi.
+    Yozuv: [state, data, updated_ts, last_used]
+    """
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True,
+                                             with_destiny=True)
+        self.cache = OrderedDict()  # kalit -> yozuv, eng uzoq ishlatilmagani boshida
+        self.dirty = {}  # kalit -> StorageKey (qaysi tenant bazasiga yozilishi uchun)
+        self.frozen = set()  # tiklanayotgan bazalar — ularga yozuvlar vaqtincha saqlanmaydi
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @staticmethod
+    def _database(key: StorageKey) -> Database:
+        return tenant_for_bot(key.bot_id).db
+
+    def _load(self, key: StorageKey, name: str) -> list:
+        conn = self._database(key).get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT state, data, updated_ts FROM fsm_states WHERE key = ?", (name,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return [None, {}, time.time(), 0.0]
+        return [row[0], json.loads(row[1]) if row[1] else {}, row[2], 0.0]
+
+    async def _record(self, key: StorageKey) -> tuple:
+        name = self.key_builder.build(key)
+        record = self.cache.get(name)
+        if record is None:
+            self.misses += 1
+            loaded = await run_read(self._load, key, name)
+            # Kutish paytida boshqa korutina yozuvni keshga qo'ygan bo'lishi mumkin — u ustun
+            record = self.cache.setdefault(name, loaded)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(name)
+        # Uzoq vaqt o'zgarmagan holat — foydalanuvchi jarayonni tashlab ketgan
+        if (record[0] is not None or record[1]) and time.time() - record[2] > FSM_STATE_TTL:
+            record[0], record[1], record[2] = None, {}, time.time()
+            self.dirty[name] = key
+            self.expired += 1
+        record[3] = time.monotonic()
+        return name, record
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        name, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        record[2] = time.time()
+        self.dirty[name] = key
+
+    async def get_state(self, key: StorageKey):
+        return (await self._record(key))[1][0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        name, record = await self._record(key)
+        record[1] = data.copy()
+        record[2] = time.time()
+        self.dirty[name] = key
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._record(key))[1][1].copy()
+
+    async def flush(self) -> int:
+        """Yozilmagan yozuvlarni har bir tenant bazasiga bitta tranzaksiyada saqlaydi (yozuvchi oqimida)"""
+        dirty = {name: key for name, key in self.dirty.items() if self._database(key).path not in self.frozen}
+        if not dirty:
+            return 0
+        for name in dirty:
+            del self.dirty[name]
+        batches = {}
+        for name, key in dirty.items():
+            record = self.cache.get(name)
+            if record is None:
+                continue
+            database = self._database(key)
+            upserts, deletes = batches.setdefault(database.path, (database, [], []))[1:]
+            if record[0] is None and not record[1]:
+                deletes.append((name,))
+            else:
+                upserts.append((name, record[0], json.dumps(record[1], ensure_ascii=False), int(record[2])))
+        try:
+            await run_write(self._write_batches, list(batches.values()))
+        except Exception:
+            # Keyingi urinishda qayta yoziladi (upsert takrorlansa ham zarar yo'q)
+            for name, key in dirty.items():
+                self.dirty.setdefault(name, key)
+            raise
+        return len(dirty)
+
+    @staticmethod
+    def _write_batches(batches: list):
+        for database, upserts, deletes in batches:
+            conn = database.get_connection()
+            try:
+                with conn:
+                    conn.executemany("""INSERT INTO fsm_states (key, state, data, updated_ts)
+                                        VALUES (?, ?, ?, ?)
+                                        ON CONFLICT(key) DO UPDATE SET state      = excluded.state,
+                                                                       data       = excluded.data,
+                                                                       updated_ts = excluded.updated_ts""",
+                                     upserts)
+                    conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+            finally:
+                conn.close()
+
+    async def freeze(self, database: Database):
+        """Baza tiklanishidan oldin: yozilmaganlar saqlanadi, keyingi yozuvlar unga yozilmay turadi"""
+        await self.flush()
+        self.frozen.add(database.path)
+
+    def invalidate(self, database: Database):
+        """Baza tiklangandan keyin: uning yozilmagan yozuvlari tashlanadi, kesh bazadan qayta o'qiladi"""
+        for name, key in list(self.dirty.items()):
+            if self._database(key).path == database.path:
+                del self.dirty[name]
+        for name in [name for name in self.cache if name not in self.dirty]:
+            del self.cache[name]
+        self.frozen.discard(database.path)
+
+    def evict(self) -> int:
+        """FSM_CACHE_TTL davomida ishlatilmagan (va saqlangan) yozuvlarni keshdan chiqaradi"""
+        cutoff = time.monotonic() - FSM_CACHE_TTL
+        stale = []
+        for name, record in self.cache.items():
+            if record[3] > cutoff:
+                break
+            if name not in self.dirty:
+                stale.append(name)
+        for name in stale:
+            del self.cache[name]
+        return len(stale)
+
+    def purge_expired(self) -> int:
+        """Bazadagi FSM_STATE_TTL dan eski barcha holatlarni o'chiradi.
+
+        Keshda qolgan shunday yozuvlar ham o'chadi — ular _record da baribir bo'shatiladi,
+        yozilmagan (dirty) o'zgarishlar esa keyingi flush da qayta yoziladi.
+        """
+        cutoff = int(time.time() - FSM_STATE_TTL)
+        databases = {t.db.path: t.db for t in tenants_by_bot_id.values()}
+        if default_tenant is not None:
+            databases.setdefault(default_tenant.db.path, default_tenant.db)
+        removed = 0
+        for database in databases.values():
+            conn = database.get_connection()
+            with conn:
+                removed += conn.execute("DELETE FROM fsm_states WHERE updated_ts < ?", (cutoff,)).rowcount
+            conn.close()
+        self.expired += removed
+        return removed
+
+    async def run(self):
+        """Yozuvlarni davriy saqlaydi; har FSM_CACHE_TTL da keshni va eski holatlarni tozalaydi"""
+        last_cleanup = time.monotonic()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                if time.monotonic() - last_cleanup >= min(FSM_CACHE_TTL, FSM_STATE_TTL):
+                    last_cleanup = time.monotonic()
+                    evicted = self.evict()
+                    removed = await run_write(self.purge_expired)
+                    if evicted or removed:
+                        logger.info(f"🗂 FSM: keshdan {evicted} ta chiqarildi, bazadan {removed} ta eski holat o'chirildi")
+            except Exception:
+                logger.error(f"FSM saqlashda xatolik: {traceback.format_exc()}")
+
+    async def close(self) -> None:
+        await self.flush()
+
+    def size_report(self) -> str:
+        active = sum(1 for r in self.cache.values() if r[0] is not None or r[1])
+        return (f"{len(self.cache)} keshda, {active} ta faol, {len(self.dirty)} yozilmagan, "
+                f"{self.expired} muddati o'tgan; kesh {hit_rate(self.hits, self.misses)}")
+
+# === ROUTERS ===
+router = Router()
+admin_router = Router()
+
+router.message.middleware(throttling_middleware)
+router.callback_query.middleware(throttling_middleware)
+router.message.middleware(activity_middleware)
+router.callback_query.middleware(activity_middleware)
+
+# Apply admin filter to admin router
+def is_admin(event) -> bool:
+    return event.from_user is not None and event.from_user.id == get_admin_id()
+
+
+admin_router.message.filter(is_admin)
+admin_router.callback_query.filter(is_admin)
+
+
+# === START HANDLER ===
+@router.message(CommandStart(), flags={"throttling_key": "check"})
+async def start_handler(message: Message, bot: Bot):
+    user = message.from_user
+
+    # Referral parametrni tekshiramiz
+    referrer_id = None
+    if message.text and len(message.text.split()) > 1:
+        try:
+            referrer_id = int(message.text.split()[1])
+        except ValueError:
+            pass
+
+    conn = db.for_user(user.id).get_connection()
+    cur = conn.cursor()
+
+    # Foydalanuvchi bazada bormi?
+    cur.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
+    existing_user = cur.fetchone()
+
+    # AGAR: Yangi foydalanuvchi VA referral mavjud VA o'zini taklif qilmagan bo'lsa
+    if not existing_user and referrer_id and referrer_id != user.id:
+        print(f"🎯 YANGI REFERAL: {user.id} -> {referrer_id}")
+
+        # 1. Yangi foydalanuvchini qo'shish
+        cur.execute(
+            "INSERT INTO users (user_id, username, full_name, points, referrals, referrer_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (user.id, user.username, user.full_name, 0, 0, referrer_id),
+        )
+        record_stats(cur, "join")
+        conn.commit()
+
+        # 2. Referral egasiga ball — faqat u mavjud bo'lsa, referrals_awarded bilan bitta tranzaksiyada
+        if give_referral_points_if_needed(user.id):
+            print(f"✅ Referral {referrer_id} ga {REFERRAL_POINTS} ball qo'shildi")
+
+            # Referral egasiga xabar yuborish (mashhur havolalar uchun digestga jamlanadi)
+            try:
+                await notify(
+                    bot, referrer_id,
+                    f"🎊 Tabriklaymiz! Sizning taklif havolangiz orqali yangi foydalanuvchi qo'shildi.\n"
+                    f"📊 Sizga {REFERRAL_POINTS} ball qo'shildi!",
+                    points=REFERRAL_POINTS, referrals=1,
+                )
+            except Exception as e:
+                print(f"⚠️ Referral egasiga xabar yuborishda xatolik: {e}")
+
+    elif not existing_user:
+        # Oddiy yangi foydalanuvchi
+        cur.execute("INSERT INTO users (user_id, username, full_name, points, referrals) VALUES (?, ?, ?, ?, ?)",
+                    (user.id, user.username, user.full_name, 0, 0))
+        record_stats(cur, "join")
+        conn.commit()
+        print(f"✅ Yangi foydalanuvchi qo'shildi: {user.id}")
+
+    else:
+        # Mavjud foydalanuvchi - faqat ma'lumotlarni yangilash
+        cur.execute("UPDATE users SET username = ?, full_name = ? WHERE user_id = ?",
+                    (user.username, user.full_name, user.id))
+        conn.commit()
+        print(f"✅ Foydalanuvchi yangilandi: {user.id}")
+
+    conn.close()
+
+    # 🔒 Majburiy obuna tekshiruvi
+    is_subscribed = await check_subscription(user.id, bot)
+    if not is_subscribed:
+        keyboard = build_channels_keyboard()
+        await message.answer(
+            "❌ Iltimos, quyidagi kanallarga obuna bo'ling yoki qo'shilish so'rovini yuboring, so'ngra tekshirish tugmasini bosing:",
+            reply_markup=keyboard
+        )
+        return
+
+    # ✅ Obuna bo'lgan foydalanuvchi uchun ASOSIY XABAR
+    if user.id == get_admin_id():
+        await message.answer("👑 Xush kelibsiz, Admin!", reply_markup=admin_menu())
+    else:
+        pts = get_user_points(user.id)
+
+        await message.answer(
+            f"👋 Xush kelibsiz, {user.full_name}!\n\n"
+            f"📊 Sizning ballaringiz: {pts} ball\n\n"
+            f"Quyidagi menyu orqali botning barcha imkoniyatlaridan foydalaning:",
+            reply_markup=user_menu()
+        )
 
-    pts = row[0] if row else 0
-    refs = row[1] if row else 0
+# === BALL KO'RISH ===
+@router.message(Command("ball"))
+@router.message(F.text == "📊 Mening ballarim")
+async def my_points_cmd(message: Message, bot: Bot):
+    pts, refs = await run_read(get_user_balance, message.from_user.id)
 
     await message.answer(
         f"📊 Sizning ballaringiz: {pts} ball\n"
@@ -520,14 +2936,7 @@ async def help_handler(message: Message):
 # === REFERAL HANDLER ===
 @router.message(F.text == "👥 Referal")
 async def referral_handler(message: Message, bot: Bot):
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT points, referrals FROM users WHERE user_id = ?", (message.from_user.id,))
-    row = cur.fetchone()
-    conn.close()
-
-    pts = row[0] if row else 0
-    refs = row[1] if row else 0
+    pts, refs = await run_read(get_user_balance, message.from_user.id)
 
     bot_username = (await bot.get_me()).username
     ref_link = f"https://t.me/{bot_username}?start={message.from_user.id}"
@@ -548,7 +2957,7 @@ async def referral_handler(message: Message, bot: Bot):
 async def test_ref_handler(message: Message, bot: Bot):
     user_id = message.from_user.id
 
-    conn = db.get_connection()
+    conn = db.for_user(user_id).get_connection()
     cur = conn.cursor()
 
     # Foydalanuvchi ma'lumotlari
@@ -577,89 +2986,36 @@ async def test_ref_handler(message: Message, bot: Bot):
     await message.answer(response)
 
 # === REYTING HANDLER ===
-@router.message(F.text == "🏆 Reyting")
+@router.message(F.text == "🏆 Reyting", flags={"throttling_key": "rating"})
 async def rating_handler(message: Message):
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT full_name, points FROM users ORDER BY points DESC LIMIT 20")
-    rows = cur.fetchall()
-
     # Foydalanuvchining o'z o'rni
-    cur.execute("SELECT points FROM users WHERE user_id = ?", (message.from_user.id,))
-    up = cur.fetchone()
-    user_points = up[0] if up else 0
-    cur.execute("SELECT COUNT(*) + 1 FROM users WHERE points > ?", (user_points,))
-    user_rank = cur.fetchone()[0]
-    conn.close()
+    user_points = await run_read(get_user_points, message.from_user.id)
+    user_rank = await run_read(count_users, "WHERE points > ?", (user_points,)) + 1
 
-    msg = f"🏆 Umumiy reyting\n\n"
-    msg += f"📊 Sizning o'rningiz: {user_rank}\n"
+    page_text, keyboard = await run_read(render_rating_page)
+    msg = f"📊 Sizning o'rningiz: {user_rank}\n"
     msg += f"🎯 Sizning ballaringiz: {user_points}\n\n"
-    msg += "TOP 10 talaba:\n"
+    msg += page_text
 
-    for i, (name, points) in enumerate(rows[:10], 1):
-        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-        msg += f"{medal} {name} - {points} ball\n"
-
-    await message.answer(msg)
+    await message.answer(msg, reply_markup=keyboard)
 
 
 # === KANALLAR HANDLER ===
-@router.message(F.text == "📺 Kanallar")
+@router.message(F.text == "📺 Kanallar", flags={"throttling_key": "lists"})
 async def channels_handler(message: Message):
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name, invite_link FROM channels")
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        await message.answer("📺 Hozircha kanallar mavjud emas.")
-        return
-
-    msg = "📺 Obuna bo'lish kerak bo'lgan kanallar:\n\n"
-    for name, link in rows:
-        msg += f"➡️ {name}\n"
-        if link:
-            msg += f"🔗 {link}\n"
-        msg += "\n"
-    msg += "ℹ️ Kanallarga obuna bo'lib, qo'shimcha ball to'plashingiz mumkin!"
-    await message.answer(msg)
+    msg, keyboard = await run_read(render_channels_page)
+    await message.answer(msg, reply_markup=keyboard)
 
 
 # === SOVG'ALAR HANDLER ===
-@router.message(F.text == "🎁 Sovg'alar")
+@router.message(F.text == "🎁 Sovg'alar", flags={"throttling_key": "lists"})
 async def gifts_handler(message: Message):
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name, points_required FROM gifts ORDER BY points_required")
-    rows = cur.fetchall()
-    cur.execute("SELECT points FROM users WHERE user_id = ?", (message.from_user.id,))
-    user_points = cur.fetchone()
-    conn.close()
-
-    user_points = user_points[0] if user_points else 0
-
-    if not rows:
-        await message.answer(
-            f"🎁 Hozircha sovg'alar mavjud emas.\n\n"
-            f"📊 Sizda {user_points} ball to'plagansiz."
-        )
-        return
-
-    msg = f"🎁 Mavjud sovg'alar:\n\n"
-    msg += f"💰 Sizning ballaringiz: {user_points}\n\n"
-    for name, points_req in rows:
-        status = "✅ Sotib olish mumkin" if user_points >= points_req else f"❌ Yetarli ball yo'q"
-        msg += f"🎯 {name}\n"
-        msg += f"💰 Narxi: {points_req} ball\n"
-        msg += f"📊 Holat: {status}\n\n"
-    msg += "ℹ️ Sovg'a olish uchun admin bilan bog'laning: @admin"
-    await message.answer(msg)
+    msg, keyboard = await run_read(render_gifts_page, message.from_user.id)
+    await message.answer(msg, reply_markup=keyboard)
 
 
 # === INLINE TUGMALAR HANDLER ===
-@router.callback_query(F.data == "check_sub")
+@router.callback_query(F.data == "check_sub", flags={"throttling_key": "check"})
 async def check_subscription_callback(query: CallbackQuery, bot: Bot):
     user_id = query.from_user.id
 
@@ -685,6 +3041,103 @@ async def check_subscription_callback(query: CallbackQuery, bot: Bot):
     await query.answer()
 
 
+@router.callback_query(F.data.startswith("pg:"), flags={"throttling_key": "pages"})
+async def page_callback(query: CallbackQuery):
+    """◀️/▶️ sahifalash tugmalari"""
+    try:
+        kind, page, backward, cursor = parse_page_callback(query.data)
+    except ValueError:
+        await query.answer()
+        return
+
+    if kind == "r":
+        msg, keyboard = await run_read(render_rating_page, page, cursor, backward)
+    elif kind == "c":
+        msg, keyboard = await run_read(render_channels_page, page, cursor, backward)
+    elif kind == "g":
+        msg, keyboard = await run_read(render_gifts_page, query.from_user.id, page, cursor, backward)
+    else:
+        await query.answer()
+        return
+
+    try:
+        await query.message.edit_text(msg, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Sahifani yangilashda xatolik: {e}")
+    await query.answer()
+
+
+@router.callback_query(F.data.startswith("rd:"))
+async def redeem_prompt_callback(query: CallbackQuery):
+    """Sovg'a olishni tasdiqlash so'rovi"""
+    gift_id = int(query.data.split(":")[1])
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT name, points_required FROM gifts WHERE id = ?", (gift_id,))
+    gift = cur.fetchone()
+    conn.close()
+    if not gift:
+        await query.answer("❌ Sovg'a topilmadi", show_alert=True)
+        return
+
+    await query.message.answer(
+        f"🎁 <b>{gift[0]}</b> — {gift[1]} ball.\n\nSovg'ani olishni tasdiqlaysizmi?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✅ Tasdiqlash", callback_data=f"rdc:{gift_id}"),
+            InlineKeyboardButton(text="❌ Bekor qilish", callback_data="rdx"),
+        ]])
+    )
+    await query.answer()
+
+
+@router.callback_query(F.data.startswith("rdc:"), flags={"throttling_key": "redeem"})
+async def redeem_confirm_callback(query: CallbackQuery, bot: Bot):
+    """Sovg'ani sotib olish"""
+    gift_id = int(query.data.split(":")[1])
+    # Bitta tasdiqlash xabari — bitta buyurtma (ikki marta bosilsa ham)
+    nonce = f"msg:{query.message.message_id}"
+    try:
+        status, order_id, name, price = await run_write(redeem_gift, query.from_user.id, gift_id, nonce)
+    except Exception:
+        logger.error(f"Sovg'a olishda xatolik: {traceback.format_exc()}")
+        await query.answer("❌ Xatolik yuz berdi, keyinroq urinib ko'ring", show_alert=True)
+        return
+
+    if status == "duplicate":
+        await query.answer(f"✅ Buyurtma #{order_id} allaqachon qabul qilingan")
+        return
+    if status == "not_found":
+        await query.message.edit_text("❌ Sovg'a topilmadi.")
+    elif status == "out_of_stock":
+        await query.message.edit_text("📦 Afsuski, bu sovg'a tugadi.")
+    elif status == "no_points":
+        await query.message.edit_text(f"❌ Yetarli ball yo'q. <b>{name}</b> uchun {price} ball kerak.")
+    else:
+        await query.message.edit_text(
+            f"✅ Buyurtma #{order_id} qabul qilindi!\n"
+            f"🎁 {name} — {price} ball yechildi.\n\n"
+            f"Admin tez orada siz bilan bog'lanadi."
+        )
+        user = query.from_user
+        try:
+            await bot.send_message(
+                get_admin_id(),
+                f"🧾 <b>Yangi buyurtma #{order_id}</b>\n"
+                f"👤 {user.full_name} (<code>{user.id}</code>{', @' + user.username if user.username else ''})\n"
+                f"🎁 {name} — {price} ball",
+                reply_markup=order_admin_keyboard(order_id)
+            )
+        except Exception as e:
+            logger.error(f"Adminga buyurtma haqida xabar berishda xatolik: {e}")
+    await query.answer()
+
+
+@router.callback_query(F.data == "rdx")
+async def redeem_cancel_callback(query: CallbackQuery):
+    await query.message.edit_text("❌ Bekor qilindi.")
+    await query.answer()
+
+
 @router.callback_query(F.data == "noop")
 async def noop_callback(query: CallbackQuery):
     await query.answer("Bu kanal hozircha faol emas", show_alert=True)
@@ -700,34 +3153,33 @@ async def join_request_handler(chat_join: ChatJoinRequest, bot: Bot):
 
         # Avvalo foydalanuvchini bazaga qo'shamiz (agar yo'q bo'lsa)
         add_or_update_user(user.id, user.username, user.full_name)
+        record_user_event(user.id, "request", str(chat.id))
 
-        # Avval tekshiramiz, bu user bu kanal uchun hali ball olganmi
-        conn = db.get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM points_given WHERE user_id = ? AND channel_id = ?", (user.id, str(chat.id)))
-        already_given = cur.fetchone()
-        conn.close()
+        # Tekshiruv va yozuv bitta so'rovda: ball faqat hali berilmagan bo'lsa yoziladi
+        try:
+            awarded = award_channels(user.id, [str(chat.id)], POINTS_PER_JOIN, source="request")
+        except Exception as e:
+            logger.error(f"Ball berishda xatolik: {e}")
+            awarded = None
 
-        if not already_given:
-            # Agar hali ball berilmagan bo'lsa, bir marta beramiz
-            if give_points_once_for_channel(user.id, str(chat.id), POINTS_PER_JOIN):
-                await bot.send_message(
-                    chat_id=user.id,
-                    text=(
-                        f"📩 Assalomu alaykum, {user.full_name}!\n"
-                        f"Siz {chat.title} kanaliga qo'shilish so'rovi yubordingiz.\n"
-                        f"🎉 Sizga {POINTS_PER_JOIN} ball berildi!"
-                    ),
-                )
-                logger.info(f"✅ {user.id} foydalanuvchiga {POINTS_PER_JOIN} ball berildi (join request)")
-            else:
-                await bot.send_message(
-                    chat_id=user.id,
-                    text=(
-                        f"📩 Siz {chat.title} kanaliga so'rov yuborgansiz.\n"
-                        f"❌ Ball berishda xatolik yuz berdi."
-                    ),
-                )
+        if awarded:
+            await bot.send_message(
+                chat_id=user.id,
+                text=(
+                    f"📩 Assalomu alaykum, {user.full_name}!\n"
+                    f"Siz {chat.title} kanaliga qo'shilish so'rovi yubordingiz.\n"
+                    f"🎉 Sizga {POINTS_PER_JOIN} ball berildi!"
+                ),
+            )
+            logger.info(f"✅ {user.id} foydalanuvchiga {POINTS_PER_JOIN} ball berildi (join request)")
+        elif awarded is None:
+            await bot.send_message(
+                chat_id=user.id,
+                text=(
+                    f"📩 Siz {chat.title} kanaliga so'rov yuborgansiz.\n"
+                    f"❌ Ball berishda xatolik yuz berdi."
+                ),
+            )
         else:
             # Agar avval berilgan bo'lsa, xabarni takrorlaymiz, lekin ball qo'shmaymiz
             await bot.send_message(
@@ -739,13 +3191,8 @@ async def join_request_handler(chat_join: ChatJoinRequest, bot: Bot):
             )
 
         # YANGI QO'SHILGAN QISM: menyu ochish
-        if user.id != ADMIN_ID:
-            conn = db.get_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT points FROM users WHERE user_id = ?", (user.id,))
-            pts = cur.fetchone()
-            conn.close()
-            pts = pts[0] if pts else 0
+        if user.id != get_admin_id():
+            pts = get_user_points(user.id)
 
             await bot.send_message(
                 chat_id=user.id,
@@ -769,41 +3216,87 @@ async def join_request_handler(chat_join: ChatJoinRequest, bot: Bot):
 
 
 
+# === A'ZOLIK YANGILANISHLARI (chat_member / my_chat_member) ===
+@router.chat_member()
+async def chat_member_handler(update: ChatMemberUpdated):
+    """Kanal a'zoligi o'zgarganda subscriptions jadvalini yangilaydi"""
+    chat_id = resolve_registered_channel(update.chat)
+    if not chat_id:
+        return
+    member = update.new_chat_member
+    save_subscription_states([(member.user.id, chat_id, member_status(member))])
+
+
+@router.my_chat_member()
+async def my_chat_member_handler(update: ChatMemberUpdated, bot: Bot):
+    """Botning o'zi kanalda admin bo'lmay qolsa, keshlangan holatlar ishonchsiz bo'ladi"""
+    chat_id = resolve_registered_channel(update.chat)
+    if not chat_id:
+        return
+    status = update.new_chat_member.status
+    if status != "administrator":
+        forget_channel_states(chat_id)
+        logger.warning(f"⚠️ Bot {chat_id} kanalida admin emas ({status}) — obuna holatlari tozalandi")
+        try:
+            await bot.send_message(
+                get_admin_id(),
+                f"⚠️ Bot <b>{update.chat.title}</b> (<code>{chat_id}</code>) kanalida endi admin emas.\n"
+                f"Obunani tekshirish va ball berish bu kanal uchun ishlamaydi."
+            )
+        except Exception as e:
+            logger.error(f"Adminga xabar berishda xatolik: {e}")
+
+
 # === ADMIN HANDLERS ===
-@admin_router.message(Command("new_contest"))
-@admin_router.message(F.text == "🔁 Yangi konkurs")
-async def new_contest_cmd(message: Message):
-    """Yangi konkursni boshlash"""
+def start_new_contest():
+    """Eski konkursni arxivlab yopadi, yangisini ochadi va ballarni nolga tushiradi"""
+    # Tozalashdan oldin tarixni arxivga ko'chiramiz
+    archive_unarchived_contests()
+
     conn = db.get_connection()
     cur = conn.cursor()
     # Eski konkursni yakunlash va yangi boshlash
-    cur.execute("UPDATE contests SET is_active = 0 WHERE is_active = 1")
+    cur.execute(
+        "UPDATE contests SET is_active = 0, end_ts = MIN(COALESCE(end_ts, CURRENT_TIMESTAMP), CURRENT_TIMESTAMP) "
+        "WHERE is_active = 1"
+    )
     cur.execute("INSERT INTO contests (is_active) VALUES (1)")
-    cur.execute("UPDATE users SET points = 0, referrals = 0")
-    # 🔥 Yangi qo'shildi — eski "kanalga qo'shilish so'rovi" ma'lumotlarini tozalash:
-    cur.execute("DELETE FROM points_given")
     conn.commit()
     conn.close()
 
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET points = 0, referrals = 0")
+        reset_ledger_cursor(cur)
+        # 🔥 Yangi qo'shildi — eski "kanalga qo'shilish so'rovi" ma'lumotlarini tozalash:
+        cur.execute("DELETE FROM points_given")
+        conn.commit()
+        conn.close()
+
+
+@admin_router.message(Command("new_contest"))
+@admin_router.message(F.text == "🔁 Yangi konkurs")
+async def new_contest_cmd(message: Message):
+    """Yangi konkursni boshlash"""
+    await run_write(start_new_contest)
     await message.answer("🔁 Yangi konkurs boshlandi! Barcha ballar va obuna yozuvlari yangilandi.")
 
 
 @admin_router.message(F.text == "📢 Kanallar")
 async def admin_channels_handler(message: Message):
     """Admin kanallar menyusi"""
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT chat_id, name, invite_link FROM channels")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await run_read(query_main, "SELECT chat_id, name, invite_link FROM channels")
 
     channels_list = "📢 <b>Kanallar boshqaruvi</b>\n\n"
     if not rows:
         channels_list += "❌ Hozircha kanallar mavjud emas\n"
     else:
+        conversions = await run_read(channel_conversion_stats)
         channels_list += "📋 <b>Mavjud kanallar:</b>\n"
         for i, (chat_id, name, link) in enumerate(rows, 1):
-            channels_list += f"{i}. <b>{name}</b>\n   ID: <code>{chat_id}</code>\n   Havola: {link if link else 'Havola yo''q'}\n\n"
+            channels_list += f"{i}. <b>{name}</b>\n   ID: <code>{chat_id}</code>\n   Havola: {link if link else 'Havola yo''q'}\n"
+            channels_list += f"   {format_conversion(conversions.get(str(chat_id), {}))}\n\n"
 
     # Kanallar boshqaruv tugmalari
     keyboard = ReplyKeyboardMarkup(
@@ -934,11 +3427,7 @@ async def process_delete_channel(message: Message, state: FSMContext):
 @admin_router.message(F.text == "📋 Kanallar ro'yxati")
 async def show_channels_list(message: Message):
     """Kanallar ro'yxatini ko'rsatish"""
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT chat_id, name, invite_link FROM channels")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await run_read(query_main, "SELECT chat_id, name, invite_link FROM channels")
 
     if not rows:
         await message.answer("📭 Hozircha kanallar mavjud emas.")
@@ -956,19 +3445,16 @@ async def show_channels_list(message: Message):
 @admin_router.message(F.text == "🎁 Sovg'alar")
 async def admin_gifts_handler(message: Message):
     """Admin sovg'alar menyusi"""
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, points_required FROM gifts")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await run_read(query_main, "SELECT id, name, points_required, stock FROM gifts")
 
     gifts_list = "🎁 <b>Sovg'alar boshqaruvi</b>\n\n"
     if not rows:
         gifts_list += "❌ Hozircha sovg'alar mavjud emas\n"
     else:
         gifts_list += "📋 <b>Mavjud sovg'alar:</b>\n"
-        for id, name, points in rows:
-            gifts_list += f"{id}. <b>{name}</b> - {points} ball\n"
+        for id, name, points, stock in rows:
+            gifts_list += f"{id}. <b>{name}</b> - {points} ball ({stock if stock is not None else '♾'} ta)\n"
+        gifts_list += "\n📦 Sonini o'zgartirish: <code>/stock sovg'a_id soni</code>\n"
 
     # Sovg'alar boshqaruv tugmalari
     keyboard = ReplyKeyboardMarkup(
@@ -989,9 +3475,9 @@ async def add_gift_prompt(message: Message, state: FSMContext):
     await message.answer(
         "🎁 <b>Sovg'a qo'shish</b>\n\n"
         "Quyidagi formatda ma'lumotlarni kiriting:\n"
-        "<code>sovg'a_nomi, ball_miqdori</code>\n\n"
+        "<code>sovg'a_nomi, ball_miqdori[, soni]</code>\n\n"
         "📍 <b>Misol:</b>\n"
-        "<code>Telefon, 1000</code>\n\n"
+        "<code>Telefon, 1000, 5</code>\n\n"
         "❌ Bekor qilish uchun <b>🔙 Orqaga</b> tugmasini bosing.",
         reply_markup=ReplyKeyboardMarkup(
             keyboard=[[KeyboardButton(text="🔙 Orqaga")]],
@@ -1011,17 +3497,18 @@ async def process_add_gift(message: Message, state: FSMContext):
 
     try:
         args = message.text.split(",")
-        if len(args) != 2:
-            await message.answer("❌ Noto'g'ri format. Iltimos, 2 ta parametr kiriting: nomi, ball_miqdori")
+        if len(args) not in (2, 3):
+            await message.answer("❌ Noto'g'ri format. Iltimos, 2 yoki 3 ta parametr kiriting: nomi, ball_miqdori, soni")
             return
 
-        name, points = [arg.strip() for arg in args]
+        name, points = [arg.strip() for arg in args[:2]]
+        stock = int(args[2].strip()) if len(args) == 3 else None
 
         conn = db.get_connection()
         cur = conn.cursor()
         cur.execute(
-            "INSERT INTO gifts (name, points_required) VALUES (?, ?)",
-            (name, int(points)),
+            "INSERT INTO gifts (name, points_required, stock) VALUES (?, ?, ?)",
+            (name, int(points), stock),
         )
         conn.commit()
         conn.close()
@@ -1093,22 +3580,109 @@ async def process_delete_gift(message: Message, state: FSMContext):
 @admin_router.message(F.text == "📜 Sovg'alar ro'yxati")
 async def show_gifts_list(message: Message):
     """Sovg'alar ro'yxatini ko'rsatish"""
+    message_text, keyboard = await run_read(render_admin_gifts_page)
+    await message.answer(message_text, reply_markup=keyboard)
+
+
+@admin_router.callback_query(F.data.startswith("pg:a:"))
+async def admin_gifts_page_callback(query: CallbackQuery):
+    """Admin sovg'alar ro'yxati sahifalari"""
+    _, page, backward, cursor = parse_page_callback(query.data)
+    message_text, keyboard = await run_read(render_admin_gifts_page, page, cursor, backward)
+    try:
+        await query.message.edit_text(message_text, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Sahifani yangilashda xatolik: {e}")
+    await query.answer()
+
+
+@admin_router.message(Command("stock"))
+async def set_gift_stock_cmd(message: Message):
+    """Sovg'a sonini belgilash (qayta to'ldirish): /stock id soni"""
+    parts = (message.text or "").split()
+    try:
+        gift_id = int(parts[1])
+        stock = None if parts[2] in ("-", "♾") else int(parts[2])
+    except (IndexError, ValueError):
+        await message.answer("❌ Foydalanish: <code>/stock sovg'a_id soni</code> (cheklanmagan uchun: <code>-</code>)")
+        return
+
+    conn = db.get_connection()
+    with conn:
+        cur = conn.execute("UPDATE gifts SET stock = ? WHERE id = ?", (stock, gift_id))
+    conn.close()
+    if cur.rowcount:
+        await message.answer(f"✅ Sovg'a #{gift_id} soni: {stock if stock is not None else '♾'}")
+    else:
+        await message.answer("❌ Sovg'a topilmadi!")
+
+
+def load_pending_orders() -> tuple:
+    """(jami, [(id, user_id, full_name, username, gift_name, points, created_ts), ...])"""
     conn = db.get_connection()
     cur = conn.cursor()
-    cur.execute("SELECT id, name, points_required FROM gifts ORDER BY points_required")
-    rows = cur.fetchall()
+    cur.execute("SELECT COUNT(*) FROM gift_orders WHERE status = 'pending'")
+    total = cur.fetchone()[0]
+    cur.execute(
+        """
+        SELECT id, user_id, gift_name, points, created_ts
+        FROM gift_orders
+        WHERE status = 'pending'
+        ORDER BY id
+        LIMIT ?
+        """,
+        (PAGE_SIZE,),
+    )
+    orders = cur.fetchall()
     conn.close()
+    # Foydalanuvchilar boshqa shardda bo'lishi mumkin — ismlar alohida o'qiladi
+    names = get_user_names(o[1] for o in orders)
+    return total, [(o[0], o[1], *names.get(o[1], (None, None)), *o[2:]) for o in orders]
+
+
+@admin_router.message(F.text == "🧾 Buyurtmalar")
+async def pending_orders_handler(message: Message):
+    """Bajarilmagan buyurtmalar navbati"""
+    total, rows = await run_read(load_pending_orders)
 
     if not rows:
-        await message.answer("📭 Hozircha sovg'alar mavjud emas.")
+        await message.answer("🧾 Bajarilmagan buyurtmalar yo'q.", reply_markup=admin_menu())
         return
 
-    message_text = "📜 <b>Mavjud sovg'alar:</b>\n\n"
-    for id, name, points in rows:
-        message_text += f"<b>{id}. {name}</b>\n"
-        message_text += f"   Narxi: {points} ball\n\n"
+    await message.answer(f"🧾 <b>Bajarilmagan buyurtmalar: {total} ta</b> (eng eskilari)")
+    for order_id, user_id, full_name, username, gift_name, points, created_ts in rows:
+        await message.answer(
+            f"🧾 <b>#{order_id}</b> — {created_ts}\n"
+            f"👤 {full_name or '?'} (<code>{user_id}</code>{', @' + username if username else ''})\n"
+            f"🎁 {gift_name} — {points} ball",
+            reply_markup=order_admin_keyboard(order_id)
+        )
 
-    await message.answer(message_text)
+
+@admin_router.callback_query(F.data.startswith("ord:"))
+async def order_action_callback(query: CallbackQuery, bot: Bot):
+    """Buyurtmani bajarish yoki rad etish"""
+    _, action, order_id = query.data.split(":")
+    order_id = int(order_id)
+    result = fulfil_order(order_id) if action == "done" else reject_order(order_id)
+    if not result:
+        await query.answer("Bu buyurtma allaqachon ko'rib chiqilgan", show_alert=True)
+        return
+
+    user_id, gift_name = result
+    if action == "done":
+        status_text = "✅ Bajarildi"
+        user_text = f"🎉 Buyurtma #{order_id} ({gift_name}) bajarildi!"
+    else:
+        status_text = "❌ Rad etildi (ballar qaytarildi)"
+        user_text = f"❌ Buyurtma #{order_id} ({gift_name}) rad etildi. Ballaringiz qaytarildi."
+
+    await query.message.edit_text(f"{query.message.html_text}\n\n{status_text}")
+    try:
+        await bot.send_message(user_id, user_text)
+    except Exception as e:
+        logger.error(f"Buyurtma holati haqida xabar berishda xatolik: {e}")
+    await query.answer()
 
 
 @admin_router.message(F.text == "🔙 Orqaga")
@@ -1118,22 +3692,83 @@ async def back_to_admin_menu(message: Message, state: FSMContext):
     await message.answer("👑 Admin menyusi:", reply_markup=admin_menu())
 
 
+# === SEGMENTLI XABAR YUBORISH ===
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # xabar / soniya (Telegram limiti ~30)
+BROADCAST_ALL = "👥 Hammaga"
+BROADCAST_FILTER_HELP = (
+    "🎯 <b>Filtrlar</b> (bo'sh joy bilan ajrating, hammasi birga qo'llanadi):\n"
+    "<code>points>=50</code> — kamida 50 ball\n"
+    "<code>joined>=2024-01-01</code> — shu sanadan keyin qo'shilganlar (<code>joined<=</code> ham bor)\n"
+    "<code>referrals>=1</code> — referali borlar\n"
+    "<code>channel=-1001234567890</code> — shu kanal uchun ball olgan va chiqib ketmaganlar\n"
+    "<code>inactive=30</code> — 30 kundan beri botdan foydalanmaganlar\n\n"
+    "Misol: <code>points>=20 inactive=14</code>"
+)
+
+
+def compile_broadcast_filter(text: str) -> tuple:
+    """Filtr matnini (where, params, tavsif) ga aylantiradi; xato bo'lsa ValueError"""
+    clauses, params, labels = [], [], []
+    for token in text.split():
+        key, op, value = None, None, None
+        for candidate in (">=", "<=", "="):
+            if candidate in token:
+                key, value = token.split(candidate, 1)
+                op = candidate
+                break
+        key = (key or "").lower()
+        try:
+            if key == "points" and op == ">=":
+                clauses.append("points >= ?")
+                params.append(int(value))
+                labels.append(f"ball ≥ {int(value)}")
+            elif key == "referrals" and op == ">=":
+                clauses.append("referrals >= ?")
+                params.append(int(value))
+                labels.append(f"referallar ≥ {int(value)}")
+            elif key == "joined" and op in (">=", "<="):
+                day = datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+                # joined_ts UTC da saqlanadi; kun chegarasi sifatida sananing boshi olinadi
+                clauses.append(f"joined_ts {op} ?")
+                params.append(day if op == ">=" else f"{day} 23:59:59")
+                labels.append(f"qo'shilgan {op} {day}")
+            elif key == "channel" and op == "=":
+                clauses.append("user_id IN (SELECT user_id FROM points_given WHERE channel_id = ? AND left_ts IS NULL)")
+                params.append(value)
+                labels.append(f"kanal {value}")
+            elif key == "inactive" and op == "=":
+                days = int(value)
+                # last_active hali yozilmagan yangi foydalanuvchilar uchun joined_ts olinadi
+                clauses.append(
+                    "(last_active < datetime('now', ?) OR (last_active IS NULL AND joined_ts < datetime('now', ?)))"
+                )
+                params.extend([f"-{days} days"] * 2)
+                labels.append(f"{days} kundan beri faol emas")
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Noto'g'ri filtr: <code>{token}</code>")
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    return where, tuple(params), ", ".join(labels) or "barcha foydalanuvchilar"
+
+
 @admin_router.message(F.text == "📩 Xabar yuborish")
 async def start_broadcast(message: Message, state: FSMContext):
-    """Xabar yuborishni boshlash"""
+    """Xabar yuborishni boshlash — avval qabul qiluvchilar filtri"""
     await message.answer(
         "📢 <b>Xabar yuborish</b>\n\n"
-        "Yubormoqchi bo'lgan xabaringizni kiriting:\n\n"
-        "⚠️ <i>Xabar BARCHA obunachilarga yuboriladi (faol bo'lmaganlariga ham)!</i>",
+        f"Kimga yuborilsin? Filtr yozing yoki «{BROADCAST_ALL}» tugmasini bosing.\n\n"
+        + BROADCAST_FILTER_HELP,
         reply_markup=ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="🔙 Bekor qilish")]],
+            keyboard=[[KeyboardButton(text=BROADCAST_ALL)], [KeyboardButton(text="🔙 Bekor qilish")]],
             resize_keyboard=True,
             one_time_keyboard=True
         )
     )
-    await state.set_state(AdminStates.broadcast)
+    await state.set_state(AdminStates.broadcast_filter)
 
 
+@admin_router.message(AdminStates.broadcast_filter, F.text == "🔙 Bekor qilish")
 @admin_router.message(AdminStates.broadcast, F.text == "🔙 Bekor qilish")
 async def cancel_broadcast(message: Message, state: FSMContext):
     """Xabar yuborishni bekor qilish"""
@@ -1141,33 +3776,50 @@ async def cancel_broadcast(message: Message, state: FSMContext):
     await message.answer("✅ Xabar yuborish bekor qilindi.", reply_markup=admin_menu())
 
 
-@admin_router.message(AdminStates.broadcast)
-async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
-    """Xabarni barcha foydalanuvchilarga yuborish"""
-    msg_text = message.text
+@admin_router.message(AdminStates.broadcast_filter)
+async def process_broadcast_filter(message: Message, state: FSMContext):
+    """Filtrni tekshiradi va qabul qiluvchilar sonini (dry-run) ko'rsatadi"""
+    filter_text = "" if message.text == BROADCAST_ALL else (message.text or "")
+    try:
+        where, params, description = compile_broadcast_filter(filter_text)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{BROADCAST_FILTER_HELP}")
+        return
 
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users")
-    users = cur.fetchall()
-    conn.close()
+    recipients = await run_read(count_users, where, params)
+    if not recipients:
+        await message.answer(f"🎯 Filtr: {description}\n👥 Bunday foydalanuvchilar yo'q. Boshqa filtr kiriting.")
+        return
 
-    sent = 0
-    failed = 0
+    await state.update_data(broadcast_filter=filter_text)
+    await message.answer(
+        f"🎯 Filtr: {description}\n"
+        f"👥 Qabul qiluvchilar: <b>{recipients}</b> ta\n\n"
+        f"Yubormoqchi bo'lgan xabaringizni kiriting:",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="🔙 Bekor qilish")]],
+            resize_keyboard=True,
+            one_time_keyboard=True
+        )
+    )
+    await state.set_state(AdminStates.broadcast)
 
-    # Barcha foydalanuvchilarga xabar yuborish
-    for (uid,) in users:
-        try:
-            await bot.send_message(uid, msg_text)
-            sent += 1
-        except Exception as e:
-            failed += 1
-            logger.error(f"Xabar yuborishda xatolik {uid}: {e}")
 
+@admin_router.message(AdminStates.broadcast)
+async def process_broadcast(message: Message, state: FSMContext):
+    """Xabarni filtrga mos foydalanuvchilarga yuborish — rejalashtiruvchi orqali darhol boshlanadi.
+
+    Yuborish fon vazifasida, checkpoint bilan: handler darhol qaytadi, admin botdan foydalanishda
+    davom etadi, qayta ishga tushganda yuborish to'xtagan joyidan davom etadi.
+    """
+    filter_text = (await state.get_data()).get("broadcast_filter", "")
+    _, _, description = compile_broadcast_filter(filter_text)
     await state.clear()
+
+    job_id = schedule_job("broadcast", {"filter": filter_text, "text": message.text}, int(time.time()))
     await message.answer(
-        f"✅ Xabar {sent} foydalanuvchiga yuborildi. {failed} ta xatolik.\n\n"
-        f"📊 Jami obunachilar: {len(users)} ta",
+        f"📤 Xabar #{job_id} yuborilmoqda. Tugagach natija haqida xabar beriladi.\n\n"
+        f"🎯 Filtr: {description}",
         reply_markup=admin_menu()
     )
 
@@ -1175,11 +3827,7 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot):
 @admin_router.message(F.text == "📊 Top 10")
 async def admin_top10_handler(message: Message):
     """Admin uchun top 10"""
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT full_name, points FROM users ORDER BY points DESC LIMIT 10")
-    rows = cur.fetchall()
-    conn.close()
+    rows = await run_read(top_users, 10)
 
     msg = "🏆 <b>TOP 10 talaba:</b>\n\n" + "\n".join(
         [f"{i + 1}. {n} — {p} ball" for i, (n, p) in enumerate(rows)]
@@ -1187,21 +3835,208 @@ async def admin_top10_handler(message: Message):
     await message.answer(msg, reply_markup=admin_menu())
 
 
-@admin_router.message(F.text == "🏁 Konkursni yakunlash")
-async def end_contest_cmd(message: Message):
-    """Konkursni yakunlash"""
-    conn = db.get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT full_name, points FROM users ORDER BY points DESC LIMIT 10")
-    winners = cur.fetchall()
-    conn.close()
+def format_stats_block(title: str, stats: dict) -> str:
+    lines = [f"<b>{title}</b>"]
+    for metric, label in STATS_METRICS.items():
+        count, points = stats.get(metric, (0, 0))
+        lines.append(f"{label}: {count}" + (f" ({points} ball)" if points else ""))
+    return "\n".join(lines)
+
+
+def build_stats_text() -> str:
+    """Rollup jadvallaridan statistika — har bir blok o'zgarmas sondagi kalitlarni o'qiydi"""
+    now = time.time()
+    today = stats_buckets(now)[1]
+    yesterday = stats_buckets(now - 86400)[1]
+    last_hours = [stats_buckets(now - h * 3600)[0] for h in range(24)]
+    last_days = [stats_buckets(now - d * 86400)[1] for d in range(7)]
+
+    blocks = [
+        format_stats_block(f"📅 Bugun ({today})", read_stats("stats_daily", [today])),
+        format_stats_block(f"📅 Kecha ({yesterday})", read_stats("stats_daily", [yesterday])),
+        format_stats_block("🕐 Oxirgi 24 soat", read_stats("stats_hourly", last_hours)),
+        format_stats_block("🗓 Oxirgi 7 kun", read_stats("stats_daily", last_days)),
+        format_stats_block("📦 Jami", read_stats("stats_total")),
+    ]
+
+    channels = query_main("SELECT chat_id, name FROM channels")
+    conversions = channel_conversion_stats()
+    if channels:
+        blocks.append("<b>📢 Kanallar bo'yicha</b>\n" + "\n".join(
+            f"• {name}: {format_conversion(conversions.get(str(chat_id), {}))}" for chat_id, name in channels
+        ))
+    return "📈 <b>Statistika</b>\n\n" + "\n\n".join(blocks)
+
+
+@admin_router.message(Command("stats"))
+@admin_router.message(F.text == "📈 Statistika")
+async def stats_handler(message: Message):
+    await message.answer(await run_read(build_stats_text), reply_markup=admin_menu())
+
+
+@admin_router.message(Command("queue"))
+async def queue_cmd(message: Message):
+    """Update navbati: bajarilayotgan, kutayotgan va eng uzun navbatli foydalanuvchilar"""
+    q = update_isolation.queue_stats()
+    text = (
+        "📥 <b>Update navbati</b>\n\n"
+        f"⚙️ Bajarilmoqda: {q['running']} / {UPDATE_CONCURRENCY}\n"
+        f"⏳ Kutmoqda: {q['waiting']}\n"
+        f"👤 Navbatdagi foydalanuvchilar: {q['keys']}\n"
+        f"📦 Jami bajarilgan: {q['processed']}\n"
+        f"📈 Eng uzun navbat: {q['max_depth']}"
+    )
+    if q["busiest"]:
+        text += "\n\n" + "\n".join(f"<code>{uid}</code>: {depth}" for uid, depth in q["busiest"])
+    await message.answer(text)
+
+
+@admin_router.message(Command("diag"))
+async def diag_cmd(message: Message, fsm_storage=None):
+    """Ish vaqtidagi holat: loop, vazifalar, FSM, keshlar, xotira (tracemalloc — oldingi /diag ga nisbatan)"""
+    report = diagnostics.report(fsm_storage)
+    await message.answer(f"🩺 <b>Diagnostika</b>\n\n<pre>{html.escape(report, quote=False)}</pre>")
+
+
+def contest_winners(contest_id: int, limit: int = 10) -> list:
+    """Arxivdan (user_id, full_name, points) — reyting tartibida"""
+    with attached_archive(contest_id) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id, full_name, points FROM arc.standings ORDER BY rank LIMIT ?", (limit,))
+        return cur.fetchall()
 
+
+def contest_winners_text(contest_id: int) -> str:
     text = "🏁 <b>Konkurs yakunlandi! G'oliblar:</b>\n\n"
-    for i, (n, p) in enumerate(winners, 1):
+    for i, (_, n, p) in enumerate(contest_winners(contest_id), 1):
         medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
         text += f"{medal} {n} — {p} ball\n"
+    text += f"\n🗄 Natijalar arxivlandi (konkurs #{contest_id})."
+    return text
+
+
+@admin_router.message(Command("ledger"))
+async def ledger_cmd(message: Message):
+    """Ballar daftari: /ledger user_id — oxirgi yozuvlar, /ledger rebuild — balanslarni daftardan qayta hisoblash"""
+    arg = (message.text or "").partition(" ")[2].strip()
+    if arg == "rebuild":
+        async def rebuild():
+            updated = 0
+            for shard in db.user_shards():
+                updated += await run_write(rebuild_balances, shard)
+            await message.answer(f"♻️ {updated} ta foydalanuvchi balansi daftardan qayta hisoblandi.")
+
+        await message.answer("⏳ Balanslar daftardan qayta hisoblanmoqda...")
+        start_admin_task(rebuild(), "ledger_rebuild")
+        return
+    try:
+        user_id = int(arg)
+    except ValueError:
+        await message.answer("❌ Foydalanish: <code>/ledger user_id</code> yoki <code>/ledger rebuild</code>")
+        return
+
+    pts, refs = get_user_balance(user_id)
+    conn = db.for_user(user_id).get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT ts, delta, reason, ref FROM points_ledger WHERE user_id = ? ORDER BY id DESC LIMIT 15",
+        (user_id,),
+    )
+    rows = cur.fetchall()
+    conn.close()
+
+    text = f"📒 <b>{user_id}</b>: {pts} ball, {refs} referal\n\n"
+    text += "\n".join(f"{ts} {delta:+d} {reason}" + (f" ({ref})" if ref else "") for ts, delta, reason, ref in rows)
+    await message.answer(text or "Yozuvlar yo'q.")
+
+
+@admin_router.message(Command("find"))
+async def find_cmd(message: Message):
+    """Foydalanuvchini ism, username yoki ID bo'yicha qidirish: /find matn"""
+    text = (message.text or "").partition(" ")[2].strip()
+    if not text:
+        await message.answer("❌ Foydalanish: <code>/find ism yoki username</code>")
+        return
+
+    rows = await run_read(search_users, text)
+    if not rows:
+        await message.answer("🔍 Hech kim topilmadi.")
+        return
+    referrers = await run_read(get_user_names, [r[5] for r in rows if r[5]])
+
+    lines = [f"🔍 <b>«{html.escape(text)}» bo'yicha:</b>\n"]
+    for i, (uid, full_name, username, points, referrals, referrer_id) in enumerate(rows, 1):
+        line = f"{i}. {html.escape(full_name or '?')}" + (f" (@{username})" if username else "")
+        line += f" — <code>{uid}</code>\n   💰 {points} ball · 👥 {referrals} referal"
+        if referrer_id:
+            line += f" · 🔗 {html.escape(referrers.get(referrer_id, ('?',))[0] or '?')} (<code>{referrer_id}</code>)"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+
+@admin_router.message(F.text == "🏁 Konkursni yakunlash")
+async def end_contest_cmd(message: Message):
+    """Konkursni yakunlash"""
+    contest_id = find_active_contest_id()
+    if contest_id is None:
+        await message.answer("ℹ️ Hozirda faol konkurs yo'q.", reply_markup=admin_menu())
+        return
+    try:
+        await run_write(finish_contest, contest_id)
+    except Exception:
+        logger.error(f"Konkursni arxivlashda xatolik: {traceback.format_exc()}")
+        await message.answer("❌ Konkursni arxivlashda xatolik yuz berdi.", reply_markup=admin_menu())
+        return
+
+    await message.answer(contest_winners_text(contest_id), reply_markup=admin_menu())
+
+
+def read_archive_summary(contest_id: int) -> tuple:
+    """(contest qatori, mukofotlar soni, ballar yig'indisi, TOP 10)"""
+    with attached_archive(contest_id) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT start_ts, end_ts FROM arc.contest")
+        meta = cur.fetchone()
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(points), 0) FROM arc.points_given")
+        awards, awarded_points = cur.fetchone()
+        cur.execute("SELECT full_name, points FROM arc.standings ORDER BY rank LIMIT 10")
+        return meta, awards, awarded_points, cur.fetchall()
+
+
+@admin_router.message(Command("archive"))
+async def archive_cmd(message: Message):
+    """Arxivlangan konkurslar natijalarini ko'rish: /archive [id]"""
+    parts = (message.text or "").split()
+    if len(parts) < 2:
+        ids = list_archived_contests()
+        if not ids:
+            await message.answer("🗄 Hozircha arxivlangan konkurslar yo'q.")
+            return
+        await message.answer(
+            "🗄 <b>Arxivlangan konkurslar:</b>\n\n"
+            + "\n".join(f"• #{i} — <code>/archive {i}</code>" for i in ids[:30])
+        )
+        return
+
+    try:
+        contest_id = int(parts[1])
+        meta, awards, awarded_points, rows = await run_read(read_archive_summary, contest_id)
+    except ValueError:
+        await message.answer("❌ Konkurs ID raqam bo'lishi kerak!")
+        return
+    except FileNotFoundError:
+        await message.answer("❌ Bunday konkurs arxivi topilmadi.")
+        return
 
-    await message.answer(text, reply_markup=admin_menu())
+    start_ts, end_ts = meta if meta else ("?", "?")
+    text = (
+        f"🗄 <b>Konkurs #{contest_id}</b>\n"
+        f"📅 {start_ts} — {end_ts}\n"
+        f"📺 Kanal ballari: {awards} ta ({awarded_points} ball)\n\n"
+        "🏆 <b>TOP 10:</b>\n"
+    )
+    text += "\n".join(f"{i}. {n} — {p} ball" for i, (n, p) in enumerate(rows, 1))
+    await message.answer(text)
 
 
 @admin_router.message(F.text == "🧹 Tozalash")
@@ -1231,51 +4066,61 @@ async def reset_all_data_cmd(message: Message, state: FSMContext):
     await state.set_state(AdminStates.confirm_reset)
 
 
+def reset_all_data():
+    """Ballar, kanallar, konkurslar va sovg'alarni tozalaydi — foydalanuvchilar ro'yxati saqlanadi"""
+    # ⚠️ Barcha ma'lumotlarni tozalash, lekin users jadvalidagi asosiy ma'lumotlarni saqlab qolamiz
+    for shard in db.user_shards():
+        conn = shard.get_connection()
+        conn.executescript("""
+                           -- Faqat ballar va referal ma'lumotlarini tozalash
+                           UPDATE users
+                           SET points    = 0,
+                               referrals = 0;
+                           DELETE
+                           FROM points_given;
+                           DELETE
+                           FROM referrals_awarded;
+                           """)
+        reset_ledger_cursor(conn)
+        conn.commit()
+        if db.shards:
+            conn.execute("VACUUM")
+        conn.close()
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.executescript("""
+                      -- Boshqa jadvallarni tozalash
+                      DELETE
+                      FROM channels;
+                      DELETE
+                      FROM contests;
+                      DELETE
+                      FROM gifts;
+
+                      -- Database ni optimallashtirish
+                      VACUUM;
+                      """)
+
+    # 🔄 Yangi bo'sh konkurs yaratamiz
+    cur.execute("INSERT INTO contests (is_active) VALUES (1)")
+    conn.commit()
+    conn.close()
+
+
 @admin_router.message(AdminStates.confirm_reset, F.text == "✅ Ha, barchasini tozalash")
 async def confirm_reset(message: Message, state: FSMContext):
     """Tozalashni tasdiqlash"""
     try:
-        conn = db.get_connection()
-        cur = conn.cursor()
-
         # 📊 Avval foydalanuvchilar sonini olamiz
-        cur.execute("SELECT COUNT(*) FROM users")
-        user_count_before = cur.fetchone()[0]
-
-        # ⚠️ Barcha ma'lumotlarni tozalash, lekin users jadvalidagi asosiy ma'lumotlarni saqlab qolamiz
-        cur.executescript("""
-                          -- Faqat ballar va referal ma'lumotlarini tozalash
-                          UPDATE users
-                          SET points              = 0,
-                              referrals           = 0,
-                              total_points_earned = 0,
-                              last_active         = CURRENT_TIMESTAMP;
-
-                          -- Boshqa jadvallarni tozalash
-                          DELETE
-                          FROM channels;
-                          DELETE
-                          FROM contests;
-                          DELETE
-                          FROM points_given;
-                          DELETE
-                          FROM referrals_awarded;
-                          DELETE
-                          FROM gifts;
-
-                          -- Database ni optimallashtirish
-                          VACUUM;
-                          """)
+        user_count_before = count_users()
 
-        # 🔄 Yangi bo'sh konkurs yaratamiz
-        cur.execute("INSERT INTO contests (is_active) VALUES (1)")
-        conn.commit()
+        # 💾 Xavfsizlik nusxasi — olinmasa tozalash bajarilmaydi
+        snapshot = await asyncio.to_thread(create_backup, "pre_reset")
+        await run_write(reset_all_data)
 
         # 📊 Tozalashdan keyin foydalanuvchilar sonini tekshiramiz
-        cur.execute("SELECT COUNT(*) FROM users")
-        user_count_after = cur.fetchone()[0]
-
-        conn.close()
+        user_count_after = count_users()
 
         await message.answer(
             f"🧹 <b>Barcha ma'lumotlar muvaffaqiyatli tozalandi!</b>\n\n"
@@ -1284,7 +4129,8 @@ async def confirm_reset(message: Message, state: FSMContext):
             f"• Tozalashdan keyin: {user_count_after} foydalanuvchi\n"
             f"• Barcha ballar nolga tayinlandi\n"
             f"• Barcha referal ma'lumotlari tozalandi\n"
-            f"• Yangi konkurs yaratildi\n\n"
+            f"• Yangi konkurs yaratildi\n"
+            f"• Oldingi holat nusxasi: <code>{os.path.basename(snapshot)}</code>\n\n"
             f"✅ <b>Foydalanuvchilar ro'yxati saqlandi!</b>\n"
             f"Endi siz barcha foydalanuvchilarga xabar yuborishingiz mumkin.",
             reply_markup=admin_menu()
@@ -1299,21 +4145,1021 @@ async def confirm_reset(message: Message, state: FSMContext):
         )
 
     await state.clear()
+
+
+# === REJALASHTIRUVCHI (SCHEDULER) ===
+SCHEDULER_MAX_SLEEP = 3600  # vazifa bo'lmasa ham soatda bir marta uyg'onadi (soat o'zgarishiga qarshi)
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "5"))
+SCHEDULER_BROADCAST_BATCH = 500
+SCHEDULER_BACKGROUND_KINDS = ("broadcast",)  # uzoq vazifalar alohida task — boshqa vazifalarni kuttirmaydi
+SNAPSHOT_SIZE = int(os.getenv("SNAPSHOT_SIZE", "100"))
+WINNERS_COUNT = 10
+WINNERS_CHAT_ID = os.getenv("WINNERS_CHAT_ID")  # g'oliblar e'lon qilinadigan kanal (ixtiyoriy)
+LOCAL_TZ = timezone(timedelta(hours=STATS_UTC_OFFSET))
+
+
+def parse_local_time(text: str) -> int:
+    """'YYYY-MM-DD HH:MM' (mahalliy vaqt) -> unix vaqt; xato bo'lsa ValueError"""
+    return int(datetime.strptime(text.strip(), "%Y-%m-%d %H:%M").replace(tzinfo=LOCAL_TZ).timestamp())
+
+
+def format_local_time(ts: int) -> str:
+    return datetime.fromtimestamp(ts, LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
+
+
+def schedule_job(kind: str, payload: dict, run_at: int, job_key: str = None) -> int:
+    """Vazifani saqlaydi; shu job_key bilan kutilayotgan vazifa bo'lsa, uning vaqti va ma'lumoti yangilanadi"""
+    conn = db.get_connection()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO scheduled_jobs (kind, payload, run_at, job_key) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(job_key) WHERE status = 'pending' "
+            "DO UPDATE SET payload = excluded.payload, run_at = excluded.run_at, attempts = 0 "
+            "RETURNING id",
+            (kind, json.dumps(payload, ensure_ascii=False), int(run_at), job_key),
+        )
+        job_id = cur.fetchone()[0]
+    conn.close()
+    current_tenant.get().scheduler_wakeup.set()
+    return job_id
+
+
+def cancel_job(job_id: int = None, job_key: str = None) -> bool:
+    conn = db.get_connection()
+    with conn:
+        cur = conn.execute(
+            "UPDATE scheduled_jobs SET status = 'cancelled' WHERE status = 'pending' AND (id = ? OR job_key = ?)",
+            (job_id, job_key),
+        )
+    conn.close()
+    current_tenant.get().scheduler_wakeup.set()
+    return cur.rowcount > 0
+
+
+def next_pending_job():
+    """Eng yaqin vazifa — idx_scheduled_jobs_due bo'yicha bitta qator"""
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id, kind, payload, run_at, attempts FROM scheduled_jobs "
+        "WHERE status = 'pending' ORDER BY run_at LIMIT 1"
+    )
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+
+def parse_db_timestamp(value) -> int:
+    """Bazadagi vaqt (UTC): 'YYYY-MM-DD HH:MM:SS', 'YYYY-MM-DD', ISO ('T', zona bilan) yoki unix soniya"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    moment = datetime.fromisoformat(str(value).strip())
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def recover_jobs():
+    """Jarayon to'xtab qolganda 'running' bo'lib qolgan vazifalarni qaytaradi, o'tkazib yuborilganlarni sanaydi"""
+    conn = db.get_connection()
+    with conn:
+        interrupted = conn.execute("UPDATE scheduled_jobs SET status = 'pending' WHERE status = 'running'").rowcount
+        missed = conn.execute(
+            "SELECT COUNT(*) FROM scheduled_jobs WHERE status = 'pending' AND run_at <= ?", (int(time.time()),)
+        ).fetchone()[0]
+        # Qo'lda kiritilgan end_ts uchun vazifa yo'q bo'lsa — yaratamiz
+        cur = conn.execute(
+            "SELECT id, end_ts FROM contests WHERE is_active = 1 AND end_ts IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM scheduled_jobs WHERE status = 'pending' AND job_key = 'end_contest:' || contests.id)"
+        )
+        orphaned = cur.fetchall()
+    conn.close()
+    rescheduled = 0
+    for contest_id, end_ts in orphaned:
+        try:
+            run_at = parse_db_timestamp(end_ts)
+        except ValueError:
+            # Bitta noto'g'ri qator butun rejalashtiruvchini to'xtatmasligi kerak
+            logger.warning(f"⏰ Konkurs #{contest_id}: end_ts tushunarsiz ({end_ts!r}), avtomatik yakunlanmaydi")
+            continue
+        schedule_job("end_contest", {"contest_id": contest_id}, run_at, f"end_contest:{contest_id}")
+        rescheduled += 1
+    if interrupted or missed or rescheduled:
+        logger.info(
+            f"⏰ Rejalashtiruvchi tiklandi: {interrupted} ta to'xtatilgan, {missed} ta o'tkazib yuborilgan vazifa, "
+            f"{rescheduled} ta konkurs yakuni qayta rejalashtirildi"
+        )
+
+
+def update_job(job_id: int, **fields):
+    conn = db.get_connection()
+    with conn:
+        conn.execute(
+            f"UPDATE scheduled_jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            (*fields.values(), job_id),
+        )
+    conn.close()
+
+
+async def job_end_contest(bot: Bot, job_id: int, payload: dict):
+    contest_id = payload["contest_id"]
+    conn = db.get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT is_active FROM contests WHERE id = ?", (contest_id,))
+    row = cur.fetchone()
+    conn.close()
+    if not row or not row[0]:
+        logger.info(f"⏰ Konkurs {contest_id} allaqachon yakunlangan — o'tkazib yuborildi")
+        return
+    await run_write(finish_contest, contest_id)
+    schedule_job("publish_winners", {"contest_id": contest_id}, int(time.time()), f"publish_winners:{contest_id}")
+    logger.info(f"⏰ Konkurs {contest_id} end_ts bo'yicha avtomatik yakunlandi")
+
+
+async def job_publish_winners(bot: Bot, job_id: int, payload: dict):
+    contest_id = payload["contest_id"]
+    text = contest_winners_text(contest_id)
+    await bot.send_message(get_admin_id(), text)
+    if WINNERS_CHAT_ID:
+        await bot.send_message(WINNERS_CHAT_ID, text)
+    for rank, (user_id, _, points) in enumerate(contest_winners(contest_id, WINNERS_COUNT), 1):
+        try:
+            await bot.send_message(
+                user_id, f"🎉 Tabriklaymiz! Konkursda {rank}-o'rinni egalladingiz ({points} ball)."
+            )
+        except Exception as e:
+            logger.error(f"G'olibga xabar yuborishda xatolik {user_id}: {e}")
+
+
+async def job_snapshot(bot: Bot, job_id: int, payload: dict):
+    now = int(time.time())
+    contest_id = get_active_contest_id()
+    rows = top_users(payload.get("size", SNAPSHOT_SIZE), with_ids=True)
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO leaderboard_snapshots (snapshot_ts, contest_id, rank, user_id, full_name, points) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(now, contest_id, rank, uid, name, points) for rank, (name, points, uid) in enumerate(rows, 1)],
+        )
+    conn.close()
+    # Takroriy vazifa: keyingi snapshot shu yerning o'zida rejalashtiriladi
+    schedule_job("snapshot", payload, now + payload["interval"], "snapshot")
+
+
+async def job_broadcast(bot: Bot, job_id: int, payload: dict):
+    """Rejalashtirilgan xabar; har bir batchdan keyin checkpoint — qayta ishga tushganda davom etadi"""
+    where, params, _ = compile_broadcast_filter(payload.get("filter", ""))
+    checkpoint = payload.setdefault("checkpoint", {})
+    limiter = RateLimiter(BROADCAST_RATE)
+    for index, shard in enumerate(db.user_shards()):
+        while True:
+            last_id = checkpoint.get(str(index), 0)
+            user_ids = fetch_user_id_batch(shard, where, params, last_id, SCHEDULER_BROADCAST_BATCH)
+            if not user_ids:
+                break
+            for uid in user_ids:
+                await limiter.acquire()
+                try:
+                    await bot.send_message(uid, payload["text"])
+                    payload["sent"] = payload.get("sent", 0) + 1
+                except Exception as e:
+                    payload["failed"] = payload.get("failed", 0) + 1
+                    logger.error(f"Xabar yuborishda xatolik {uid}: {e}")
+            checkpoint[str(index)] = user_ids[-1]
+            update_job(job_id, payload=json.dumps(payload, ensure_ascii=False))
+    await bot.send_message(
+        get_admin_id(),
+        f"⏰ Rejalashtirilgan xabar yuborildi: {payload.get('sent', 0)} ta, {payload.get('failed', 0)} ta xatolik.",
+    )
+
+
+async def job_backup(bot: Bot, job_id: int, payload: dict):
+    await asyncio.to_thread(create_backup, "auto")
+    schedule_job("backup", payload, int(time.time()) + payload["interval"], "backup")
+
+
+JOB_HANDLERS = {
+    "end_contest": job_end_contest,
+    "publish_winners": job_publish_winners,
+    "snapshot": job_snapshot,
+    "broadcast": job_broadcast,
+    "backup": job_backup,
+}
+
+
+async def run_job(bot: Bot, job):
+    """Vazifani bajaradi (chaqiruvchi uni oldindan 'running' deb belgilagan)"""
+    job_id, kind, payload, run_at, attempts = job
+    try:
+        await JOB_HANDLERS[kind](bot, job_id, json.loads(payload))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"⏰ Vazifa #{job_id} ({kind}) xatosi: {traceback.format_exc()}")
+        if attempts + 1 >= SCHEDULER_MAX_ATTEMPTS:
+            update_job(job_id, status="failed", last_error=str(e))
+        else:
+            # Keyingi urinish: 1, 2, 4, ... daqiqadan keyin
+            update_job(job_id, status="pending", last_error=str(e), run_at=int(time.time()) + 60 * 2 ** attempts)
+        return
+    update_job(job_id, status="done")
+
+
+async def job_scheduler(bot: Bot):
+    """Eng yaqin vazifagacha uxlaydi; yangi vazifa qo'shilsa schedule_job uni uyg'otadi"""
+    wakeup = current_tenant.get().scheduler_wakeup
+    recovered = False
+    background = set()
+    try:
+        while True:
+            wakeup.clear()
+            try:
+                if not recovered:
+                    recover_jobs()
+                    recovered = True
+                job = next_pending_job()
+                delay = SCHEDULER_MAX_SLEEP if job is None else job[3] - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=min(delay, SCHEDULER_MAX_SLEEP))
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                # Task ishga tushguncha next_pending_job uni qayta qaytarmasligi uchun shu yerda belgilanadi
+                update_job(job[0], status="running", attempts=job[4] + 1)
+                if job[1] in SCHEDULER_BACKGROUND_KINDS:
+                    task = asyncio.create_task(run_job(bot, job))
+                    background.add(task)
+                    task.add_done_callback(background.discard)
+                    continue
+                await run_job(bot, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error(f"Rejalashtiruvchi xatosi: {traceback.format_exc()}")
+                await asyncio.sleep(60)
+    finally:
+        # To'xtatilganda 'running' bo'lib qoladi — recover_jobs keyingi ishga tushishda checkpointdan davom ettiradi
+        for task in background:
+            task.cancel()
+
+
+@admin_router.message(Command("end_at"))
+async def end_at_cmd(message: Message):
+    """Joriy konkurs yakunlanish vaqti: /end_at YYYY-MM-DD HH:MM (bekor qilish: /end_at -)"""
+    arg = (message.text or "").partition(" ")[2].strip()
+    contest_id = get_active_contest_id()
+    if arg == "-":
+        conn = db.get_connection()
+        with conn:
+            conn.execute("UPDATE contests SET end_ts = NULL WHERE id = ?", (contest_id,))
+        conn.close()
+        cancel_job(job_key=f"end_contest:{contest_id}")
+        await message.answer("✅ Avtomatik yakunlash bekor qilindi.")
+        return
+    try:
+        run_at = parse_local_time(arg)
+    except ValueError:
+        await message.answer("❌ Foydalanish: <code>/end_at 2025-01-31 20:00</code> (bekor qilish: <code>/end_at -</code>)")
+        return
+    if run_at <= time.time():
+        await message.answer("❌ Vaqt kelajakda bo'lishi kerak.")
+        return
+
+    conn = db.get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE contests SET end_ts = ? WHERE id = ?",
+            (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(run_at)), contest_id),
+        )
+    conn.close()
+    schedule_job("end_contest", {"contest_id": contest_id}, run_at, f"end_contest:{contest_id}")
+    await message.answer(
+        f"⏰ Konkurs #{contest_id} <b>{format_local_time(run_at)}</b> da avtomatik yakunlanadi "
+        f"va g'oliblar e'lon qilinadi."
+    )
+
+
+@admin_router.message(Command("schedule"))
+async def schedule_broadcast_cmd(message: Message):
+    """Rejalashtirilgan xabar: /schedule YYYY-MM-DD HH:MM [filtr] — xabar matni keyingi qatorlarda"""
+    first_line, _, text = (message.text or "").partition("\n")
+    parts = first_line.split()
+    usage = (
+        "❌ Foydalanish:\n<code>/schedule 2025-01-31 20:00 points>=10\nXabar matni...</code>\n\n"
+        + BROADCAST_FILTER_HELP
+    )
+    if len(parts) < 3 or not text.strip():
+        await message.answer(usage)
+        return
+    try:
+        run_at = parse_local_time(f"{parts[1]} {parts[2]}")
+        filter_text = " ".join(parts[3:])
+        _, _, description = compile_broadcast_filter(filter_text)
+    except ValueError as e:
+        await message.answer(f"❌ {e}" if str(e).startswith("Noto'g'ri") else usage)
+        return
+
+    job_id = schedule_job("broadcast", {"filter": filter_text, "text": text.strip()}, run_at)
+    await message.answer(
+        f"⏰ Xabar #{job_id} <b>{format_local_time(run_at)}</b> da yuboriladi.\n🎯 Filtr: {description}"
+    )
+
+
+@admin_router.message(Command("snapshots"))
+async def snapshots_cmd(message: Message):
+    """Reyting snapshotlari: /snapshots daqiqa (0 — o'chirish)"""
+    try:
+        minutes = int((message.text or "").split()[1])
+    except (IndexError, ValueError):
+        await message.answer("❌ Foydalanish: <code>/snapshots 60</code> (o'chirish: <code>/snapshots 0</code>)")
+        return
+    if minutes <= 0:
+        cancel_job(job_key="snapshot")
+        await message.answer("✅ Reyting snapshotlari o'chirildi.")
+        return
+    schedule_job("snapshot", {"interval": minutes * 60, "size": SNAPSHOT_SIZE}, int(time.time()), "snapshot")
+    await message.answer(f"📸 Reyting har {minutes} daqiqada saqlanadi (top {SNAPSHOT_SIZE}).")
+
+
+BACKUP_USAGE = (
+    "💾 <b>Zaxira nusxalar</b>\n"
+    "<code>/backup now</code> — hozir nusxa olish\n"
+    "<code>/backup every 360</code> — har N daqiqada (0 — o'chirish)\n"
+    "<code>/backup list</code> — mavjud nusxalar\n"
+    "<code>/backup send</code> — oxirgi nusxani yuborish\n"
+    "<code>/backup restore</code> — oxirgi nusxadan tiklash"
+)
+
+
+@admin_router.message(Command("backup"))
+async def backup_cmd(message: Message, bot: Bot, fsm_storage: BaseStorage):
+    """Online zaxira nusxalar: olish, jadval, ro'yxat, yuborish va tiklash"""
+    args = (message.text or "").split()[1:]
+    action = args[0] if args else ""
+
+    if action == "now":
+        snapshot = await asyncio.to_thread(create_backup, "manual")
+        size = sum(os.path.getsize(path) for path in backup_files(snapshot))
+        await message.answer(f"💾 Nusxa olindi: <code>{os.path.basename(snapshot)}</code> ({size / 1048576:.1f} MB)")
+    elif action == "every" and len(args) > 1 and args[1].isdigit():
+        minutes = int(args[1])
+        if minutes <= 0:
+            cancel_job(job_key="backup")
+            await message.answer("✅ Avtomatik zaxira nusxalar o'chirildi.")
+            return
+        schedule_job("backup", {"interval": minutes * 60}, int(time.time()), "backup")
+        await message.answer(f"💾 Zaxira nusxa har {minutes} daqiqada olinadi (oxirgi {BACKUP_KEEP} tasi saqlanadi).")
+    elif action == "list":
+        snapshots = list_backups()
+        await message.answer(
+            "💾 <b>Nusxalar:</b>\n" + "\n".join(
+                f"• <code>{os.path.basename(path)}</code> — "
+                f"{sum(os.path.getsize(f) for f in backup_files(path)) / 1048576:.1f} MB"
+                for path in reversed(snapshots)
+            ) if snapshots else "💾 Hozircha nusxalar yo'q."
+        )
+    elif action == "send":
+        snapshots = list_backups()
+        if not snapshots:
+            await message.answer("💾 Hozircha nusxalar yo'q.")
+            return
+        for path in backup_files(snapshots[-1]):
+            if os.path.getsize(path) > BACKUP_SEND_LIMIT:
+                await message.answer(f"⚠️ <code>{path}</code> juda katta — serverdan oling.")
+                continue
+            await bot.send_document(message.chat.id, FSInputFile(path), caption=os.path.basename(snapshots[-1]))
+    elif action == "restore":
+        snapshots = list_backups()
+        if not snapshots:
+            await message.answer("💾 Tiklash uchun nusxa yo'q.")
+            return
+        if args[1:] != ["confirm"]:
+            await message.answer(
+                f"⚠️ Joriy ma'lumotlar <code>{os.path.basename(snapshots[-1])}</code> nusxasi bilan almashtiriladi.\n"
+                f"Tiklashdan oldin hozirgi holatdan ham nusxa olinadi.\n\n"
+                f"Tasdiqlash: <code>/backup restore confirm</code>"
+            )
+            return
+        latest = snapshots[-1]
+        # FSM keshi tiklangan bazaga eski holatlarni qayta yozmasligi kerak
+        sqlite_fsm = isinstance(fsm_storage, SQLiteStorage)
+        if sqlite_fsm:
+            await fsm_storage.freeze(db)
+        try:
+            await asyncio.to_thread(create_backup, "pre_restore")
+            await run_write(restore_backup, latest)
+        except Exception as e:
+            logger.error(f"Tiklashda xatolik: {traceback.format_exc()}")
+            await message.answer(f"❌ Tiklashda xatolik: {e}")
+            return
+        finally:
+            if sqlite_fsm:
+                fsm_storage.invalidate(db)
+        await message.answer(f"♻️ Ma'lumotlar <code>{os.path.basename(latest)}</code> nusxasidan tiklandi.")
+    else:
+        await message.answer(BACKUP_USAGE)
+
+
+@admin_router.message(Command("jobs"))
+async def jobs_cmd(message: Message):
+    """Kutilayotgan va oxirgi muvaffaqiyatsiz vazifalar"""
+    pending = await run_read(
+        query_main,
+        "SELECT id, kind, run_at, attempts FROM scheduled_jobs WHERE status = 'pending' ORDER BY run_at LIMIT 20",
+    )
+    failed = await run_read(
+        query_main,
+        "SELECT id, kind, last_error FROM scheduled_jobs WHERE status = 'failed' ORDER BY id DESC LIMIT 5",
+    )
+
+    text = "⏰ <b>Rejalashtirilgan vazifalar</b>\n\n"
+    text += "\n".join(
+        f"#{job_id} {kind} — {format_local_time(run_at)}" + (f" (urinish: {attempts})" if attempts else "")
+        for job_id, kind, run_at, attempts in pending
+    ) or "Kutilayotgan vazifalar yo'q."
+    if failed:
+        text += "\n\n❌ <b>Muvaffaqiyatsiz:</b>\n" + "\n".join(
+            f"#{job_id} {kind}: {html.escape(error or '')}" for job_id, kind, error in failed
+        )
+    text += "\n\nBekor qilish: <code>/cancel_job ID</code>"
+    await message.answer(text)
+
+
+@admin_router.message(Command("cancel_job"))
+async def cancel_job_cmd(message: Message):
+    try:
+        job_id = int((message.text or "").split()[1])
+    except (IndexError, ValueError):
+        await message.answer("❌ Foydalanish: <code>/cancel_job ID</code>")
+        return
+    if cancel_job(job_id=job_id):
+        await message.answer(f"✅ Vazifa #{job_id} bekor qilindi.")
+    else:
+        await message.answer("❌ Bunday kutilayotgan vazifa topilmadi.")
+
+
+# === OMMAVIY IMPORT (CSV / JSONL) ===
+IMPORT_BATCH_SIZE = 10000
+IMPORT_PROGRESS_INTERVAL = 2.0  # soniya, progress xabarini yangilash oralig'i
+IMPORT_MAX_ERRORS_SHOWN = 20
+
+IMPORT_SPECS = {
+    "users": {
+        "fields": {
+            "user_id": int, "username": str, "full_name": str,
+            "points": int, "referrals": int, "referrer_id": int,
+        },
+        "required": ("user_id",),
+        "sql": """
+            INSERT INTO users (user_id, username, full_name, referrer_id)
+            VALUES (:user_id, :username, :full_name, :referrer_id)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username    = COALESCE(:username, username),
+                full_name   = COALESCE(:full_name, full_name),
+                referrer_id = COALESCE(:referrer_id, referrer_id)
+        """,
+        # Ball va referallar snapshotga emas, daftarga farq sifatida yoziladi — /ledger rebuild ularni saqlaydi
+        "ledger_sql": f"""
+            INSERT INTO points_ledger (user_id, delta, ref_delta, reason, ref)
+            SELECT b.user_id, COALESCE(:points, b.points) - b.points,
+                   COALESCE(:referrals, b.referrals) - b.referrals, 'import', 'import'
+            FROM (SELECT u.user_id,
+                         u.points + COALESCE(SUM(l.delta), 0)        AS points,
+                         u.referrals + COALESCE(SUM(l.ref_delta), 0) AS referrals
+                  FROM users u
+                  LEFT JOIN points_ledger l
+                      ON l.user_id = u.user_id AND l.id > {LEDGER_CURSOR.format(p='', name='ledger_applied_id')}
+                  WHERE u.user_id = :user_id
+                  GROUP BY u.user_id) b
+            WHERE COALESCE(:points, b.points) != b.points OR COALESCE(:referrals, b.referrals) != b.referrals
+        """,
+    },
+    "channels": {
+        "fields": {"chat_id": str, "name": str, "invite_link": str, "is_private": int},
+        "required": ("chat_id", "name"),
+        "sql": """
+            INSERT INTO channels (chat_id, name, invite_link, is_private)
+            VALUES (:chat_id, :name, :invite_link, COALESCE(:is_private, 1))
+            ON CONFLICT(chat_id) DO UPDATE SET
+                name        = :name,
+                invite_link = COALESCE(:invite_link, invite_link),
+                is_private  = COALESCE(:is_private, is_private)
+        """,
+    },
+    "gifts": {
+        "fields": {"id": int, "name": str, "points_required": int, "stock": int},
+        "required": ("name", "points_required"),
+        "sql": """
+            INSERT INTO gifts (id, name, points_required, stock)
+            VALUES (:id, :name, :points_required, :stock)
+            ON CONFLICT(id) DO UPDATE SET
+                name            = :name,
+                points_required = :points_required,
+                stock           = COALESCE(:stock, stock)
+        """,
+    },
+}
+
+
+def iter_import_records(fileobj, filename: str):
+    """Fayldan (qator_raqami, dict) juftliklarini qaytaradi (CSV yoki JSONL)"""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    if filename.lower().endswith((".jsonl", ".json", ".ndjson")):
+        for line_no, line in enumerate(text, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, e
+                continue
+            if not isinstance(record, dict):
+                yield line_no, ValueError("JSON obyekt kutilgan edi")
+                continue
+            yield line_no, record
+    else:
+        reader = csv.DictReader(text)
+        for record in reader:
+            # sarlavha 1-qator, shuning uchun ma'lumotlar 2-qatordan boshlanadi
+            yield reader.line_num, record
+
+
+def validate_import_record(kind: str, record: dict) -> dict:
+    """Yozuvni tekshiradi va SQL parametrlariga aylantiradi (xato bo'lsa ValueError)"""
+    spec = IMPORT_SPECS[kind]
+    row = {}
+    for field, cast in spec["fields"].items():
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == "":
+            row[field] = None
+            continue
+        try:
+            row[field] = cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{field}' noto'g'ri qiymat: {value!r}")
+    missing = [f for f in spec["required"] if row[f] is None]
+    if missing:
+        raise ValueError(f"majburiy maydon yo'q: {', '.join(missing)}")
+    return row
+
+
+def import_batch(kind: str, rows: list) -> int:
+    """Bitta tranzaksiyada executemany orqali upsert qiladi (shard rejimida — har bir shardga bittadan)"""
+    groups = {}
+    if kind == "users":
+        for row in rows:
+            groups.setdefault(id(db.for_user(row["user_id"])), (db.for_user(row["user_id"]), []))[1].append(row)
+    else:
+        groups[id(db)] = (db, rows)
+
+    for target, target_rows in groups.values():
+        conn = target.get_connection()
+        try:
+            with conn:
+                conn.executemany(IMPORT_SPECS[kind]["sql"], target_rows)
+                if "ledger_sql" in IMPORT_SPECS[kind]:
+                    conn.executemany(IMPORT_SPECS[kind]["ledger_sql"],
+                                     [r for r in target_rows if r["points"] is not None or r["referrals"] is not None])
+        finally:
+            conn.close()
+    return len(rows)
+
+
+def read_import_batch(kind: str, records, report: dict) -> list:
+    """Keyingi IMPORT_BATCH_SIZE ta to'g'ri yozuvni o'qib tekshiradi (xatolar report ga yoziladi)"""
+    batch = []
+    for line_no, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise ValueError(str(record))
+            batch.append(validate_import_record(kind, record))
+        except ValueError as e:
+            report["error_count"] += 1
+            if len(report["errors"]) < IMPORT_MAX_ERRORS_SHOWN:
+                report["errors"].append(f"{line_no}-qator: {e}")
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            break
+    return batch
+
+
+async def run_bulk_import(kind: str, fileobj, filename: str, progress=None) -> dict:
+    """Faylni bo'laklab import qiladi; o'qish/tekshirish va bazaga yozish alohida thread'larda bajariladi"""
+    report = {"imported": 0, "errors": [], "error_count": 0}
+    records = iter_import_records(fileobj, filename)
+    last_progress = time.monotonic()
+    while True:
+        # Dekodlash va tekshirish ham event loopni band qilmaydi
+        batch = await asyncio.to_thread(read_import_batch, kind, records, report)
+        if not batch:
+            break
+        # Event loop bo'sh qoladi, har bir batch qisqa tranzaksiya — jonli trafik kutib qolmaydi
+        report["imported"] += await run_write(import_batch, kind, batch)
+        if progress and time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await progress(report)
+    return report
+
+
+@admin_router.message(Command("import"))
+async def bulk_import_prompt(message: Message, state: FSMContext):
+    """Ommaviy importni boshlash: /import users|channels|gifts"""
+    parts = (message.text or "").split()
+    kind = parts[1].lower() if len(parts) > 1 else ""
+    if kind not in IMPORT_SPECS:
+        await message.answer(
+            "📥 <b>Ommaviy import</b>\n\n"
+            "Foydalanish: <code>/import users</code>, <code>/import channels</code> yoki <code>/import gifts</code>\n\n"
+            "Fayl formati: CSV (sarlavha qatori bilan) yoki JSONL.\n"
+            f"• users: {', '.join(IMPORT_SPECS['users']['fields'])}\n"
+            f"• channels: {', '.join(IMPORT_SPECS['channels']['fields'])}\n"
+            f"• gifts: {', '.join(IMPORT_SPECS['gifts']['fields'])}"
+        )
+        return
+
+    await state.set_state(AdminStates.bulk_import)
+    await state.update_data(import_kind=kind)
+    await message.answer(
+        f"📎 <b>{kind}</b> uchun CSV yoki JSONL faylni yuboring.\n\n"
+        "❌ Bekor qilish uchun <b>🔙 Orqaga</b> tugmasini bosing.",
+        reply_markup=ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text="🔙 Orqaga")]],
+            resize_keyboard=True
+        )
+    )
+
+
+@admin_router.message(AdminStates.bulk_import, F.document)
+async def process_bulk_import(message: Message, state: FSMContext, bot: Bot):
+    """Yuborilgan faylni import qilish"""
+    data = await state.get_data()
+    kind = data.get("import_kind")
+    await state.clear()
+
+    filename = message.document.file_name or "import.csv"
+    status = await message.answer(f"⏳ {filename} yuklanmoqda...")
+    # Katta fayl uzoq davom etadi — handler qaytadi, admin botdan foydalanishda davom etadi
+    start_admin_task(bulk_import_task(message, status, kind, filename, bot), "import")
+
+
+async def bulk_import_task(message: Message, status: Message, kind: str, filename: str, bot: Bot):
+    """Faylni yuklab import qiladi va natijani status xabarida ko'rsatadi (fon vazifasi)"""
+    async def progress(report):
+        try:
+            await status.edit_text(
+                f"⏳ Import davom etmoqda ({kind})...\n"
+                f"✅ Yozildi: {report['imported']}\n"
+                f"⚠️ Xatolar: {report['error_count']}"
+            )
+        except Exception as e:
+            logger.error(f"Import progress xabarida xatolik: {e}")
+
+    try:
+        fileobj = await bot.download(message.document)
+        started = time.monotonic()
+        report = await run_bulk_import(kind, fileobj, filename, progress)
+    except Exception as e:
+        logger.error(f"Importda xatolik: {traceback.format_exc()}")
+        await status.edit_text(f"❌ Importda xatolik yuz berdi: {e}")
+        await message.answer("👑 Admin menyusi:", reply_markup=admin_menu())
+        return
+
+    text = (
+        f"📥 <b>Import yakunlandi ({kind})</b>\n\n"
+        f"✅ Yozildi: {report['imported']}\n"
+        f"⚠️ Xatolar: {report['error_count']}\n"
+        f"⏱ Vaqt: {time.monotonic() - started:.1f} s"
+    )
+    if report["errors"]:
+        text += "\n\n<b>Birinchi xatolar:</b>\n" + "\n".join(
+            f"• {html.escape(err)}" for err in report["errors"]
+        )
+    await status.edit_text(text)
+    await message.answer("👑 Admin menyusi:", reply_markup=admin_menu())
+    logger.info(f"📥 Import ({kind}): {report['imported']} yozildi, {report['error_count']} xato")
+
+
+@admin_router.message(AdminStates.bulk_import)
+async def bulk_import_expect_file(message: Message):
+    """Import holatida fayl kutilmoqda"""
+    await message.answer("📎 Iltimos, CSV yoki JSONL faylni hujjat sifatida yuboring.")
+
+
+# === UPDATE LARNI YOZIB OLISH (CAPTURE) ===
+# Yo'l berilsa, barcha kiruvchi update lar anonimlashtirilib gzip JSONL ga yoziladi
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "hadiyam").encode()
+CAPTURE_FLUSH_EVERY = 100
+ANON_USER_KEYS = ("from", "from_user", "user", "forward_from", "sender_user", "via_bot", "left_chat_member")
+ANON_USER_LIST_KEYS = ("new_chat_members", "users")
+ANON_NAME_FIELDS = ("first_name", "last_name", "username")
+# chat_join_request.user_chat_id — foydalanuvchi bilan shaxsiy chat = user_id; contact.user_id
+ANON_ID_FIELDS = ("user_chat_id", "user_id")
+ANON_DROP_FIELDS = ("bio", "vcard", "forward_sender_name", "sender_user_name")
+
+
+class UpdateAnonymizer:
+    """user_id larni barqaror soxta id larga almashtiradi; adminlar id si saqlanadi (replayda admin handlerlari uchun)"""
+
+    def __init__(self, salt: bytes, keep_ids=()):
+        self.salt = salt
+        self.keep_ids = set(keep_ids)
+
+    def user_id(self, user_id: int) -> int:
+        if user_id in self.keep_ids:
+            return user_id
+        digest = hmac.new(self.salt, str(user_id).encode(), hashlib.sha256).digest()
+        return 10 ** 12 + int.from_bytes(digest[:8], "big") % 10 ** 12
+
+    def _person(self, obj: dict):
+        if "id" in obj:
+            obj["id"] = self.user_id(obj["id"])
+        for field in ANON_NAME_FIELDS:
+            if field in obj:
+                obj[field] = f"user{obj.get('id', '')}" if field == "first_name" else None
+        for field in ANON_NAME_FIELDS:
+            if obj.get(field) is None:
+                obj.pop(field, None)
+
+    def walk(self, obj):
+        if isinstance(obj, list):
+            for item in obj:
+                self.walk(item)
+            return obj
+        if not isinstance(obj, dict):
+            return obj
+        for field in ANON_DROP_FIELDS:
+            obj.pop(field, None)
+        for key, value in obj.items():
+            if key in ANON_ID_FIELDS and isinstance(value, int):
+                obj[key] = self.user_id(value)
+            elif key in ANON_USER_KEYS and isinstance(value, dict):
+                self._person(value)
+            elif key in ANON_USER_LIST_KEYS and isinstance(value, list):
+                for person in value:
+                    if isinstance(person, dict):
+                        self._person(person)
+            elif key == "contact" and isinstance(value, dict):
+                # Majburiy maydonlar replay uchun qoladi, qiymatlari soxta; user_id — ANON_ID_FIELDS orqali
+                for field in ANON_NAME_FIELDS:
+                    value.pop(field, None)
+                value["first_name"] = "contact"
+                value["phone_number"] = "0"
+            elif key == "chat" and isinstance(value, dict) and value.get("type") == "private":
+                self._person(value)
+            elif key == "text" and isinstance(value, str) and value.startswith("/start "):
+                # Referal havolasidagi user_id ham xuddi shunday almashtiriladi
+                arg = value.split(maxsplit=1)[1]
+                if arg.isdigit():
+                    obj[key] = f"/start {self.user_id(int(arg))}"
+            if isinstance(value, (dict, list)):
+                self.walk(value)
+        return obj
+
+
+class CaptureMiddleware(BaseMiddleware):
+    """Update larni (bot_id, vaqt bilan) gzip JSONL faylga qo'shib boradi"""
+
+    def __init__(self, path: str, anonymizer: UpdateAnonymizer):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # "a" rejimi: har bir ishga tushirish alohida gzip a'zosi, fayl butunligicha o'qiladi
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.anonymizer = anonymizer
+        self.started = time.monotonic()
+        self.pending = 0
+
+    async def __call__(self, handler, event, data):
+        try:
+            record = {
+                "t": round(time.monotonic() - self.started, 4),
+                "bot": data["bot"].id,
+                "update": self.anonymizer.walk(event.model_dump(mode="json", exclude_none=True, by_alias=True)),
+            }
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.pending += 1
+            if self.pending >= CAPTURE_FLUSH_EVERY:
+                self.file.flush()
+                self.pending = 0
+        except Exception as e:
+            logger.error(f"Update ni yozib olishda xatolik: {e}")
+        return await handler(event, data)
+
+    def close(self):
+        self.file.close()
+
+
+# === REPLAY (YOZIB OLINGAN YUKLAMANI QAYTA O'YNATISH) ===
+replay_update_id = ContextVar("replay_update_id", default=None)
+
+
+class ReplaySession(BaseSession):
+    """Telegram ga chiqmaydigan sessiya: chaqiruvlarni update bo'yicha yozadi va soxta javob qaytaradi"""
+
+    def __init__(self, member_status: str = "member"):
+        super().__init__()
+        self.member_status = member_status
+        self.calls = {}
+        self.total_calls = 0
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        self.total_calls += 1
+        # Default(parse_mode) kabi qiymatlar Telegram ga yuboriladigan ko'rinishga keltiriladi
+        params = self.prepare_value(method.model_dump(warnings=False), bot=bot, files={}, _dumps_json=False)
+        params = {k: "attach://file" if str(v).startswith("attach://") else v for k, v in params.items()}
+        self.calls.setdefault(replay_update_id.get(), []).append([method.__api_method__, params])
+        now = datetime.now()
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="replay", username="replay_bot")
+        if isinstance(method, GetChatMember):
+            user = User(id=method.user_id, is_bot=False, first_name="replay")
+            if self.member_status == "left":
+                return ChatMemberLeft(user=user)
+            return ChatMemberMember(user=user)
+        if isinstance(method, (SendMessage, SendDocument, EditMessageText)):
+            return Message(
+                message_id=self.total_calls, date=now, chat=Chat(id=getattr(method, "chat_id", 0) or 0, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+
+def read_capture(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def diff_calls(baseline: dict, current: dict, limit: int = 20) -> list:
+    """Update bo'yicha chiqish chaqiruvlari farqlari (matnli ro'yxat)"""
+    differences = []
+    for update_id in sorted(set(baseline) | set(current), key=str):
+        expected, actual = baseline.get(update_id, []), current.get(update_id, [])
+        if expected != actual:
+            differences.append(
+                f"update {update_id}: kutilgan {[c[0] for c in expected]}, olingan {[c[0] for c in actual]}"
+            )
+            for e, a in zip(expected, actual):
+                if e != a:
+                    differences.append(f"    - {json.dumps(e, ensure_ascii=False)}\n    + {json.dumps(a, ensure_ascii=False)}")
+                    break
+    return differences[:limit * 2]
+
+
+async def replay_capture(args) -> int:
+    records = list(read_capture(args.capture))
+    if not records:
+        print("Capture bo'sh")
+        return 1
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="replay_"), "replay.db")
+    session = ReplaySession(args.member_status)
+    bot = Bot(token=f"{records[0]['bot']}:replay", session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    tenants_by_bot_id[bot.id] = Tenant(bot.token, ADMIN_ID, db_path, name="replay",
+                                       archive_dir=os.path.join(os.path.dirname(db_path), "archives"))
+    dp = build_dispatcher(capture=False)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def feed(record):
+        update = Update.model_validate(record["update"], context={"bot": bot})
+        async with semaphore:
+            replay_update_id.set(update.update_id)
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Replay update {update.update_id} xatosi: {e}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        if args.speed > 0:
+            delay = record["t"] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(record)))
+    await asyncio.gather(*tasks)
+    # Jamlangan xabarnomalar ham chaqiruvlar ro'yxatiga tushsin
+    await dp.emit_shutdown(bot=bot)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"📼 {len(records)} update, {session.total_calls} API chaqiruv, {elapsed:.2f} s")
+    print(f"⚡ {len(records) / elapsed:.1f} update/s, {session.total_calls / elapsed:.1f} chaqiruv/s")
+    print(f"⏱ p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+    print(f"🗄 Baza: {db_path}")
+
+    calls = {str(k): v for k, v in session.calls.items()}
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(calls, f, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        differences = diff_calls(baseline, calls)
+        if differences:
+            print("❌ Chiqish chaqiruvlari farq qiladi:")
+            print("\n".join(differences))
+            return 1
+        print("✅ Chiqish chaqiruvlari baseline bilan bir xil")
+    return 0
+
+
+def replay_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog="hadiyam.bot.py replay", description="Yozib olingan update larni qayta o'ynatish")
+    parser.add_argument("capture", help="CAPTURE_PATH bilan yozilgan .jsonl.gz fayl")
+    parser.add_argument("--speed", type=float, default=0, help="1 — real vaqt, 10 — 10x tez, 0 — iloji boricha tez")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="bir vaqtda qayta ishlanadigan update lar (1 — qat'iy tartib, diff uchun barqaror)")
+    parser.add_argument("--db", help="replay uchun baza (prod nusxasi); berilmasa vaqtinchalik bo'sh baza")
+    parser.add_argument("--member-status", choices=("member", "left"), default="member",
+                        help="getChatMember soxta javobi")
+    parser.add_argument("--out", help="chiqish chaqiruvlarini JSON ga yozish")
+    parser.add_argument("--compare", help="oldingi --out fayli bilan solishtirish")
+    return asyncio.run(replay_capture(parser.parse_args(argv)))
+
+
 # === MAIN FUNCTION ===
-async def main():
-    """Asosiy funksiya"""
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher()
+def build_dispatcher(capture: bool = True) -> Dispatcher:
+    # Holatlar qayta ishga tushganda saqlanib qoladi; FSM_STORAGE=memory — eski xotira rejimi
+    storage = SQLiteStorage() if FSM_STORAGE == "sqlite" else None
+    dp = Dispatcher(storage=storage, events_isolation=update_isolation)
+    dp.update.outer_middleware(TenantMiddleware())
+    # Sessiyalar yopilishidan oldin ishlaydi — jamlangan xabarnomalar yo'qolmaydi
+    dp.shutdown.register(notification_digest.flush_all)
+    if capture and CAPTURE_PATH:
+        admin_ids = {t.admin_id for t in tenants_by_bot_id.values()}
+        if default_tenant is not None:
+            admin_ids.add(default_tenant.admin_id)
+        dp["capture_middleware"] = CaptureMiddleware(CAPTURE_PATH, UpdateAnonymizer(CAPTURE_SALT, admin_ids))
+        dp.update.outer_middleware(dp["capture_middleware"])
+        logger.info(f"📼 Update lar yozib olinmoqda: {CAPTURE_PATH}")
 
     # Routerlarni qo'shamiz
     dp.include_router(admin_router)
     dp.include_router(router)
+    return dp
 
-    logger.info("🤖 Bot ishga tushdi...")
-    await dp.start_polling(bot)
+
+async def main():
+    """Asosiy funksiya"""
+    diagnostics.install(asyncio.get_running_loop())
+    tenants = load_tenants()
+    # Barcha botlar bitta HTTP ulanishlar hovuzidan (va bitta circuit breaker dan) foydalanadi
+    session = ResilientSession(**runtime_profile["session_kwargs"])
+    bots = []
+    for tenant in tenants:
+        bot = Bot(token=tenant.token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+        tenants_by_bot_id[bot.id] = tenant
+        bots.append(bot)
+    dp = build_dispatcher()
+
+    background_tasks = [asyncio.create_task(loop_monitor.run())]
+    if DIAG_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(diagnostics.run(dp.fsm.storage)))
+    if isinstance(dp.fsm.storage, SQLiteStorage):
+        background_tasks.append(asyncio.create_task(dp.fsm.storage.run()))
+    for tenant, bot in zip(tenants, bots):
+        if SWEEP_INTERVAL > 0:
+            background_tasks.append(create_tenant_task(tenant, subscription_sweeper(bot)))
+        background_tasks.append(create_tenant_task(tenant, job_scheduler(bot)))
+        background_tasks.append(create_tenant_task(tenant, ledger_compactor()))
+
+    loop_name = type(asyncio.get_running_loop()).__module__.split(".")[0]
+    logger.info(
+        f"⚙️ Ish vaqti profili: {runtime_profile['name']} — loop: {runtime_profile['loop']} ({loop_name}), "
+        f"JSON: {runtime_profile['json']}"
+    )
+    logger.info(f"🤖 Bot ishga tushdi... ({len(bots)} ta bot: {', '.join(t.name for t in tenants)})")
+    try:
+        # chat_member yangilanishlari faqat aniq so'ralganda keladi
+        # Har bir update alohida task; tartib va parallellik update_isolation da boshqariladi
+        await dp.start_polling(*bots, allowed_updates=dp.resolve_used_update_types(), handle_as_tasks=True)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        if "capture_middleware" in dp.workflow_data:
+            dp["capture_middleware"].close()
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    asyncio.run(main())
\ No newline at end of file
+    runtime_profile = load_runtime_profile()
+    # python hadiyam.bot.py replay capture.jsonl.gz [--speed 10] [--out calls.json] [--compare calls.json]
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        sys.exit(replay_main(sys.argv[2:]))
+    asyncio.run(main())
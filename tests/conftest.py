@@ -0,0 +1,24 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+BOT_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "hadiyam.bot.py")
+
+
+@pytest.fixture(scope="session")
+def hb(tmp_path_factory):
+    """hadiyam.bot.py ni vaqtinchalik papkada yuklaydi (bazalar repo ichida yaratilmaydi)"""
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+    os.environ.pop("BOTS_CONFIG", None)
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    spec = importlib.util.spec_from_file_location("hadiyam_bot", BOT_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["hadiyam_bot"] = module
+    try:
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,61 @@
+import json
+
+REAL_IDS = (111111111, 222222222, 333333333, 444444444, 555555555)
+REAL_STRINGS = ("Alisher", "Navoiy", "alisher_n", "Bobur", "bobur_m", "+998901234567", "Zahiriddin",
+                "real_bot", "Secret bio", "Hidden Person", "BEGIN:VCARD")
+
+
+def fixture_update():
+    alisher = {"id": 111111111, "is_bot": False, "first_name": "Alisher", "last_name": "Navoiy",
+               "username": "alisher_n"}
+    bobur = {"id": 222222222, "is_bot": False, "first_name": "Bobur", "username": "bobur_m"}
+    return {
+        "update_id": 1,
+        "message": {
+            "message_id": 10,
+            "date": 0,
+            "chat": {"id": 111111111, "type": "private", "first_name": "Alisher", "username": "alisher_n"},
+            "from": dict(alisher),
+            "forward_from": dict(bobur),
+            "forward_origin": {"type": "user", "date": 0, "sender_user": dict(bobur)},
+            "forward_sender_name": "Hidden Person",
+            "via_bot": {"id": 333333333, "is_bot": True, "first_name": "Zahiriddin", "username": "real_bot"},
+            "new_chat_members": [dict(bobur), {"id": 444444444, "is_bot": False, "first_name": "Zahiriddin"}],
+            "contact": {"phone_number": "+998901234567", "first_name": "Bobur", "user_id": 222222222,
+                        "vcard": "BEGIN:VCARD"},
+            "reply_to_message": {
+                "message_id": 9, "date": 0, "chat": {"id": 111111111, "type": "private"},
+                "from": {"id": 555555555, "is_bot": False, "first_name": "Alisher"},
+            },
+            "text": "/start 222222222",
+        },
+        "chat_join_request": {
+            "chat": {"id": -100123, "type": "channel", "title": "Kanal"},
+            "from": dict(alisher),
+            "user_chat_id": 111111111,
+            "date": 0,
+            "bio": "Secret bio",
+        },
+    }
+
+
+def test_walk_removes_real_ids_and_names(hb):
+    anonymizer = hb.UpdateAnonymizer(b"test-salt")
+    dumped = json.dumps(anonymizer.walk(fixture_update()), ensure_ascii=False)
+    for value in REAL_IDS:
+        assert str(value) not in dumped
+    for value in REAL_STRINGS:
+        assert value not in dumped
+
+
+def test_walk_is_consistent_and_keeps_admins(hb):
+    anonymizer = hb.UpdateAnonymizer(b"test-salt", keep_ids={111111111})
+    update = anonymizer.walk(fixture_update())
+    message = update["message"]
+    fake = anonymizer.user_id(222222222)
+    assert message["from"]["id"] == 111111111
+    assert message["forward_from"]["id"] == fake
+    assert message["forward_origin"]["sender_user"]["id"] == fake
+    assert message["contact"]["user_id"] == fake
+    assert message["text"] == f"/start {fake}"
+    assert update["chat_join_request"]["user_chat_id"] == 111111111
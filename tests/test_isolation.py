@@ -0,0 +1,60 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+
+def key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def handle(isolation, user_id: int, name: str, log: list, delay: float):
+    async with isolation.lock(key(user_id)):
+        log.append(("start", name))
+        await asyncio.sleep(delay)
+        log.append(("end", name))
+
+
+def test_same_user_updates_run_in_order(hb):
+    async def scenario():
+        isolation = hb.OrderedEventIsolation(concurrency=8)
+        log = []
+        first = asyncio.create_task(handle(isolation, 7, "first", log, 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(handle(isolation, 7, "second", log, 0))
+        await asyncio.gather(first, second)
+        return log, isolation.queue_stats()
+
+    log, stats = asyncio.run(scenario())
+    assert log == [("start", "first"), ("end", "first"), ("start", "second"), ("end", "second")]
+    assert stats["processed"] == 2 and stats["keys"] == 0
+
+
+def test_different_users_run_in_parallel(hb):
+    async def scenario():
+        isolation = hb.OrderedEventIsolation(concurrency=8)
+        log = []
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(handle(isolation, uid, f"user{uid}", log, 0.1) for uid in range(1, 6)))
+        return log, asyncio.get_running_loop().time() - started
+
+    log, elapsed = asyncio.run(scenario())
+    # Hammasi birinchi tugashdan oldin boshlangan — ketma-ket bo'lganda 0.5 s ketardi
+    assert [event for event, _ in log[:5]] == ["start"] * 5
+    assert elapsed < 0.3
+
+
+def test_concurrency_limit_is_respected(hb):
+    async def scenario():
+        isolation = hb.OrderedEventIsolation(concurrency=2)
+        peak = 0
+
+        async def probe(uid):
+            nonlocal peak
+            async with isolation.lock(key(uid)):
+                peak = max(peak, isolation.running)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(probe(uid) for uid in range(10)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2